@@ -0,0 +1,40 @@
+# Routes writes to BLE characteristics to their handlers as they happen. Every routed characteristic has a task
+# waiting on aioble's written(), so nothing runs while nothing is written.
+import uasyncio as asyncio
+
+
+class WriteDispatcher:
+    def __init__(self):
+        self.routes = []
+        self.tasks = []
+        self.writes = 0
+
+    def route(self, characteristic, handler, capture=False):
+        # handler(value) gets the bytes written. It may be a plain function or an async one.
+        # capture: the characteristic was made with capture=True, so every write is handled, in order. Otherwise
+        # writes that come in while the handler runs are handled once, with the latest value.
+        self.routes.append((characteristic, handler, capture))
+
+    async def serve(self, characteristic, handler, capture):
+        while True:
+            if capture:
+                connection, value = await characteristic.written()
+            else:
+                await characteristic.written()
+                value = characteristic.read()
+            self.writes += 1
+            try:
+                result = handler(value)
+                if result is not None:
+                    await result
+            except Exception as e:
+                print("Error handling write:", e)
+
+    def start(self):
+        for characteristic, handler, capture in self.routes:
+            self.tasks.append(asyncio.create_task(self.serve(characteristic, handler, capture)))
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
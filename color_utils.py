@@ -1,3 +1,5 @@
+import array
+import json
 import math
 import time
 import random
@@ -92,6 +94,63 @@ def RGB2RGBW(r, g, b):
     return (rgbw[1], rgbw[0], rgbw[2], rgbw[3])
     return (rgbw[0], rgbw[1], rgbw[2], rgbw[3])
 
+# RGB2RGBW is slow (float math and two cos per color), but patterns convert the same few colors over and over.
+# The last RGBW_CACHE_SIZE conversions are kept, keyed by 0xRRGGBB; when full, the oldest entry is replaced.
+RGBW_CACHE_SIZE = 256
+_rgbw_cache = {}
+_rgbw_cache_keys = [None] * RGBW_CACHE_SIZE
+_rgbw_cache_next = 0
+
+def RGB2RGBW_cached(r, g, b):
+    global _rgbw_cache_next
+    key = r << 16 | g << 8 | b
+    rgbw = _rgbw_cache.get(key)
+    if rgbw is None:
+        rgbw = RGB2RGBW(r, g, b)
+        old_key = _rgbw_cache_keys[_rgbw_cache_next]
+        if old_key is not None:
+            del _rgbw_cache[old_key]
+        _rgbw_cache_keys[_rgbw_cache_next] = key
+        _rgbw_cache_next = (_rgbw_cache_next + 1) % RGBW_CACHE_SIZE
+        _rgbw_cache[key] = rgbw
+    return rgbw
+
+# Precomputed RGB2RGBW for every color quantized to RGBW_LUT_LEVELS levels per channel, as packed 0xRRGGBBWW words.
+# It takes 16 KB and a few seconds to build on the Pico; colors are rounded to the nearest level.
+RGBW_LUT_LEVELS = 16
+
+def build_RGB2RGBW_lut():
+    top = RGBW_LUT_LEVELS - 1
+    lut = array.array("I", [0] * (RGBW_LUT_LEVELS * RGBW_LUT_LEVELS * RGBW_LUT_LEVELS))
+    i = 0
+    for r in range(RGBW_LUT_LEVELS):
+        for g in range(RGBW_LUT_LEVELS):
+            for b in range(RGBW_LUT_LEVELS):
+                lut[i] = pack_rgbw(RGB2RGBW(r * 255 // top, g * 255 // top, b * 255 // top))
+                i += 1
+    return lut
+
+def RGB2RGBW_lut(lut, r, g, b):
+    top = RGBW_LUT_LEVELS - 1
+    return lut[(((r * top + 127) // 255) * RGBW_LUT_LEVELS + (g * top + 127) // 255) * RGBW_LUT_LEVELS + (b * top + 127) // 255]
+
+# Convert <data>, a buffer of r, g, b bytes, into packed RGBW words in <out> in one pass.
+# With a lut from build_RGB2RGBW_lut colors are quantized, otherwise they are converted exactly through the cache.
+# Returns the number of pixels converted.
+def RGB2RGBW_frame(out, data, lut=None):
+    count = min(len(out), len(data) // 3)
+    if lut is not None:
+        top = RGBW_LUT_LEVELS - 1
+        levels = RGBW_LUT_LEVELS
+        for i in range(count):
+            j = 3 * i
+            out[i] = lut[(((data[j] * top + 127) // 255) * levels + (data[j + 1] * top + 127) // 255) * levels + (data[j + 2] * top + 127) // 255]
+        return count
+    for i in range(count):
+        j = 3 * i
+        out[i] = pack_rgbw(RGB2RGBW_cached(data[j], data[j + 1], data[j + 2]))
+    return count
+
 def RGBToRGBW(r, g, b, blueCorrectionEnabled=False):
     # Source: https://github.com/BertanT/Arduino-RGBWConverter/blob/main/src/RGBWConverter.cpp
     # Converted to Python by me :)
@@ -142,6 +201,130 @@ def wheel(wheel_pos):
         wheel_pos -= 170
         return (0, wheel_pos * 3, 255 - wheel_pos * 3)
 
+# Pack an (r, g, b) or (r, g, b, w) tuple into one 0xRRGGBBWW word, the framebuffer's pixel format.
+def pack_rgbw(color):
+    if len(color) == 4:
+        return color[0] << 24 | color[1] << 16 | color[2] << 8 | color[3]
+    return color[0] << 24 | color[1] << 16 | color[2] << 8
+
+def unpack_rgbw(value):
+    return (value >> 24, (value >> 16) & 255, (value >> 8) & 255, value & 255)
+
+# Blend two packed 0xRRGGBBWW colors in integers. amount is 0..255: 0 gives color1, 255 gives color2.
+def blend8(color1, color2, amount):
+    # Stretch 0..255 to 0..256, so that 255 gives exactly color2
+    amount += amount >> 7
+    inv = 256 - amount
+    return (((color1 >> 24) * inv + (color2 >> 24) * amount + 128) >> 8) << 24 | \
+        ((((color1 >> 16) & 255) * inv + ((color2 >> 16) & 255) * amount + 128) >> 8) << 16 | \
+        ((((color1 >> 8) & 255) * inv + ((color2 >> 8) & 255) * amount + 128) >> 8) << 8 | \
+        (((color1 & 255) * inv + (color2 & 255) * amount + 128) >> 8)
+
+# Integer version of lerp for (r, g, b) or (r, g, b, w) tuples. amount is 0..255 instead of 0..1.
+def lerp8(color1, color2, amount):
+    if len(color1) != len(color2):
+        raise ValueError("Both colors must be either RGB or RGBW.")
+    amount += amount >> 7
+    inv = 256 - amount
+    return tuple((c1 * inv + c2 * amount + 128) >> 8 for c1, c2 in zip(color1, color2))
+
+# Alpha ramps for antialiased line edges, by feather width. Line ends are at sub-pixel positions in 1/256ths of
+# a pixel, quantised to FEATHER_PHASES phases. kernel[phase * (feather + 2) + k] is the alpha 0..255 of the k-th
+# pixel inside the end of a line whose end lies <phase> sixteenths into its first pixel: the coverage of the
+# pixel for feather 0, a linear ramp to full over feather + 1 pixels otherwise.
+FEATHER_PHASES = 16
+_feather_kernels = {}
+
+def feather_kernel(feather):
+    kernel = _feather_kernels.get(feather)
+    if kernel is None:
+        width = feather + 2
+        ramp = (feather + 1) * 256
+        kernel = bytearray(FEATHER_PHASES * width)
+        for phase in range(FEATHER_PHASES):
+            for k in range(width):
+                # Distance from the end of the line to the center of the pixel, plus half a pixel
+                d = k * 256 + 256 - phase * (256 // FEATHER_PHASES)
+                kernel[phase * width + k] = min(255, max(0, d * 255 // ramp))
+        _feather_kernels[feather] = kernel
+    return kernel
+
+# Palettes: gradients of up to 16 stops, expanded once into 256 packed RGBW words so a pixel's color is one lookup.
+# A palette is defined as a list of stops [index, r, g, b] or [index, r, g, b, w], with indices 0..255 in
+# increasing order. Palettes shipped with the board are in palettes.json, by name.
+PALETTE_FILE = "palettes.json"
+_palette_definitions = None
+_palettes = {}
+
+def expand_palette(stops):
+    if not 2 <= len(stops) <= 16:
+        raise ValueError("A palette has 2 to 16 stops.")
+    palette = array.array("I", [0] * 256)
+    rgb_only = True
+    for stop in stops:
+        if len(stop) != 4:
+            rgb_only = False
+    for k in range(len(stops) - 1):
+        start = stops[k]
+        end = stops[k + 1]
+        span = end[0] - start[0]
+        if span <= 0:
+            # Same index twice: a hard edge, the next stop starts right away
+            continue
+        if rgb_only:
+            # Blend in RGB, then convert every entry, as RGB2RGBW isn't linear
+            for i in range(span + 1):
+                r, g, b = lerp8(start[1:], end[1:], i * 255 // span)
+                palette[start[0] + i] = pack_rgbw(RGB2RGBW(r, g, b))
+        else:
+            color1 = _pack_stop(start)
+            color2 = _pack_stop(end)
+            for i in range(span + 1):
+                palette[start[0] + i] = blend8(color1, color2, i * 255 // span)
+    # Stops don't have to start at 0 or end at 255: extend the first and last color
+    for i in range(stops[0][0]):
+        palette[i] = palette[stops[0][0]]
+    for i in range(stops[-1][0] + 1, 256):
+        palette[i] = palette[stops[-1][0]]
+    return palette
+
+def _pack_stop(stop):
+    if len(stop) == 4:
+        return pack_rgbw(RGB2RGBW(stop[1], stop[2], stop[3]))
+    return pack_rgbw(stop[1:])
+
+def _load_palette_definitions():
+    global _palette_definitions
+    if _palette_definitions is None:
+        with open(PALETTE_FILE) as f:
+            _palette_definitions = json.load(f)
+    return _palette_definitions
+
+# Expanded palette by name, from PALETTE_FILE. Definitions are read on first use and every palette is expanded
+# once; palettes that aren't used cost nothing.
+def get_palette(name):
+    palette = _palettes.get(name)
+    if palette is not None:
+        return palette
+    stops = _load_palette_definitions().get(name)
+    if stops is None:
+        raise ValueError("Unknown palette: %s" % name)
+    palette = expand_palette(stops)
+    _palettes[name] = palette
+    return palette
+
+def palette_names():
+    return list(_load_palette_definitions())
+
+# Packed RGBW color at <index> (0..255, wraps around) of an expanded palette, scaled by brightness 0..255.
+def color_from_palette(palette, index, brightness=255):
+    color = palette[index & 255]
+    if brightness == 255:
+        return color
+    brightness += 1
+    return (((color >> 24) * brightness) >> 8) << 24 | ((((color >> 16) & 255) * brightness) >> 8) << 16 | \
+        ((((color >> 8) & 255) * brightness) >> 8) << 8 | (((color & 255) * brightness) >> 8)
+
 def lerp(color1, color2, t):
     # Check whether the colors are RGB or RGBW.
     if len(color1) == 3 and len(color2) == 3:
@@ -151,79 +334,90 @@ def lerp(color1, color2, t):
     else:
         raise ValueError("Both colors must be either RGB or RGBW.")
 
-def beatsin88(beats_per_minute, lowest, highest):
-    # Convert beats per minute to beats per second
-    bps = beats_per_minute / 60.0
-
-    # Calculate the current position in the waveform
-    t = time.time() * bps * 2 * math.pi
-
-    # Map the sine wave to the desired range
-    val = math.sin(t) * 127.5 + 127.5
-
-    # Scale and constrain the result to the specified range
-    val = int((val / 255.0) * (highest - lowest) + lowest)
-
-    return val
-
-def beatsin16(beats_per_minute, lowest, highest):
-    # Convert beats per minute to beats per second
-    bps = beats_per_minute / 60.0
-
-    # Calculate the current position in the waveform
-    t = time.time() * bps * 2 * math.pi
-
-    # Map the sine wave to the desired range
-    val = math.sin(t) * 32767.5 + 32767.5
-
-    # Scale and constrain the result to the specified range
-    val = int((val / 65535.0) * (highest - lowest) + lowest)
-
-    return val
-def beatsin8(beats_per_minute, lowest, highest):
-    # Convert beats per minute to beats per second
-    bps = beats_per_minute / 60.0
-
-    # Calculate the current position in the waveform
-    t = time.time() * bps * 2 * math.pi
-
-    # Map the sine wave to the desired range
-    val = math.sin(t) * 127.5 + 127.5
-
-    # Scale and constrain the result to the specified range
-    val = int((val / 255.0) * (highest - lowest) + lowest)
-
-    return val
-
-def beat16(beats_per_minute):
-    # Convert beats per minute to beats per second
-    bps = beats_per_minute / 60.0
-
-    # Calculate the current position in the waveform
-    t = time.time() * bps
-
-    # Calculate the fractional part of the waveform
-    frac_part = t - int(t)
-
-    # Scale the fractional part to the range [0, 65535]
-    val = int(frac_part * 65535) % 65536
-
-    return val
-
-def sin16(angle):
-    # Map the sine wave to the range [0, 65535]
-    sin_val = (math.sin(angle / 65536.0 * 2 * math.pi) + 1) / 2.0
-
-    # Scale the result to the range [0, 65535]
-    val = int(sin_val * 65535) % 65536
-
-    return val
+# Beats in the style of FastLED, driven by time.ticks_ms(). A full turn is 0..65535 (0..255 for beat8). The
+# phase of a beat is integer math within MicroPython's small integers (30 bits), so it stays exact however long
+# the board runs; the sine waves on top of it are plain floats.
+_TURN16 = 2 * math.pi / 65536
+
+# Time of the frame being drawn, see begin_frame(). None means the beats follow the clock.
+_frame_ms = None
+_frame_m60 = 0
+_frame_m15 = 0
+# One minute, and 256 minutes: after that a beat in 1/256 beats per minute is back at the same phase
+_MINUTE_MS = 60000
+_BEAT88_PERIOD_MS = 256 * 60000
+
+# Take one timestamp for a whole frame, so every beat drawn in it is in step. Call end_frame() to go back
+# to following the clock.
+def begin_frame(now_ms=None):
+    global _frame_ms, _frame_m60, _frame_m15
+    if now_ms is None:
+        now_ms = time.ticks_ms()
+    _frame_ms = now_ms
+    _frame_m60 = now_ms % _MINUTE_MS
+    _frame_m15 = now_ms % _BEAT88_PERIOD_MS
+    return now_ms
+
+def end_frame():
+    global _frame_ms
+    _frame_ms = None
+
+def frame_ms():
+    if _frame_ms is None:
+        return time.ticks_ms()
+    return _frame_ms
 
 def scale16(i, scale):
-    # Perform a fixed-point multiplication and scale the result
-    val = (i * scale + 32768) // 65536
-
-    return val
+    # i * scale / 65536, where scale 65535 keeps i. Split in two, so the product stays a small integer.
+    scale += 1
+    return ((i >> 8) * scale + (((i & 255) * scale) >> 8)) >> 8
+
+def sin16(theta):
+    # 0..65535 wave
+    return int(32767.5 + 32767.5 * math.sin(theta * _TURN16))
+
+def _wave(theta, lowest, highest):
+    # Sine wave between lowest and highest
+    return lowest + int((highest - lowest) * (math.sin(theta * _TURN16) + 1) / 2)
+
+# Phase (0..65535) of a beat of <bpm88> / 256 beats per minute, started at <timebase> ms.
+# ticks_ms wraps around every 2**30 ms (about 12 days), which makes the beats jump once.
+def beat88(bpm88, timebase=0):
+    if _frame_ms is None:
+        now = time.ticks_ms()
+        m60 = now % _MINUTE_MS
+        m15 = now % _BEAT88_PERIOD_MS
+    else:
+        m60 = _frame_m60
+        m15 = _frame_m15
+    m60 = (m60 - timebase) % _MINUTE_MS
+    m15 = (m15 - timebase) % _BEAT88_PERIOD_MS
+    # Beats so far are ms * bpm88 / (256 * 60000). Only the fraction is needed: take the whole beats per minute
+    # modulo a minute and the 1/256 part modulo 256 minutes, in two halves so no product exceeds 30 bits.
+    low = bpm88 & 255
+    x = 256 * ((m60 * (bpm88 >> 8)) % _MINUTE_MS)
+    x += ((m15 * (low >> 4)) % _BEAT88_PERIOD_MS) * 16 + m15 * (low & 15)
+    return ((x % _BEAT88_PERIOD_MS) * 8) // 1875
+
+def beat16(bpm, timebase=0):
+    # Like FastLED, values below 256 are whole beats per minute, larger ones are in 1/256 beats per minute
+    if bpm < 256:
+        bpm <<= 8
+    return beat88(bpm, timebase)
+
+def beat8(bpm, timebase=0):
+    return beat16(bpm, timebase) >> 8
+
+# Sine wave between lowest and highest at <bpm88> / 256 beats per minute
+def beatsin88(bpm88, lowest=0, highest=65535, timebase=0, phase_offset=0):
+    return _wave(beat88(bpm88, timebase) + phase_offset, lowest, highest)
+
+def beatsin16(bpm, lowest=0, highest=65535, timebase=0, phase_offset=0):
+    return _wave(beat16(bpm, timebase) + phase_offset, lowest, highest)
+
+def beatsin8(bpm, lowest=0, highest=255, timebase=0, phase_offset=0):
+    # phase_offset in 1/256 of a turn
+    return _wave(beat16(bpm, timebase) + (phase_offset << 8), lowest, highest)
 
 def getAverageLightness(r, g, b):
     # Average of R, G, and B
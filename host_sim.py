@@ -0,0 +1,2307 @@
+# Host stand-ins for the Pico hardware, so the LED code can be exercised and measured on a PC.
+#
+# Run with CPython on the host:   python host_sim.py
+# install() registers fake 'rp2', 'machine', 'micropython' and 'uasyncio' modules and adds the
+# MicroPython ticks_* / sleep_* functions to 'time'. After that 'neopixel' and 'patterns' import normally
+# and every rp2.StateMachine they create is a FakeStateMachine recording what it was sent.
+import array
+import sys
+import time
+import types
+import asyncio
+
+# Every PIO bit is 10 cycles at 8MHz
+_BIT_US = 1.25
+_FIFO_DEPTH = 8
+
+state_machines = []
+
+
+class FakeProgram:
+    def __init__(self, name, options):
+        self.name = name
+        self.pull_thresh = options.get("pull_thresh", 32)
+
+
+class FakeStateMachine:
+    """
+    Stand-in for rp2.StateMachine. Records every word put into the TX FIFO together with the time
+    it was put, and simulates the wire: words leave the FIFO at the speed of the led protocol and
+    put blocks while the FIFO is full, like on the Pico.
+    """
+
+    def __init__(self, sm_id, program=None, freq=8000000, sideset_base=None):
+        self.id = sm_id
+        self.bits = program.pull_thresh if program is not None else 32
+        self.word_s = self.bits * _BIT_US / 1000000
+        self.words = []
+        self.puts = []
+        # When False only the timing is simulated, words and puts aren't kept
+        self.record = True
+        self.busy_until = 0.0
+        self.wire_time = 0.0
+        self.is_active = 0
+        state_machines.append(self)
+
+    def active(self, value=None):
+        if value is None:
+            return self.is_active
+        self.is_active = value
+
+    def reset(self):
+        self.words = []
+        self.puts = []
+        self.wire_time = 0.0
+
+    def enqueue(self, value, shift=0, blocking=True):
+        if isinstance(value, int):
+            values = (value,)
+        else:
+            values = value
+        now = time.perf_counter()
+        if self.record:
+            count = 0
+            for word in values:
+                self.words.append((word << shift) & 0xFFFFFFFF)
+                count += 1
+            self.puts.append((now, count))
+        else:
+            count = len(values)
+        self.busy_until = max(now, self.busy_until) + count * self.word_s
+        self.wire_time += count * self.word_s
+        if blocking:
+            # put returns once the last word fits into the FIFO
+            wait = self.busy_until - _FIFO_DEPTH * self.word_s - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+
+    def put(self, value, shift=0):
+        self.enqueue(value, shift)
+
+    def tx_fifo(self):
+        pending = (self.busy_until - time.perf_counter()) / self.word_s
+        if pending <= 0:
+            return 0
+        return min(_FIFO_DEPTH, int(pending) + 1)
+
+
+class FakeDMA:
+    """
+    Stand-in for rp2.DMA writing to a FakeStateMachine. The transfer is handed over at once and the
+    channel stays active until the words would have been drained into the FIFO.
+    """
+
+    def __init__(self):
+        self.sm = None
+        self.transfers = 0
+
+    def pack_ctrl(self, **kwargs):
+        return kwargs
+
+    def config(self, read=None, write=None, count=None, ctrl=None, trigger=False):
+        self.sm = write
+        if trigger:
+            self.transfers += 1
+            write.enqueue(memoryview(read)[:count], blocking=False)
+
+    def active(self, value=None):
+        if self.sm is None:
+            return False
+        return time.perf_counter() < self.sm.busy_until - _FIFO_DEPTH * self.sm.word_s
+
+    def close(self):
+        pass
+
+
+class FakePin:
+    OUT = 1
+    IN = 0
+    PULL_UP = 1
+
+    def __init__(self, pin_id, mode=None, value=None, pull=None):
+        self.id = pin_id
+        self.pin_value = value or 0
+
+    def value(self, value=None):
+        if value is None:
+            return self.pin_value
+        self.pin_value = value
+
+    def irq(self, handler=None, trigger=None):
+        pass
+
+
+class FakeThreadSafeFlag:
+    # uasyncio's ThreadSafeFlag: like an Event, but wait() clears it
+    def __init__(self):
+        self.event = asyncio.Event()
+
+    def set(self):
+        self.event.set()
+
+    def clear(self):
+        self.event.clear()
+
+    async def wait(self):
+        await self.event.wait()
+        self.event.clear()
+
+
+class FakeClock:
+    """
+    Virtual ticks_ms / ticks_us for checks that count frames, so a busy host can't change the result. Time only
+    moves when every sleeping task waits for a later time than the earliest sleeper, or on busy().
+    """
+    def __init__(self):
+        self.us = 0
+        self.waiting = []
+        self.saved = None
+
+    def install(self):
+        import uasyncio
+        self.saved = (time.ticks_ms, time.ticks_us, time.sleep_ms, time.sleep_us, uasyncio.sleep_ms)
+        time.ticks_ms = lambda: self.us // 1000
+        time.ticks_us = lambda: self.us
+        time.sleep_ms = self.busy
+        time.sleep_us = lambda us: self.busy(us / 1000)
+        uasyncio.sleep_ms = self.sleep_ms
+        return self
+
+    def restore(self):
+        import uasyncio
+        time.ticks_ms, time.ticks_us, time.sleep_ms, time.sleep_us, uasyncio.sleep_ms = self.saved
+
+    def busy(self, ms):
+        # Code that keeps the CPU for <ms>
+        self.us += int(ms * 1000)
+
+    async def sleep_ms(self, ms):
+        wake = self.us + max(0, int(ms)) * 1000
+        self.waiting.append(wake)
+        try:
+            await asyncio.sleep(0)
+            while self.us < wake:
+                if wake <= min(self.waiting):
+                    self.us = wake
+                else:
+                    await asyncio.sleep(0)
+        finally:
+            self.waiting.remove(wake)
+
+
+class FakeCharacteristic:
+    """
+    Stand-in for aioble.Characteristic. client_write() is a write by the connected central: it stores the
+    value and wakes written(), as aioble does. With capture, written() returns every write in order.
+    notify() records the notifications sent; with notify_limit it fails like aioble does when the central falls
+    behind.
+    """
+    def __init__(self, value=b"", capture=False, notify_limit=None, interval_ms=15):
+        self.value = value
+        self.capture = capture
+        self.captured = []
+        self.notified = []
+        self.notify_limit = notify_limit
+        self.interval_ms = interval_ms
+        self.window = None
+        self.window_count = 0
+        self.event = asyncio.Event()
+
+    def read(self):
+        return self.value
+
+    def write(self, value, send_update=False):
+        self.value = value
+
+    def notify(self, connection, data=None):
+        # A central taking at most notify_limit notifications per connection interval, like a phone's buffers
+        if self.notify_limit is not None:
+            window = int(time.perf_counter() * 1000 // self.interval_ms)
+            if window != self.window:
+                self.window = window
+                self.window_count = 0
+            if self.window_count >= self.notify_limit:
+                raise OSError(12)
+            self.window_count += 1
+        self.notified.append(bytes(data))
+
+    def client_write(self, value):
+        self.value = value
+        if self.capture:
+            self.captured.append(value)
+        self.event.set()
+
+    async def written(self, timeout_ms=None):
+        while not self.event.is_set():
+            await self.event.wait()
+        if self.capture:
+            value = self.captured.pop(0)
+            if not self.captured:
+                self.event.clear()
+            return None, value
+        self.event.clear()
+
+
+# Worst case conversion time of a DS18X20 in ms by resolution, from the datasheet
+_DS18X20_CONVERSION_MS = {9: 93.75, 10: 187.5, 11: 375, 12: 750}
+
+
+class FakeDS18X20:
+    """
+    Stand-in for ds18x20.DS18X20 on a one-wire bus with a sensor for every temperature in <temperatures>.
+    convert_temp() starts a conversion on all sensors at once. A sensor read before its conversion is done
+    returns its previous reading (85.0, the power-on value, before the first), as the real ones do. Readings are
+    rounded to the resolution in the sensor's configuration register. Sensors in <failing> raise CRC errors.
+    """
+    def __init__(self, temperatures):
+        self.temperatures = list(temperatures)
+        self.roms = [bytes((0x28, index, 0, 0, 0, 0, 0, 0)) for index in range(len(temperatures))]
+        self.configs = [0x7F] * len(temperatures)
+        self.readings = [85.0] * len(temperatures)
+        self.started = None
+        self.failing = set()
+        self.conversions = 0
+        self.stale = 0
+
+    def scan(self):
+        return list(self.roms)
+
+    def convert_temp(self):
+        self.conversions += 1
+        self.started = time.perf_counter()
+        self.done = [False] * len(self.roms)
+
+    def read_scratch(self, rom):
+        return bytearray((0, 0, 75, 70, self.configs[self.roms.index(rom)], 0xFF, 0, 0x10, 0))
+
+    def write_scratch(self, rom, buf):
+        self.configs[self.roms.index(rom)] = buf[2]
+
+    def read_temp(self, rom):
+        index = self.roms.index(rom)
+        if index in self.failing:
+            raise Exception("CRC error")
+        resolution = 9 + (self.configs[index] >> 5)
+        if self.started is not None and not self.done[index] and \
+                (time.perf_counter() - self.started) * 1000 >= _DS18X20_CONVERSION_MS[resolution]:
+            step = 0.5 / (1 << (resolution - 9))
+            self.readings[index] = round(self.temperatures[index] / step) * step
+            self.done[index] = True
+        if not self.done[index]:
+            self.stale += 1
+        return self.readings[index]
+
+
+def _asm_pio(**options):
+    def wrap(program):
+        return FakeProgram(program.__name__, options)
+    return wrap
+
+
+def install(dma=True):
+    """
+    Register the fake hardware modules. Must be called before importing neopixel or patterns.
+
+    :param dma: [default: True] whether the fake rp2 module offers rp2.DMA
+    :return: None
+    """
+    rp2 = types.ModuleType("rp2")
+    rp2.asm_pio = _asm_pio
+    rp2.StateMachine = FakeStateMachine
+    rp2.PIO = types.SimpleNamespace(OUT_LOW=0, SHIFT_LEFT=0)
+    if dma:
+        rp2.DMA = FakeDMA
+    machine = types.ModuleType("machine")
+    machine.Pin = FakePin
+    micropython = types.ModuleType("micropython")
+    micropython.const = lambda value: value
+    micropython.schedule = lambda func, arg: func(arg)
+    uasyncio = types.ModuleType("uasyncio")
+    uasyncio.__dict__.update(asyncio.__dict__)
+    uasyncio.sleep_ms = lambda ms: asyncio.sleep(ms / 1000)
+    uasyncio.ThreadSafeFlag = FakeThreadSafeFlag
+    sys.modules["rp2"] = rp2
+    sys.modules["machine"] = machine
+    sys.modules["micropython"] = micropython
+    sys.modules["uasyncio"] = uasyncio
+    for name in ("neopixel", "pattern_base", "patterns", "scene"):
+        sys.modules.pop(name, None)
+
+    start = time.perf_counter()
+    time.ticks_us = lambda: int((time.perf_counter() - start) * 1000000)
+    time.ticks_ms = lambda: int((time.perf_counter() - start) * 1000)
+    time.ticks_diff = lambda a, b: a - b
+    time.ticks_add = lambda a, b: a + b
+    time.sleep_us = lambda us: time.sleep(us / 1000000)
+    time.sleep_ms = lambda ms: time.sleep(ms / 1000)
+
+
+def check_dirty_tracking(num_leds=151):
+    """
+    Check that unchanged frames are skipped and that a change only sends the pixels up to it.
+
+    :return: None, raises AssertionError on mismatch
+    """
+    install()
+    from neopixel import Neopixel
+    np = Neopixel(num_leds, 0, 22, "RGBW")
+    np.fill((10, 20, 30, 40))
+    np.show()
+    assert len(np.sm.words) == num_leds
+    np.fill((10, 20, 30, 40))
+    np.show()
+    assert len(np.sm.words) == num_leds and np.frames_skipped == 1
+    np.set_pixel(10, (1, 2, 3, 4))
+    np.show()
+    assert len(np.sm.words) == num_leds + 11
+    assert np.sm.words[-11:] == list(np.pixels[:11])
+    np.rotate_left()
+    np.show()
+    assert len(np.sm.words) == 2 * num_leds + 11
+    assert (np.frames_sent, np.frames_skipped) == (3, 1)
+
+
+def check_lut_packing(samples=2000, mode="GRBW"):
+    """
+    Check that the lookup table packing matches the float formula it replaced, for random colours
+    and brightness levels.
+
+    :return: None, raises AssertionError on mismatch
+    """
+    import random
+    install()
+    from neopixel import Neopixel
+    np = Neopixel(1, 0, 22, mode)
+    sh_R, sh_G, sh_B, sh_W = np.shift
+    for _ in range(samples):
+        color = tuple(random.randint(0, 255) for _ in range(4))
+        how_bright = random.randint(1, 255)
+        bratio = how_bright / 255.0
+        r, g, b, w = (round(c * bratio) for c in color)
+        np.set_pixel(0, color, how_bright)
+        np.render(1)
+        assert np.pixels[0] == w << sh_W | b << sh_B | r << sh_R | g << sh_G, (color, how_bright)
+
+
+def check_brightness_mask(num_leds=151, mode="GRBW"):
+    """
+    Check that the per-pixel brightness mask gives the float formula's result within 1 (the global brightness and
+    the mask each round once), for random colours, global brightness and a mask of many levels, and that the mask
+    doesn't build brightness lookup tables.
+
+    :return: None, raises AssertionError on mismatch
+    """
+    import random
+    install()
+    from neopixel import Neopixel
+    np = Neopixel(num_leds, 0, 22, mode)
+    sh_R, sh_G, sh_B, sh_W = np.shift
+    for _ in range(20):
+        how_bright = random.randint(1, 255)
+        np.brightness(how_bright)
+        colors = [tuple(random.randint(0, 255) for _ in range(4)) for _ in range(num_leds)]
+        for i in range(num_leds):
+            np.set_pixel(i, colors[i])
+            np.set_brightness(i, random.choice((0, 255, random.randint(0, 255))))
+        luts = list(np.lut_order)
+        np.render(num_leds)
+        assert np.lut_order == luts
+        for i in range(num_leds):
+            scale = how_bright / 255.0 * np.mask[i] / 255.0
+            # Without a white channel, zip stops at blue
+            for c, shift in zip(colors[i], (sh_R, sh_G, sh_B, sh_W)[:4 if np.W_in_mode else 3]):
+                assert abs((np.pixels[i] >> shift & 255) - c * scale) <= 1, (colors[i], how_bright, np.mask[i])
+
+
+def benchmark_brightness_mask(num_leds=151, frames=50):
+    """
+    Time rendering a frame without a brightness mask, with a mask of 8 levels and with a ramp of a level per pixel.
+
+    :return: (unmasked ms, 8 levels ms, ramp ms) per frame
+    """
+    install()
+    from neopixel import Neopixel
+    np = Neopixel(num_leds, 0, 22, "RGBW")
+    np.fill((200, 100, 50, 25))
+    results = []
+    for levels in (None, 8, num_leds):
+        if levels is not None:
+            for i in range(num_leds):
+                np.set_brightness(i, 255 - (i % levels) * 255 // levels)
+        start = time.perf_counter()
+        for _ in range(frames):
+            np.render(num_leds)
+        results.append((time.perf_counter() - start) * 1000 / frames)
+    return tuple(results)
+
+
+def check_framebuffer(num_leds=151):
+    """
+    Check that colors read back exactly whatever the brightness, and that a brightness change is
+    applied by the next show() without redrawing.
+
+    :return: None, raises AssertionError on mismatch
+    """
+    import random
+    install()
+    from neopixel import Neopixel
+    np = Neopixel(num_leds, 0, 22, "GRBW")
+    np.brightness(37)
+    colors = [tuple(random.randint(0, 255) for _ in range(4)) for _ in range(num_leds)]
+    for i in range(num_leds):
+        np.set_pixel(i, colors[i], random.randint(0, 255))
+    for i in range(num_leds):
+        assert np.get_pixel(i) == colors[i]
+    np.show()
+    dim = list(np.pixels)
+    np.brightness(255)
+    np.show()
+    assert np.frames_sent == 2 and list(np.pixels) != dim
+
+
+def check_rotate_no_alloc(num_leds=151, rotations=5000):
+    """
+    Check that rotating gives the same pixels as rotating a list, and that thousands of rotations
+    (with the frames shown in between) don't allocate.
+
+    :return: None, raises AssertionError on mismatch or heap growth
+    """
+    import tracemalloc
+    install()
+    from neopixel import Neopixel
+    np = Neopixel(num_leds, 0, 22, "GRBW")
+    expected = [(i, 255 - i, i // 2, 7) for i in range(num_leds)]
+    for i in range(num_leds):
+        np.set_pixel(i, expected[i])
+    np.rotate_left(5)
+    np.rotate_right(2)
+    expected = expected[3:] + expected[:3]
+    assert [np.get_pixel(i) for i in range(num_leds)] == expected
+    reference = Neopixel(num_leds, 1, 23, "GRBW")
+    for i in range(num_leds):
+        reference.set_pixel(i, expected[i])
+    np.show()
+    reference.show()
+    assert np.pixels == reference.pixels
+
+    np.sm.record = False
+    tracemalloc.start()
+    for i in range(100):
+        np.rotate_left()
+        np.show()
+    before = tracemalloc.get_traced_memory()[0]
+    # The peak also catches short-lived copies, which on the Pico would pile up until the next GC
+    tracemalloc.reset_peak()
+    for i in range(rotations):
+        if i & 1:
+            np.rotate_right(3)
+        else:
+            np.rotate_left(7)
+        np.show()
+    growth = tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    assert growth < 1024, growth
+
+
+def check_bulk_writers(num_leds=151):
+    """
+    Check that set_pixels and write_frame give the same framebuffer as set_pixel, also when the
+    copy wraps around the ring offset, and that pixels before the start of the strip are left out.
+
+    :return: None, raises AssertionError on mismatch
+    """
+    import random
+    install()
+    from neopixel import Neopixel
+    bulk = Neopixel(num_leds, 0, 22, "GRBW")
+    single = Neopixel(num_leds, 1, 23, "GRBW")
+    bulk.rotate_left(100)
+    colors = [tuple(random.randint(0, 255) for _ in range(4)) for _ in range(num_leds)]
+    bulk.set_pixels(0, bytearray(c for color in colors[:60] for c in color))
+    bulk.set_pixels(60, bytearray(c for color in colors[60:90] for c in color[:3]), with_W=False)
+    packed = array.array("I", [r << 24 | g << 16 | b << 8 | w for r, g, b, w in colors])
+    bulk.write_frame(memoryview(packed)[90:], 90)
+    for i in range(num_leds):
+        single.set_pixel(i, colors[i] if not 60 <= i < 90 else colors[i][:3])
+    assert [bulk.get_pixel(i) for i in range(num_leds)] == [single.get_pixel(i) for i in range(num_leds)]
+    expected = [bulk.get_pixel(i) for i in range(num_leds)]
+    bulk.write_frame(memoryview(packed)[:10], -5)
+    expected[:5] = colors[5:10]
+    assert [bulk.get_pixel(i) for i in range(num_leds)] == expected
+    bulk.set_pixels(-3, bytearray(c for color in colors[:8] for c in color))
+    expected[:5] = colors[3:8]
+    assert [bulk.get_pixel(i) for i in range(num_leds)] == expected
+    bulk.write_frame(packed, -num_leds)
+    assert [bulk.get_pixel(i) for i in range(num_leds)] == expected
+
+
+def _float_gradient(left_pixel, right_pixel, stops):
+    # The float interpolation set_pixel_line_gradient used to do, extended to several stops
+    span = right_pixel - left_pixel
+    segments = len(stops) - 1
+    colors = []
+    for s in range(segments):
+        count = (s + 1) * span // segments - s * span // segments
+        c1 = [(stops[s] >> sh) & 255 for sh in (24, 16, 8, 0)]
+        c2 = [(stops[s + 1] >> sh) & 255 for sh in (24, 16, 8, 0)]
+        for i in range(count):
+            colors.append(tuple(round(a + (b - a) * i / count) for a, b in zip(c1, c2)))
+    colors.append(tuple((stops[-1] >> sh) & 255 for sh in (24, 16, 8, 0)))
+    return colors
+
+
+def check_gradient_engine(num_leds=151, samples=200):
+    """
+    Check that the fixed point gradient and blend8 stay within 1 of the float interpolation, and that
+    stops land exactly on their pixels.
+
+    :return: None, raises AssertionError on mismatch
+    """
+    import random
+    install()
+    from neopixel import Neopixel
+    from color_utils import blend8, unpack_rgbw
+    np = Neopixel(num_leds, 0, 22, "GRBW")
+    np.rotate_left(40)
+    for _ in range(samples):
+        left = random.randint(0, num_leds - 2)
+        right = random.randint(left + 1, num_leds - 1)
+        stops = [random.getrandbits(32) for _ in range(random.randint(2, min(5, right - left + 1)))]
+        np.fill_gradient(left, right, stops)
+        expected = _float_gradient(left, right, stops)
+        for i, color in enumerate(expected):
+            got = np.get_pixel(left + i)
+            assert max(abs(a - b) for a, b in zip(got, color)) <= 1, (left, right, i, got, color)
+        assert np.get_pixel(left) == unpack_rgbw(stops[0]) and np.get_pixel(right) == unpack_rgbw(stops[-1])
+        # Started before pixel 0: the same colors, shifted
+        shift = random.randint(1, right)
+        before = [np.get_pixel(i) for i in range(num_leds)]
+        np.fill_gradient(left - shift, right - shift, stops)
+        for i, color in enumerate(expected):
+            if 0 <= left - shift + i:
+                before[left - shift + i] = np.get_pixel(left - shift + i)
+                assert max(abs(a - b) for a, b in zip(before[left - shift + i], color)) <= 1, (left, right, shift, i)
+        assert [np.get_pixel(i) for i in range(num_leds)] == before
+    for _ in range(samples * 10):
+        c1 = random.getrandbits(32)
+        c2 = random.getrandbits(32)
+        amount = random.randint(0, 255)
+        got = unpack_rgbw(blend8(c1, c2, amount))
+        for a, b, c in zip(unpack_rgbw(c1), unpack_rgbw(c2), got):
+            assert abs(a + (b - a) * amount / 255 - c) <= 1
+        assert blend8(c1, c2, 0) == c1 and blend8(c1, c2, 255) == c2
+
+
+def benchmark_gradient(num_leds=151, frames=50):
+    """
+    Time a gradient over the whole strip with the float per-pixel path it replaced and with fill_gradient.
+
+    :return: (float_ms, fixed_ms) per gradient
+    """
+    install()
+    from neopixel import Neopixel
+    np = Neopixel(num_leds, 0, 22, "GRBW")
+    left_rgb_w = (255, 40, 0, 10)
+    right_rgb_w = (0, 80, 255, 200)
+    start = time.perf_counter()
+    for _ in range(frames):
+        for i in range(num_leds):
+            fraction = i / (num_leds - 1)
+            np.set_pixel(i, tuple(round((b - a) * fraction + a) for a, b in zip(left_rgb_w, right_rgb_w)))
+    float_ms = (time.perf_counter() - start) * 1000 / frames
+    start = time.perf_counter()
+    for _ in range(frames):
+        np.set_pixel_line_gradient(0, num_leds - 1, left_rgb_w, right_rgb_w)
+    fixed_ms = (time.perf_counter() - start) * 1000 / frames
+    return float_ms, fixed_ms
+
+
+def benchmark_set_pixel(num_leds=151, frames=50):
+    """
+    Time Neopixel.set_pixel over a whole strip with a per-pixel brightness, as the patterns call it.
+
+    :return: microseconds per set_pixel call
+    """
+    install()
+    from neopixel import Neopixel
+    np = Neopixel(num_leds, 0, 22, "GRBW")
+    colors = [((i * 7) & 255, (i * 13) & 255, (i * 29) & 255, i & 255) for i in range(num_leds)]
+    start = time.perf_counter()
+    for frame in range(frames):
+        for i in range(num_leds):
+            np.set_pixel(i, colors[(i + frame) % num_leds], 255)
+    return (time.perf_counter() - start) * 1000000 / (frames * num_leds)
+
+
+def benchmark_rainbow(frames=50):
+    """
+    Time one Rainbow frame drawn pixel by pixel through set_pixel (as before the bulk writers)
+    and through the wheel table and write_frame.
+
+    :return: (per_pixel_ms, bulk_ms) per frame
+    """
+    install()
+    import patterns
+    from color_utils import wheel
+    rainbow = patterns.Rainbow()
+    num_pixels = rainbow.NUM_PIXELS
+    start = time.perf_counter()
+    for j in range(frames):
+        for i in range(num_pixels):
+            rainbow.set_pixel(i, wheel((((i * 255) // num_pixels) + j) & 255))
+    per_pixel = (time.perf_counter() - start) * 1000 / frames
+    reference = list(rainbow.NP.frame)
+    start = time.perf_counter()
+    for j in range(frames):
+        rainbow.draw(j)
+    bulk = (time.perf_counter() - start) * 1000 / frames
+    assert list(rainbow.NP.frame) == reference
+    return per_pixel, bulk
+
+
+def check_rgbw_conversion(samples=2000):
+    """
+    Check that the cached and whole-frame RGB2RGBW conversions give exactly the same words as RGB2RGBW,
+    and that the cache stays within its size.
+
+    :return: None, raises AssertionError on mismatch
+    """
+    import random
+    import color_utils
+    data = bytearray(random.getrandbits(8) for _ in range(3 * samples))
+    for i in range(samples):
+        r, g, b = data[3 * i], data[3 * i + 1], data[3 * i + 2]
+        assert color_utils.RGB2RGBW_cached(r, g, b) == color_utils.RGB2RGBW(r, g, b)
+        assert color_utils.RGB2RGBW_cached(r, g, b) == color_utils.RGB2RGBW(r, g, b)
+    assert len(color_utils._rgbw_cache) <= color_utils.RGBW_CACHE_SIZE
+    out = array.array("I", [0] * samples)
+    assert color_utils.RGB2RGBW_frame(out, data) == samples
+    for i in range(samples):
+        assert out[i] == color_utils.pack_rgbw(color_utils.RGB2RGBW(data[3 * i], data[3 * i + 1], data[3 * i + 2]))
+
+
+def rgbw_lut_accuracy(step=5, tolerance=16):
+    """
+    Compare the quantized RGB2RGBW lookup table against the exact conversion over a grid of colors.
+    RGB2RGBW jumps near white (saturation goes to 1 as lightness does), so a few colors there are far off.
+
+    :param step: Distance between sampled channel values
+    :param tolerance: Channel error above which a color counts as off
+    :return: (max_error, mean_error, off_share): channel errors in 0..255 units and the share of colors off
+    """
+    import color_utils
+    lut = color_utils.build_RGB2RGBW_lut()
+    worst = 0
+    total = 0
+    count = 0
+    off = 0
+    for r in range(0, 256, step):
+        for g in range(0, 256, step):
+            for b in range(0, 256, step):
+                exact = color_utils.RGB2RGBW(r, g, b)
+                word = color_utils.RGB2RGBW_lut(lut, r, g, b)
+                color_error = 0
+                for c, shift in zip(exact, (24, 16, 8, 0)):
+                    error = abs(((word >> shift) & 255) - c)
+                    color_error = max(color_error, error)
+                    total += error
+                worst = max(worst, color_error)
+                count += 1
+                if color_error > tolerance:
+                    off += 1
+    return worst, total / (4 * count), off / count
+
+
+def benchmark_rgbw_conversion(num_leds=151, frames=20):
+    """
+    Time converting a frame of Rainbow colors to packed RGBW: RGB2RGBW per pixel as the patterns did,
+    the cached conversion, and the whole-frame converter with the cache and with the lookup table.
+
+    :return: (exact_ms, cached_ms, frame_cached_ms, frame_lut_ms) per frame
+    """
+    import color_utils
+    lut = color_utils.build_RGB2RGBW_lut()
+    out = array.array("I", [0] * num_leds)
+    data = bytearray()
+    for i in range(num_leds):
+        data.extend(color_utils.wheel(i * 255 // num_leds))
+    results = []
+    for convert in (color_utils.RGB2RGBW, color_utils.RGB2RGBW_cached):
+        start = time.perf_counter()
+        for frame in range(frames):
+            for i in range(num_leds):
+                out[i] = color_utils.pack_rgbw(convert(data[3 * i], data[3 * i + 1], data[3 * i + 2]))
+        results.append((time.perf_counter() - start) * 1000 / frames)
+    for frame_lut in (None, lut):
+        start = time.perf_counter()
+        for frame in range(frames):
+            color_utils.RGB2RGBW_frame(out, data, frame_lut)
+        results.append((time.perf_counter() - start) * 1000 / frames)
+    return tuple(results)
+
+
+def check_waves():
+    """
+    Check that beats are exact over the whole range of ticks_ms, follow ticks_ms and the frame snapshot, and
+    that the waves on them span lowest..highest in phase with the beat.
+
+    :return: None, raises AssertionError on mismatch
+    """
+    import math
+    install()
+    import color_utils
+    for theta in range(0, 65536, 7):
+        exact = 32767.5 + 32767.5 * math.sin(2 * math.pi * theta / 65536)
+        assert abs(color_utils.sin16(theta) - exact) < 2, theta
+    for i in range(0, 65536, 251):
+        for scale in (0, 1, 255, 30000, 65535):
+            assert color_utils.scale16(i, scale) == (i * (scale + 1)) >> 16
+    for now in (0, 1, 999, 60000, 1234567, 15360001, (1 << 30) - 1):
+        color_utils.begin_frame(now)
+        for bpm88 in (1, 100, 256, 60 * 256, 120 * 256 + 128, 65535):
+            exact = (now * bpm88 * 65536 // (256 * 60000)) % 65536
+            assert color_utils.beat88(bpm88) == exact, (now, bpm88)
+            assert color_utils.beat88(bpm88, 1000) == ((now - 1000) * bpm88 * 65536 // (256 * 60000)) % 65536
+        value = color_utils.beatsin8(60, 10, 20, phase_offset=64)
+        assert 10 <= value <= 20
+    # One beat per second: top after a quarter of it, bottom after three quarters
+    for now, expected in ((0, 127), (250, 255), (500, 127), (750, 0)):
+        color_utils.begin_frame(now)
+        assert color_utils.beatsin16(60, 0, 255) == expected, now
+        assert color_utils.beatsin8(60, 0, 255, phase_offset=64) == color_utils.beatsin16(60, 0, 255, 0, 16384)
+    color_utils.end_frame()
+    # Without a snapshot the beats follow ticks_ms, here a clock stepped by hand so wall time doesn't matter
+    ticks_ms = time.ticks_ms
+    values = set()
+    try:
+        for now in range(0, 100, 5):
+            time.ticks_ms = lambda: now
+            color_utils.begin_frame(now)
+            expected = color_utils.beat16(120)
+            color_utils.end_frame()
+            assert color_utils.beat16(120) == expected, now
+            values.add(expected)
+    finally:
+        time.ticks_ms = ticks_ms
+    assert len(values) == 20
+
+
+def check_palettes():
+    """
+    Check that every shipped palette expands to 256 words that pass through its stops, and that the
+    palette patterns draw from it.
+
+    :return: None, raises AssertionError on mismatch
+    """
+    install()
+    import color_utils
+    import patterns
+    for name in color_utils.palette_names():
+        palette = color_utils.get_palette(name)
+        assert len(palette) == 256 and color_utils.get_palette(name) is palette
+        for stop in color_utils._palette_definitions[name]:
+            if len(stop) == 5:
+                assert palette[stop[0]] == color_utils.pack_rgbw(stop[1:]), (name, stop)
+    palette = color_utils.expand_palette([[0, 0, 0, 0, 0], [255, 255, 255, 255, 255]])
+    assert palette[0] == 0 and palette[255] == 0xFFFFFFFF and palette[128] == 0x80808080
+    assert color_utils.color_from_palette(palette, 255 + 256, 127) == 0x7F7F7F7F
+    rainbow = patterns.Rainbow(palette="lava")
+    rainbow.draw(10)
+    lava = color_utils.get_palette("lava")
+    assert list(rainbow.NP.frame) == [lava[(rainbow.hues[i] + 10) & 255] for i in range(rainbow.NUM_PIXELS)]
+    pulse = patterns.NeopixelGradientPulseConfiguration.from_json({"steps": 10, "wait_ms": 1, "palette": "ocean"})
+    pulse.fill(pulse.pulse_color(64))
+    assert pulse.NP.frame[0] == color_utils.get_palette("ocean")[64]
+
+
+def benchmark_palette(frames=50):
+    """
+    Time drawing a strip of colors computed per pixel (wheel and RGB2RGBW, as the patterns did) against
+    looking them up from an expanded palette.
+
+    :return: (computed_ms, palette_ms) per frame
+    """
+    install()
+    import color_utils
+    import patterns
+    board = patterns.NeopixelConfigurationInterface()
+    num_pixels = board.NUM_PIXELS
+    palette = color_utils.get_palette("rainbow")
+    start = time.perf_counter()
+    for j in range(frames):
+        for i in range(num_pixels):
+            board.set_pixel(i, color_utils.RGB2RGBW(*color_utils.wheel((i * 256 // num_pixels + j) & 255)))
+    computed = (time.perf_counter() - start) * 1000 / frames
+    start = time.perf_counter()
+    for j in range(frames):
+        board.fill_palette(palette, j)
+    return computed, (time.perf_counter() - start) * 1000 / frames
+
+
+def check_zones():
+    """
+    Check the zone map: wrapping zones are split into runs and index tables in board order, and the zone
+    drawing functions touch exactly the pixels of the zone.
+
+    :return: None, raises AssertionError on mismatch
+    """
+    install()
+    import color_utils
+    import patterns
+    import zones
+    zone_map = zones.ZoneMap(151, {"wrap": [135, 30], "two": [[0, 5], [10, 12]], "all": [0, 0]})
+    assert zone_map.spans["wrap"] == ((135, 151), (0, 30))
+    assert list(zone_map.indices["wrap"]) == list(range(135, 151)) + list(range(30))
+    assert zone_map.size("two") == 7 and zone_map.size("all") == 151
+    board = patterns.NeopixelConfigurationInterface()
+    num_pixels = board.NUM_PIXELS
+    for name in board.zones.names():
+        # Same pixels as the old per-pixel index math
+        start, end = board.zones.spans[name][0][0], board.zones.spans[name][-1][1]
+        expected = [board.get_board_pixel(i) for i in board.get_board_pixel_range(start, end % num_pixels)]
+        assert list(board.zones.indices[name]) == expected, name
+        board.fill((0, 0, 0, 0))
+        board.fill_zone(name, (1, 2, 3, 4))
+        inside = set(board.zones.indices[name])
+        for i in range(num_pixels):
+            assert board.NP.get_pixel(i) == ((1, 2, 3, 4) if i in inside else (0, 0, 0, 0)), (name, i)
+    board.fill((0, 0, 0, 0))
+    board.gradient_zone("mountain", (0, 0, 0, 0), (0, 0, 0, 200))
+    indices = board.zones.indices["mountain"]
+    assert board.NP.get_pixel(indices[0]) == (0, 0, 0, 0) and board.NP.get_pixel(indices[-1])[3] >= 199
+    levels = [board.NP.get_pixel(i)[3] for i in indices]
+    assert levels == sorted(levels) and board.NP.get_pixel(indices[-1] + 1) == (0, 0, 0, 0)
+    ocean = color_utils.get_palette("ocean")
+    board.palette_zone("sea", ocean, 10)
+    assert board.NP.frame[60] == ocean[10]
+    # The brightness mask of a zone that wraps past the end of the strip, and of no other pixel
+    wrap = board.zones.indices["mountain"]
+    board.set_zone_brightness("mountain", 40)
+    assert all(board.NP.mask[i] == (40 if i in wrap else 255) for i in range(num_pixels))
+    assert board.NP.masked == len(wrap)
+    board.set_zone_brightness("mountain", 255)
+    assert board.NP.masked == 0 and min(board.NP.mask) == 255
+    import scene
+    zone_scene = scene.ZoneScene.from_json({"mode": "scene", "zones": {
+        "sea": {"palette": "ocean", "bpm": 10}, "mountain": {"color": [0, 0, 0, 255], "glow_bpm": 20}}})
+    color_utils.begin_frame(1000)
+    assert zone_scene.render_frame(1000, zone_scene.NP)
+    color_utils.end_frame()
+    try:
+        scene.ZoneScene({"nowhere": {"color": [1, 2, 3]}})
+        assert False, "unknown zone accepted"
+    except ValueError:
+        pass
+
+
+def benchmark_zones(frames=50):
+    """
+    Time drawing a scene of three zones (a color, a gradient and a palette) through get_board_pixel and
+    get_board_pixel_range per pixel, as the patterns did, and through the zone drawing functions.
+
+    :return: (per_pixel_ms, zones_ms) per frame
+    """
+    install()
+    import color_utils
+    import patterns
+    board = patterns.NeopixelConfigurationInterface()
+    palette = color_utils.get_palette("ocean")
+    start = time.perf_counter()
+    for j in range(frames):
+        for i in board.get_board_pixel_range(patterns._MOUNTAIN_START, patterns._DESERT_START):
+            board.set_pixel(board.get_board_pixel(i), (0, 0, 0, 200))
+        pixels = board.get_board_pixel_range(patterns._DESERT_START, patterns._SEA_START)
+        for k, i in enumerate(pixels):
+            board.set_pixel(board.get_board_pixel(i), color_utils.lerp8((200, 80, 0, 0), (80, 20, 0, 0),
+                                                                        k * 255 // len(pixels)))
+        pixels = board.get_board_pixel_range(patterns._SEA_START, patterns._JUNGLE_START)
+        for k, i in enumerate(pixels):
+            board.set_pixel(board.get_board_pixel(i),
+                            color_utils.unpack_rgbw(palette[(j + k * 256 // len(pixels)) & 255]))
+    per_pixel = (time.perf_counter() - start) * 1000 / frames
+    start = time.perf_counter()
+    for j in range(frames):
+        board.fill_zone("mountain", (0, 0, 0, 200))
+        board.gradient_zone("desert", (200, 80, 0, 0), (80, 20, 0, 0))
+        board.palette_zone("sea", palette, j)
+    return per_pixel, (time.perf_counter() - start) * 1000 / frames
+
+
+def check_feather_line():
+    """
+    Check the antialiased line renderer: solid lines on whole pixels, coverage at sub-pixel ends, symmetric
+    feathered edges, and lines that wrap around the board seam.
+
+    :return: None, raises AssertionError on mismatch
+    """
+    install()
+    import patterns
+    board = patterns.NeopixelConfigurationInterface()
+
+    def line(position, length, feather, pixels):
+        board.fill((0, 0, 0, 0))
+        board.draw_line(position, length, (0, 0, 0, 255), feather)
+        return [board.NP.get_pixel(i)[3] for i in pixels]
+
+    assert line(3 << 8, 10 << 8, 0, range(16)) == [0] * 3 + [255] * 10 + [0] * 3
+    assert line((3 << 8) + 128, 10 << 8, 0, range(16)) == [0] * 3 + [127] + [255] * 9 + [127] + [0] * 2
+    assert line(3 << 8, 11 << 8, 4, range(16)) == [0] * 3 + [51, 102, 153, 204] + [255] * 3 + \
+        [204, 153, 102, 51] + [0] * 2
+    assert line(148 << 8, 10 << 8, 2, list(range(145, 151)) + list(range(10))) == \
+        [0] * 3 + [85, 170] + [255] * 6 + [170, 85] + [0] * 3
+    # A line moving by 1/16 of a pixel per step changes the frame every step, and keeps its total brightness
+    frames = set()
+    sums = set()
+    for step in range(32):
+        pixels = line((20 << 8) + step * 16, 5 << 8, 1, range(151))
+        frames.add(tuple(pixels))
+        sums.add(sum(pixels))
+    assert len(frames) == 32 and max(sums) - min(sums) <= 2, sums
+    # Blending keeps what is already in the frame under the edges
+    board.fill((0, 0, 0, 200))
+    board.draw_line(10 << 8, 6 << 8, (0, 0, 0, 0), 2)
+    assert [board.NP.get_pixel(i)[3] for i in range(9, 18)] == [200, 134, 66, 0, 0, 66, 134, 200, 200]
+
+
+def _readback_feather_line(board, start, end, color, feather):
+    # set_feather_pixel_line as it was: edge pixels read back from the frame and written one by one
+    solid_line_start = board.get_board_pixel(start + feather)
+    solid_line_end = board.get_board_pixel(end - feather)
+    board.set_pixel_line(solid_line_start, solid_line_end, color)
+    for i in range(feather):
+        left_edge_pixel_color = board.fb.get_pixel(board.get_board_pixel(start + i))
+        board.set_pixel(board.get_board_pixel(start + i), lerp8(color, left_edge_pixel_color, i * 255 // feather))
+        right_edge_pixel_color = board.fb.get_pixel(board.get_board_pixel(end - i))
+        board.set_pixel(board.get_board_pixel(end - i), lerp8(color, right_edge_pixel_color, i * 255 // feather))
+
+
+def benchmark_feather_line(lines=2000):
+    """
+    Time drawing the PowerOn sweep's line (11 pixels, 4 pixel feather) with the read-back implementation and
+    with the kernel renderer, at whole pixel and sub-pixel positions.
+
+    :return: (readback_us, kernel_us, kernel_subpixel_us) per line
+    """
+    install()
+    import patterns
+    global lerp8
+    from color_utils import lerp8
+    board = patterns.NeopixelConfigurationInterface()
+    color = (255, 255, 255, 255)
+    start = time.perf_counter()
+    for k in range(lines):
+        i = k % board.NUM_PIXELS
+        _readback_feather_line(board, i, i + 10, color, 4)
+    readback = (time.perf_counter() - start) * 1000000 / lines
+    start = time.perf_counter()
+    for k in range(lines):
+        i = k % board.NUM_PIXELS
+        board.set_feather_pixel_line(i, i + 10, color, 4)
+    kernel = (time.perf_counter() - start) * 1000000 / lines
+    start = time.perf_counter()
+    for k in range(lines):
+        board.draw_line(k * 37, 11 << 8, color, 4)
+    return readback, kernel, (time.perf_counter() - start) * 1000000 / lines
+
+
+def check_keyframes():
+    """
+    Check that periodic patterns replay exactly the frames they draw live from a KeyframeCache, within its
+    memory budget, and that frames over the budget are drawn live. The budget is capped, shrinks to what the
+    heap can spare and without memory at all every frame is drawn live.
+
+    :return: None, raises AssertionError on mismatch
+    """
+    install()
+    import patterns
+    context = patterns.RenderContext()
+    live = patterns.Rainbow(10, context=context)
+    cached = patterns.Rainbow.from_json({"wait_ms": 10, "cache_kb": 20}, context)
+    words = context.num_pixels
+    for pattern in (live, cached):
+        pattern.begin(0)
+    for now_ms in range(0, 2 * 2560, 10):
+        live.render_frame(now_ms, context.NP)
+        expected = list(context.NP.logical_frame())
+        cached.render_frame(now_ms, context.NP)
+        assert list(context.NP.logical_frame()) == expected, now_ms
+    stats = cached.keyframes.stats()
+    slots = 20 * 1024 // (4 * words)
+    assert stats["slots"] == slots and stats["frames"] == slots and stats["bytes"] == slots * words * 4, stats
+    assert stats["hits"] == slots and stats["misses"] == 512 - slots, stats
+    pulse = patterns.NeopixelGradientPulseConfiguration.from_json(
+        {"c1": [255, 0, 0], "c2": [0, 0, 255], "steps": 10, "wait_ms": 20, "cache_kb": 64}, context)
+    pulse.begin(0)
+    for now_ms in range(0, 3 * 400, 20):
+        pulse.render_frame(now_ms, context.NP)
+    assert pulse.keyframes.stats()["hits"] == 40
+    assert patterns.Rainbow.from_json({"wait_ms": 10}, context).keyframes is None
+
+    import gc
+    import keyframes
+
+    class NoMemory:
+        @staticmethod
+        def array(typecode, initializer=()):
+            if len(initializer):
+                raise MemoryError
+            return array.array(typecode)
+
+    assert keyframes.KeyframeCache(10000 * 1024).budget_bytes == keyframes.MAX_BUDGET_BYTES
+    # A heap of 40 KB: the buffer takes what is left above the reserve, built from a bytearray of its size
+    gc.mem_free = lambda: 40 * 1024
+    try:
+        for heap_slots, module_array in ((16 * 1024 // (8 * words), array), (0, NoMemory)):
+            keyframes.array = module_array
+            cached = patterns.Rainbow.from_json({"wait_ms": 10, "cache_kb": 64}, context)
+            for pattern in (live, cached):
+                pattern.begin(0)
+            for now_ms in range(0, 2 * 2560, 10):
+                live.render_frame(now_ms, context.NP)
+                expected = list(context.NP.logical_frame())
+                cached.render_frame(now_ms, context.NP)
+                assert list(context.NP.logical_frame()) == expected, now_ms
+            stats = cached.keyframes.stats()
+            assert stats["slots"] == heap_slots and stats["hits"] == heap_slots, stats
+            assert stats["bytes"] == 4 * words * heap_slots, stats
+    finally:
+        del gc.mem_free
+        keyframes.array = array
+
+
+def benchmark_keyframes(budget_kb=(0, 32, 96), cycles=3):
+    """
+    Time Rainbow frames drawn live and replayed from keyframe caches of different budgets, over several
+    cycles of its 256 frames.
+
+    :return: list of (budget_kb, ms per frame, hit rate, cache bytes)
+    """
+    install()
+    import patterns
+    context = patterns.RenderContext()
+    results = []
+    for kb in budget_kb:
+        pattern = patterns.Rainbow.from_json({"wait_ms": 10, "cache_kb": kb}, context)
+        pattern.begin(0)
+        start = time.perf_counter()
+        for now_ms in range(0, cycles * 2560, 10):
+            pattern.render_frame(now_ms, context.NP)
+        elapsed = (time.perf_counter() - start) * 1000 / (cycles * 256)
+        stats = pattern.keyframes.stats() if pattern.keyframes is not None else {"hit_rate": 0, "bytes": 0}
+        results.append((kb, elapsed, stats["hit_rate"], stats["bytes"]))
+    return results
+
+
+def check_registry():
+    """
+    Check the pattern registry: modes are imported on first use, unknown modes and invalid JSON are rejected,
+    and the same payload gives the same pattern until it drops out of the cache. Dropping it leaves its frame
+    cache alone, the scheduler frees that once the pattern is done.
+
+    :return: None, raises AssertionError on mismatch
+    """
+    install()
+    import pattern_base
+    import registry
+    context = pattern_base.RenderContext()
+    pattern_base.FrameScheduler(context)
+    patterns_registry = registry.PatternRegistry(context, cache_size=2)
+    # Nothing but the registry imports the patterns
+    assert "patterns" not in sys.modules
+    patterns_registry.get_class("solid")
+    assert "patterns" in sys.modules
+    import patterns
+    for payload in (b'{"mode": "strobe"}', b'{"mode": ', b'[1, 2]', b'{}'):
+        try:
+            patterns_registry.from_payload(payload)
+            assert False, payload
+        except ValueError:
+            pass
+    assert "scene" not in sys.modules
+    rainbow, transition = patterns_registry.from_payload(b'{"mode": "rainbow", "wait_ms": 20, "cache_kb": 16}')
+    assert isinstance(rainbow, patterns.Rainbow) and rainbow.wait_ms == 20 and transition is None
+    assert patterns_registry.from_payload(b'{"mode": "rainbow", "wait_ms": 20, "cache_kb": 16}')[0] is rainbow
+    rainbow.begin(0)
+    rainbow.render_frame(0, context.NP)
+    assert rainbow.keyframes.buffer is not None
+    scene, _ = patterns_registry.from_payload(b'{"mode": "scene", "zones": {"sea": {"color": [0, 0, 255]}}}')
+    assert "scene" in sys.modules and type(scene).__name__ == "ZoneScene"
+    patterns_registry.from_payload(b'{"mode": "solid", "color": [1, 2, 3]}')
+    # The rainbow was the oldest of three with room for two. It may still be on the strip, so the cache only
+    # forgets it, it is the scheduler that releases it.
+    assert rainbow.keyframes.buffer is not None
+    assert patterns_registry.from_payload(b'{"mode": "rainbow", "wait_ms": 20, "cache_kb": 16}')[0] is not rainbow
+    # Released patterns draw again from scratch
+    rainbow.release()
+    assert rainbow.keyframes.buffer is None
+    rainbow.begin(0)
+    rainbow.render_frame(0, context.NP)
+    assert rainbow.keyframes.buffer is not None
+
+    # The scheduler frees a pattern when it is done and the outgoing pattern when its transition is over
+    scheduler = pattern_base.FrameScheduler(context)
+    stream = patterns.LiveStream(context=context)
+
+    async def drive():
+        scheduler.set_pattern(rainbow)
+        await asyncio.sleep(0.1)
+        scheduler.set_pattern(stream)
+        # After the crossfade
+        await asyncio.sleep(0.6)
+        assert scheduler.previous is None and rainbow.keyframes.buffer is None and stream.slots is not None
+        stream.finish(time.ticks_ms())
+        await asyncio.sleep(0.1)
+        assert scheduler.pattern is None and stream.slots is None
+        scheduler.stop()
+
+    async def run():
+        await asyncio.gather(scheduler.run(), drive())
+
+    asyncio.run(run())
+    # Misses: the four rejected payloads and four patterns built
+    assert patterns_registry.hits == 1 and patterns_registry.misses == 8
+
+
+def benchmark_registry(switches=300):
+    """
+    Time switching between two JSON payloads as main.py does: parsing and building the pattern every time,
+    as the if/elif dispatcher did, and through the registry's payload cache.
+
+    :return: (rebuild_us, cached_us) per switch
+    """
+    install()
+    import json
+    import patterns
+    import registry
+    context = patterns.RenderContext()
+    patterns_registry = registry.PatternRegistry(context)
+    payloads = (b'{"mode": "rainbow", "wait_ms": 20, "palette": "lava"}',
+                b'{"mode": "pulse", "c1": [255, 0, 0], "c2": [0, 0, 255], "steps": 50, "wait_ms": 20}')
+    start = time.perf_counter()
+    for k in range(switches):
+        patterns_registry.create(json.loads(payloads[k & 1]))
+    rebuild = (time.perf_counter() - start) * 1000000 / switches
+    start = time.perf_counter()
+    for k in range(switches):
+        patterns_registry.from_payload(payloads[k & 1])
+    return rebuild, (time.perf_counter() - start) * 1000000 / switches
+
+
+def _palette_stops(name):
+    # Stops of a shipped palette, as written in palettes.json
+    import color_utils
+    color_utils.get_palette(name)
+    return color_utils._palette_definitions[name]
+
+
+def check_binary_protocol():
+    """
+    Check that binary configs build the same patterns as their JSON equivalents, and that broken ones are
+    rejected.
+
+    :return: None, raises AssertionError on mismatch
+    """
+    install()
+    import patterns
+    import protocol
+    import registry
+    patterns_registry = registry.PatternRegistry(patterns.RenderContext())
+    pairs = (
+        (b'{"mode": "solid", "color": [255, 100, 0]}', protocol.encode("solid", [[0, 255, 100, 0]])),
+        (b'{"mode": "pulse", "c1": [255, 0, 0], "c2": [0, 0, 255], "steps": 40, "wait_ms": 30}',
+         protocol.encode("pulse", [[0, 255, 0, 0], [255, 0, 0, 255]], wait_ms=30, steps=40)),
+        (b'{"mode": "rainbow", "wait_ms": 15, "palette": "lava", "cache_kb": 8, '
+         b'"transition": {"type": "wipe", "ms": 800, "reverse": true}}',
+         protocol.encode("rainbow", _palette_stops("lava"), wait_ms=15, cache_kb=8, transition="wipe",
+                         transition_ms=800, reverse=True)),
+    )
+    for json_payload, binary_payload in pairs:
+        assert protocol.is_binary(binary_payload) and not protocol.is_binary(json_payload)
+        from_json, json_transition = patterns_registry.parse(json_payload)
+        from_binary, binary_transition = patterns_registry.parse(binary_payload)
+        assert type(from_json) is type(from_binary)
+        for name in ("color", "color1", "color2", "steps", "wait_ms"):
+            assert getattr(from_json, name, None) == getattr(from_binary, name, None), (name, binary_payload)
+        if isinstance(from_json, patterns.Rainbow):
+            assert list(from_json.wheel_table) == list(from_binary.wheel_table)
+            assert from_binary.keyframes.budget_bytes == 8 * 1024
+        assert type(json_transition) is type(binary_transition)
+        if binary_transition is not None:
+            assert binary_transition.duration_ms == 800 and binary_transition.reverse
+    bad = (protocol.encode("pulse", [[0, 1, 2, 3]]), protocol.encode("solid", [[0, 1, 2, 3]])[:-1],
+           bytes([protocol.MAGIC, 2]) + bytes(20), bytes([protocol.MAGIC, 1, 99]) + bytes(20))
+    for payload in bad:
+        try:
+            patterns_registry.parse(payload)
+            assert False, payload
+        except ValueError:
+            pass
+    # More stops than a palette takes are refused with the header, before any pattern is built
+    stops = [[k * 15, k, k, k] for k in range(protocol.MAX_STOPS + 1)]
+    try:
+        protocol.decode_header(protocol.encode("rainbow", stops, wait_ms=20))
+        assert False
+    except ValueError as e:
+        assert "stops" in str(e)
+    patterns_registry.parse(protocol.encode("rainbow", stops[:protocol.MAX_STOPS], wait_ms=20))
+
+
+def benchmark_protocol(parses=500):
+    """
+    Time parsing a pattern config and building the pattern, from JSON and from the binary encoding.
+
+    :return: list of (name, json_bytes, binary_bytes, json_us, binary_us) per parse
+    """
+    install()
+    import patterns
+    import protocol
+    import registry
+    patterns_registry = registry.PatternRegistry(patterns.RenderContext())
+    cases = (
+        ("solid", b'{"mode": "solid", "color": [255, 100, 0, 20]}',
+         protocol.encode("solid", [[0, 255, 100, 0, 20]])),
+        ("pulse", b'{"mode": "pulse", "c1": [255, 0, 0], "c2": [0, 0, 255], "steps": 50, "wait_ms": 20, '
+                  b'"transition": {"type": "crossfade", "ms": 500}}',
+         protocol.encode("pulse", [[0, 255, 0, 0], [255, 0, 0, 255]], wait_ms=20, steps=50, transition="crossfade")),
+        ("rainbow", b'{"mode": "rainbow", "wait_ms": 20}', protocol.encode("rainbow", wait_ms=20)),
+    )
+    results = []
+    for name, json_payload, binary_payload in cases:
+        timings = []
+        for payload in (json_payload, binary_payload):
+            start = time.perf_counter()
+            for _ in range(parses):
+                patterns_registry.parse(payload)
+            timings.append((time.perf_counter() - start) * 1000000 / parses)
+        results.append((name, len(json_payload), len(binary_payload), timings[0], timings[1]))
+    return results
+
+
+def palette_sizes(stop_count=16):
+    """
+    Bytes taken by the stops of a palette written as JSON and in the binary encoding.
+
+    :return: (json_bytes, binary_bytes)
+    """
+    import json
+    import protocol
+    stops = [[k * 255 // (stop_count - 1), (k * 97) & 255, (k * 53) & 255, (k * 31) & 255, k] for k in range(stop_count)]
+    return len(json.dumps(stops)), len(protocol.encode("rainbow", stops)) - protocol.HEADER_SIZE
+
+
+def check_write_dispatcher():
+    """
+    Check that the write dispatcher calls the handler of a characteristic with the value written, for plain
+    and async handlers, and keeps serving after a handler fails.
+
+    :return: None, raises AssertionError on mismatch
+    """
+    install()
+    import ble_dispatch
+    received = []
+
+    def plain(value):
+        received.append(("plain", value))
+        if value == b"fail":
+            raise ValueError(value)
+
+    async def later(value):
+        await asyncio.sleep(0)
+        received.append(("async", value))
+
+    async def run():
+        first = FakeCharacteristic()
+        second = FakeCharacteristic()
+        dispatcher = ble_dispatch.WriteDispatcher()
+        dispatcher.route(first, plain)
+        dispatcher.route(second, later)
+        dispatcher.start()
+        await asyncio.sleep(0)
+        for value in (b"fail", b"a"):
+            first.client_write(value)
+            await asyncio.sleep(0.001)
+        second.client_write(b"b")
+        await asyncio.sleep(0.001)
+        # Captured writes are all handled, in order, even when they come in at once
+        captured = FakeCharacteristic(capture=True)
+        dispatcher.route(captured, plain, capture=True)
+        dispatcher.stop()
+        dispatcher.start()
+        for value in (b"c", b"d", b"e"):
+            captured.client_write(value)
+        await asyncio.sleep(0.001)
+        dispatcher.stop()
+        assert dispatcher.writes == 6
+
+    asyncio.run(run())
+    assert received == [("plain", b"fail"), ("plain", b"a"), ("async", b"b"),
+                        ("plain", b"c"), ("plain", b"d"), ("plain", b"e")], received
+
+
+def _stream_frames(num_pixels, count, kind):
+    # Packed frames of a test animation: "rainbow" changes every pixel, "comet" a few moving pixels on black,
+    # "flash" fills the strip with one color
+    frames = []
+    for k in range(count):
+        if kind == "rainbow":
+            frames.append(array.array("I", [((i * 7 + k * 5) & 255) << 24 | ((i * 3 + k) & 255) << 16 | (k & 255)
+                                            for i in range(num_pixels)]))
+        elif kind == "comet":
+            frame = array.array("I", [0] * num_pixels)
+            for t in range(6):
+                frame[(k * 2 - t) % num_pixels] = (255 - t * 40) << 24 | (200 - t * 30) << 8
+            frames.append(frame)
+        else:
+            frames.append(array.array("I", [(k * 37 & 255) * 0x01010101] * num_pixels))
+    return frames
+
+
+def check_live_stream(payload_size=253):
+    """
+    Stream frames to a LiveStream pattern as keyframes and deltas, and check that it shows them unchanged and in
+    order, skips deltas after a lost packet until the next keyframe, and buffers against late frames.
+
+    :return: None, raises AssertionError on mismatch
+    """
+    install()
+    import patterns
+    import protocol
+    context = patterns.RenderContext()
+    num_pixels = context.num_pixels
+    for kind in ("rainbow", "comet", "flash"):
+        stream = patterns.LiveStream(40, 2, context)
+        stream.begin(0)
+        frames = _stream_frames(num_pixels, 30, kind)
+        previous = None
+        shown = []
+        now_ms = 0
+        for seq, frame in enumerate(frames):
+            for packet in protocol.encode_stream_frame(frame, previous, seq, payload_size):
+                assert len(packet) <= payload_size
+                assert stream.feed(packet)
+            previous = frame
+            # Frames arrive 40 ms apart, give or take 30 ms
+            for _ in range(2):
+                now_ms += 20 + ((seq * 7919) % 31) - 15
+                stream.render_frame(now_ms, context.NP)
+                if stream.frames_shown > len(shown):
+                    shown.append(list(context.NP.logical_frame()))
+        stats = stream.stats()
+        assert stats["received"] == 30 and stats["lost"] == 0 and stats["dropped"] == 0, (kind, stats)
+        assert len(shown) >= 27 and stats["underruns"] == 0, (kind, len(shown), stats)
+        assert shown == [list(frame) for frame in frames[:len(shown)]], kind
+    # A lost packet: the deltas after it are dropped, the next keyframe picks the stream up again
+    stream = patterns.LiveStream(40, 1, context)
+    stream.begin(0)
+    # Every other pixel changes, so the deltas are smaller than keyframes but take more than one packet
+    frames = []
+    for k in range(4):
+        frame = array.array("I", _stream_frames(num_pixels, 1, "rainbow")[0])
+        for i in range(0, num_pixels, 2):
+            frame[i] = k * 0x01010101 + i
+        frames.append(frame)
+    packets = [protocol.encode_stream_frame(frames[0], None, 0, payload_size),
+               protocol.encode_stream_frame(frames[1], frames[0], 1, payload_size),
+               protocol.encode_stream_frame(frames[2], frames[1], 2, payload_size),
+               protocol.encode_stream_frame(frames[3], None, 3, payload_size)]
+    assert len(packets[1]) > 1 and packets[1][0][0] == protocol.STREAM_DELTA
+    for k, frame_packets in enumerate(packets):
+        for n, packet in enumerate(frame_packets):
+            if k == 1 and n == 1:
+                continue
+            stream.feed(packet)
+    stats = stream.stats()
+    assert stats["received"] == 2 and stats["lost"] >= 2, stats
+    stream.render_frame(0, context.NP)
+    stream.render_frame(40, context.NP)
+    assert list(context.NP.logical_frame()) == list(frames[3])
+    for packet in (b"\x00", b"\x01\x01\x05\x00\x00\x00\xff", b"\x00\x01\x00\x00\x96\x00" + bytes(12)):
+        assert not stream.feed(packet)
+    # A packet of an unknown kind is lost before it takes a slot
+    lost = stream.lost
+    free = stream._free_slot()
+    assert not stream.feed(b"\x07\x01\x04\x00\x00\x00" + bytes(8))
+    assert stream.lost == lost + 1 and stream._free_slot() == free and stream.decoding == -1
+
+    # The strip is only written when another frame is shown, or when drawing into another framebuffer
+    writes = []
+    stream.write_frame = lambda frame, *args: writes.append(frame)
+    for packet in packets[0]:
+        stream.feed(packet)
+    for now_ms in (80, 90, 100, 110):
+        stream.render_frame(now_ms, context.NP)
+    assert len(writes) == 1, len(writes)
+    stream.render_frame(120, context.incoming)
+    assert len(writes) == 2, len(writes)
+    del stream.write_frame
+
+    # Shown again, the stream starts empty: a delta on the frame of the last run is refused
+    stream.begin(200)
+    assert stream.ready_count == 0 and stream.shown == -1 and stream.last_slot == -1 and stream.play_ms is None
+    assert not stream.feed(packets[1][0])
+
+
+def benchmark_live_stream(mtu=256, interval_ms=15, packets_per_interval=4, frames=60):
+    """
+    Sustained frame rate of the live frame characteristic. Writes without response carry mtu - 3 bytes, and a
+    connection interval of interval_ms carries up to packets_per_interval of them (phones manage 4 to 6).
+
+    :return: list of (animation, bytes per frame, packets per frame, link limited fps, decode_us per frame)
+    """
+    install()
+    import patterns
+    import protocol
+    context = patterns.RenderContext()
+    payload_size = mtu - 3
+    link_packets_per_s = packets_per_interval * 1000 / interval_ms
+    results = []
+    for kind in ("rainbow", "comet", "flash"):
+        encoded = []
+        previous = None
+        for seq, frame in enumerate(_stream_frames(context.num_pixels, frames, kind)):
+            # A keyframe every 30 frames, so a lost packet costs at most a little over a second
+            encoded.append(protocol.encode_stream_frame(frame, None if seq % 30 == 0 else previous, seq, payload_size))
+            previous = frame
+        stream = patterns.LiveStream(40, 2, context)
+        start = time.perf_counter()
+        for frame_packets in encoded:
+            for packet in frame_packets:
+                stream.feed(packet)
+        decode_us = (time.perf_counter() - start) * 1000000 / frames
+        assert stream.stats()["received"] == frames
+        packets = sum(len(frame_packets) for frame_packets in encoded) / frames
+        size = sum(len(packet) for frame_packets in encoded for packet in frame_packets) / frames
+        results.append((kind, size, packets, link_packets_per_s / packets, decode_us))
+    return results
+
+
+def _records(notifications):
+    # (kind, source, seq, ticks_ms, value) of every record in the notifications
+    import notify_queue
+    import struct
+    records = []
+    for data in notifications:
+        for offset in range(0, len(data), notify_queue.RECORD_SIZE):
+            records.append(struct.unpack_from(notify_queue.RECORD, data, offset))
+    return records
+
+
+def check_notification_queue():
+    """
+    Check the notification queue: events are batched into as few notifications as the MTU allows, the oldest
+    are dropped when full (leaving a gap in the sequence numbers), put_async waits for room, and a stalled
+    central keeps the events queued.
+
+    :return: None, raises AssertionError on mismatch
+    """
+    install()
+    import notify_queue
+    connection = types.SimpleNamespace(mtu=256)
+    characteristic = FakeCharacteristic()
+    queue = notify_queue.NotificationQueue(characteristic, depth=8)
+    for index in range(5):
+        queue.put(notify_queue.KIND_BUTTON, index, 1)
+    assert queue.send(connection) == 5 and len(characteristic.notified) == 1
+    assert [(kind, source, seq) for kind, source, seq, _, _ in _records(characteristic.notified)] == \
+        [(notify_queue.KIND_BUTTON, index, index) for index in range(5)]
+    # Default MTU: two records per notification
+    queue.put(notify_queue.KIND_TEMPERATURE, 0, 2345)
+    queue.put(notify_queue.KIND_TEMPERATURE, 1, -500)
+    queue.put(notify_queue.KIND_TEMPERATURE, 2, 100000)
+    assert queue.send(types.SimpleNamespace(mtu=None)) == 2
+    assert [record[4] for record in _records(characteristic.notified[1:])] == [2345, -500]
+    assert queue.send(connection) == 1 and _records(characteristic.notified[2:])[0][4] == 32767
+    # Full: the oldest go, the sequence numbers show the gap
+    characteristic.notified = []
+    for index in range(11):
+        assert queue.put(notify_queue.KIND_BUTTON, index, 1) == (index < 8)
+    queue.send(connection)
+    assert [record[2] for record in _records(characteristic.notified)] == list(range(11, 19))
+    assert queue.stats()["dropped"] == 3 and queue.stats()["max_depth"] == 8
+    # A stalled central: nothing is lost
+    characteristic.notify_limit = 0
+    queue.put(notify_queue.KIND_BUTTON, 0, 1)
+    assert queue.send(connection) == 0 and queue.count == 1 and queue.stats()["stalls"] == 1
+
+    async def back_pressure():
+        characteristic = FakeCharacteristic()
+        queue = notify_queue.NotificationQueue(characteristic, depth=2, interval_ms=5,
+                                               policy=notify_queue.BACK_PRESSURE)
+        pump = asyncio.create_task(queue.run(connection))
+        for index in range(6):
+            await queue.put_async(notify_queue.KIND_TEMPERATURE, index, index * 100)
+        await asyncio.sleep(0.05)
+        pump.cancel()
+        assert [record[1] for record in _records(characteristic.notified)] == list(range(6))
+        assert queue.stats()["dropped"] == 0 and queue.stats()["max_depth"] == 2
+
+    asyncio.run(back_pressure())
+
+
+def benchmark_notifications(presses=40, burst_ms=40, notify_limit=4, interval_ms=15):
+    """
+    A burst of button presses sent to a central that takes at most notify_limit notifications per connection
+    interval: one notification per press, as button_clicked did, and through a NotificationQueue.
+
+    :return: dict per case ("direct", "queued") of (presses delivered, notifications, ms until the last one)
+    """
+    install()
+    import notify_queue
+    connection = types.SimpleNamespace(mtu=256)
+    results = {}
+    for case in ("direct", "queued"):
+        characteristic = FakeCharacteristic(notify_limit=notify_limit, interval_ms=interval_ms)
+        queue = notify_queue.NotificationQueue(characteristic, interval_ms=interval_ms)
+
+        async def run():
+            pump = asyncio.create_task(queue.run(connection))
+            start = time.perf_counter()
+            for index in range(presses):
+                if case == "direct":
+                    try:
+                        characteristic.notify(connection, str(index % 7).encode())
+                    except OSError:
+                        pass
+                else:
+                    queue.put(notify_queue.KIND_BUTTON, index % 7, 1)
+                await asyncio.sleep(burst_ms / presses / 1000)
+            while queue.count:
+                await asyncio.sleep(0.001)
+            elapsed = (time.perf_counter() - start) * 1000
+            pump.cancel()
+            delivered = len(characteristic.notified) if case == "direct" else len(_records(characteristic.notified))
+            results[case] = (delivered, len(characteristic.notified), elapsed)
+
+        asyncio.run(run())
+    return results
+
+
+def check_temperature_sampler():
+    """
+    Check the DS18X20 sampler on a fake one-wire bus: one conversion per round for all sensors, no reading before
+    the conversion is done, reports only past the deadband, the sampling rate slowing while nothing changes, the
+    history ring and CRC errors.
+
+    :return: None, raises AssertionError on mismatch
+    """
+    install()
+    import thermometer
+    sensor = FakeDS18X20([21.3, 22.0, 19.87])
+    sampler = thermometer.TemperatureSampler(sensor, sensor.scan(), resolution=9, interval_ms=100,
+                                             max_interval_ms=400, deadband=1.0, history=5)
+    sampler.configure()
+    assert sensor.configs == [0x1F] * 3
+
+    async def rounds(count):
+        return [await sampler.sample() for _ in range(count)]
+
+    assert asyncio.run(rounds(1)) == [[0, 1, 2]]
+    assert sensor.conversions == 1 and sensor.stale == 0
+    assert [sampler.latest(index) for index in range(3)] == [2150, 2200, 2000]
+    # 21.5 -> 22.5 is within the deadband, 23.0 is past it
+    sensor.temperatures[0] = 22.6
+    assert asyncio.run(rounds(1)) == [[]] and sampler.period_ms == 200
+    sensor.temperatures[0] = 23.0
+    assert asyncio.run(rounds(1)) == [[0]] and sampler.period_ms == 100
+    assert asyncio.run(rounds(3)) == [[], [], []] and sampler.period_ms == 400
+    assert sampler.history(0) == [2250, 2300, 2300, 2300, 2300] and sampler.history(1) == [2200] * 5
+    # A CRC error keeps the last reading
+    sensor.failing.add(2)
+    sensor.temperatures[2] = 30.0
+    assert asyncio.run(rounds(1)) == [[]] and sampler.latest(2) == 2000 and sampler.errors == 1
+    assert sensor.conversions == 7 and sensor.stale == 0
+
+    async def run():
+        reports = []
+        sensor.failing.clear()
+        task = asyncio.create_task(sampler.run(lambda index, value: reports.append((index, value))))
+        await asyncio.sleep(0.15)
+        task.cancel()
+        return reports
+
+    # A new run reports every sensor again
+    assert asyncio.run(run()) == [(0, 2300), (1, 2200), (2, 3000)]
+
+
+def benchmark_thermometer(sensors=3, rounds=20):
+    """
+    Sampling 12 bit DS18X20 sensors one by one with 100 ms waits, as thermometer_task did, against the sampler's
+    single conversion, and the notifications each sends while the temperatures barely change.
+
+    :return: dict per case ("per sensor", "sampler") of (conversions per round, stale readings per round, ms per
+        round, notifications per round)
+    """
+    install()
+    import thermometer
+    results = {}
+    # Conversions and stale readings, the temperatures rising 0.3 C per round
+    sensor = FakeDS18X20([20.0] * sensors)
+
+    async def per_sensor():
+        start = time.perf_counter()
+        for _ in range(2):
+            sensor.temperatures = [value + 0.3 for value in sensor.temperatures]
+            for rom in sensor.roms:
+                sensor.convert_temp()
+                await asyncio.sleep(0.1)
+                sensor.read_temp(rom)
+        return (time.perf_counter() - start) * 1000 / 2
+
+    elapsed = asyncio.run(per_sensor())
+    results["per sensor"] = [sensor.conversions / 2, sensor.stale / 2, elapsed]
+    sensor = FakeDS18X20([20.0] * sensors)
+    sampler = thermometer.TemperatureSampler(sensor, sensor.roms)
+    sampler.configure()
+
+    async def sampled():
+        start = time.perf_counter()
+        for _ in range(2):
+            sensor.temperatures = [value + 0.3 for value in sensor.temperatures]
+            await sampler.sample()
+        return (time.perf_counter() - start) * 1000 / 2
+
+    elapsed = asyncio.run(sampled())
+    results["sampler"] = [sensor.conversions / 2, sensor.stale / 2, elapsed]
+    # Notifications: the first sensor creeping up 0.05 C per round, the others steady. 9 bit to keep this short,
+    # the deadband of 0.25 C is below its 0.5 C step.
+    results["per sensor"].append(sensors)
+    sensor = FakeDS18X20([20.6] + [21.0] * (sensors - 1))
+    sampler = thermometer.TemperatureSampler(sensor, sensor.roms, resolution=9)
+    sampler.configure()
+
+    async def drift():
+        notifications = 0
+        for _ in range(rounds):
+            sensor.temperatures[0] += 0.05
+            notifications += len(await sampler.sample())
+        return notifications
+
+    results["sampler"].append(asyncio.run(drift()) / rounds)
+    return results
+
+
+def benchmark_command_latency(commands=20, idle_s=1.0):
+    """
+    Time from a write to the neopixel characteristic until the pattern is switched: with main.py's old
+    polling (characteristics read every 20 ms, the new identifier picked up every 200 ms) and with the write
+    dispatcher signalling an asyncio Event. Also counts how often the tasks wake up while nothing is written.
+
+    :return: dict per case ("polling", "events") of (avg_ms, max_ms, idle wakeups per second)
+    """
+    install()
+    import random
+    import ble_dispatch
+    results = {}
+    for case in ("polling", "events"):
+        characteristic = FakeCharacteristic()
+        state = {"identifier": None, "wakeups": 0}
+        switched = []
+        changed = asyncio.Event()
+
+        async def poll_characteristic():
+            latest = None
+            while True:
+                state["wakeups"] += 1
+                value = characteristic.read()
+                if value and value != latest:
+                    latest = value
+                    state["identifier"] = value
+                await asyncio.sleep(0.02)
+
+        async def poll_identifier():
+            previous = None
+            while True:
+                state["wakeups"] += 1
+                if state["identifier"] != previous:
+                    previous = state["identifier"]
+                    switched.append(time.perf_counter())
+                await asyncio.sleep(0.2)
+
+        def handle_write(value):
+            state["identifier"] = value
+            changed.set()
+
+        async def wait_identifier():
+            while True:
+                await changed.wait()
+                changed.clear()
+                state["wakeups"] += 1
+                switched.append(time.perf_counter())
+
+        async def run():
+            if case == "polling":
+                tasks = [asyncio.create_task(poll_characteristic()), asyncio.create_task(poll_identifier())]
+            else:
+                dispatcher = ble_dispatch.WriteDispatcher()
+                dispatcher.route(characteristic, handle_write)
+                dispatcher.start()
+                tasks = [asyncio.create_task(wait_identifier())] + dispatcher.tasks
+            await asyncio.sleep(0.05)
+            state["wakeups"] = 0
+            await asyncio.sleep(idle_s)
+            idle_wakeups = state["wakeups"] / idle_s
+            latencies = []
+            for k in range(commands):
+                await asyncio.sleep(random.uniform(0.05, 0.3))
+                count = len(switched)
+                start = time.perf_counter()
+                characteristic.client_write(b'{"mode": "rainbow", "wait_ms": %d}' % k)
+                while len(switched) == count:
+                    await asyncio.sleep(0.0005)
+                latencies.append((switched[-1] - start) * 1000)
+            for task in tasks:
+                task.cancel()
+            results[case] = (sum(latencies) / len(latencies), max(latencies), idle_wakeups)
+
+        asyncio.run(run())
+    return results
+
+
+def benchmark_pattern_switch(switches=30):
+    """
+    Build patterns from JSON the way main.py does on every mode change, once giving every pattern its own
+    RenderContext (a new strip per pattern, as before) and once sharing one context.
+
+    :return: dict per case ("own", "shared") of (ms per switch, peak heap bytes per switch, state machines created)
+    """
+    import tracemalloc
+    install()
+    import patterns
+    configs = (
+        (patterns.NeopixelSingleColorConfiguration, {"mode": "solid", "color": [255, 100, 0]}),
+        (patterns.Rainbow, {"mode": "rainbow", "wait_ms": 50}),
+        (patterns.NeopixelGradientPulseConfiguration, {"mode": "pulse", "c1": [255, 0, 0], "c2": [0, 0, 255],
+                                                       "steps": 50, "wait_ms": 50}),
+    )
+    shared = patterns.RenderContext()
+    results = {}
+    for case in ("own", "shared"):
+        created = len(state_machines)
+        elapsed = 0.0
+        peak = 0
+        pattern = None
+        for k in range(switches):
+            cls, config = configs[k % len(configs)]
+            tracemalloc.start()
+            start = time.perf_counter()
+            pattern = cls.from_json(config, patterns.RenderContext() if case == "own" else shared)
+            elapsed += time.perf_counter() - start
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        results[case] = (elapsed * 1000 / switches, peak, len(state_machines) - created)
+    return results
+
+
+def check_frame_scheduler(frame_ms=20):
+    """
+    Run patterns on a FrameScheduler: a switch lets the old pattern fade out before the new one begins,
+    a stalled frame is counted as dropped frames, and the frame rate doesn't drift with render time.
+
+    :return: dict of the scheduler stats
+    """
+    install()
+    import patterns
+    clock = FakeClock()
+
+    class Stall(patterns.NeopixelConfigurationInterface):
+        # Draws like Rainbow, but one frame takes three frame periods
+        def render(self, now_ms, fb):
+            clock.busy(3 * frame_ms if self.elapsed(now_ms) // frame_ms == 5 else 5)
+            self.fill((self.elapsed(now_ms) & 255, 0, 0, 0))
+            return self.end_ms is None
+
+    context = patterns.RenderContext()
+    scheduler = patterns.FrameScheduler(context, frame_ms)
+    # Without a transition, a switch waits for the old pattern to finish
+    scheduler.transition = None
+    solid = patterns.NeopixelSingleColorConfiguration((0, 0, 0, 255), context)
+    stall = Stall(context)
+    events = []
+
+    async def drive():
+        scheduler.set_pattern(solid)
+        await clock.sleep_ms(300)
+        scheduler.set_pattern(stall)
+        # Solid fades out over a second before Stall begins
+        while scheduler.pattern is solid:
+            await clock.sleep_ms(10)
+        events.append(time.ticks_ms())
+        scheduler.reset_stats()
+        await clock.sleep_ms(500)
+        scheduler.stop()
+
+    async def run():
+        events.append(time.ticks_ms())
+        await asyncio.gather(scheduler.run(), drive())
+
+    # The stats count frames against the clock: on the virtual clock they don't depend on how busy the host is
+    clock.install()
+    try:
+        asyncio.run(run())
+    finally:
+        clock.restore()
+    assert events[1] - events[0] >= 1300, "switch didn't wait for the fade out"
+    stats = scheduler.stats()
+    # 0.5 s at 20 ms per frame is 25 frames: two of them dropped by the stall
+    assert stats["dropped"] == 2 and stats["frames"] + stats["dropped"] == 25, stats
+    return stats
+
+
+def check_scheduler_errors(frame_ms=20):
+    """
+    Check that configs that would divide by zero are refused, and that a pattern raising while it draws is
+    dropped while the scheduler keeps running the next pattern.
+
+    :return: None, raises AssertionError on mismatch
+    """
+    install()
+    import micropython
+    import patterns
+    import protocol
+    from registry import PatternRegistry
+    context = patterns.RenderContext()
+    assert not isinstance(context.redraw, asyncio.Event)
+    registry = PatternRegistry(context)
+    for payload in (b'{"mode": "rainbow", "wait_ms": 0}',
+                    b'{"mode": "pulse", "c1": [1, 2, 3], "c2": [4, 5, 6], "steps": 0, "wait_ms": 20}',
+                    b'{"mode": "pulse", "c1": [1, 2, 3], "c2": [4, 5, 6], "steps": 10, "wait_ms": 0}',
+                    protocol.encode("rainbow", wait_ms=0),
+                    protocol.encode("pulse", [[0, 1, 2, 3], [255, 4, 5, 6]], wait_ms=20, steps=0)):
+        try:
+            registry.from_payload(payload)
+        except ValueError:
+            continue
+        raise AssertionError(payload)
+
+    class Broken(patterns.NeopixelConfigurationInterface):
+        def render(self, now_ms, fb):
+            return 1 // 0
+
+    scheduler = patterns.FrameScheduler(context, frame_ms)
+    solid = patterns.NeopixelSingleColorConfiguration((1, 2, 3, 4), context)
+
+    async def drive():
+        scheduler.set_pattern(Broken(context))
+        await asyncio.sleep(0.1)
+        assert scheduler.pattern is None and scheduler.running
+        scheduler.set_pattern(solid)
+        # After the crossfade in
+        await asyncio.sleep(0.6)
+        assert scheduler.pattern is solid and context.NP.get_pixel(0) == (1, 2, 3, 4)
+        # A button callback run by micropython.schedule wakes the idle scheduler through the redraw flag
+        frames = scheduler.frames
+        micropython.schedule(lambda _: solid.increase_color_for_channel(0, 10), None)
+        await asyncio.sleep(0.1)
+        assert context.NP.get_pixel(0) == (11, 2, 3, 4) and scheduler.frames > frames
+        scheduler.stop()
+
+    async def run():
+        await asyncio.gather(scheduler.run(), drive())
+
+    asyncio.run(run())
+
+
+def benchmark_idle_frames(seconds=0.5, frame_ms=20):
+    """
+    Frames the scheduler draws per second without a pattern, with a static color and with a rainbow. A static
+    color is drawn again only when it changes.
+
+    :return: (no pattern fps, static color fps, rainbow fps)
+    """
+    install()
+    import patterns
+    context = patterns.RenderContext()
+    scheduler = patterns.FrameScheduler(context, frame_ms)
+    solid = patterns.NeopixelSingleColorConfiguration((10, 20, 30, 40), context)
+    results = []
+
+    async def measure():
+        scheduler.reset_stats()
+        await asyncio.sleep(seconds)
+        results.append(scheduler.frames / seconds)
+
+    async def drive():
+        await measure()
+        scheduler.set_pattern(solid)
+        # After the crossfade in
+        await asyncio.sleep(0.6)
+        await measure()
+        solid.increase_color_for_channel(0, 25)
+        await asyncio.sleep(0.05)
+        assert context.NP.get_pixel(0) == (35, 20, 30, 40)
+        scheduler.set_pattern(patterns.Rainbow(10, context=context))
+        await asyncio.sleep(0.6)
+        await measure()
+        scheduler.stop()
+
+    async def run():
+        await asyncio.gather(scheduler.run(), drive())
+
+    asyncio.run(run())
+    return tuple(results)
+
+
+def check_transitions(frame_ms=20):
+    """
+    Check the transition blends: crossfade halfway, wipe and dissolve at both ends, and that a switch through
+    the scheduler ends on the incoming pattern's frame.
+
+    :return: None, raises AssertionError on mismatch
+    """
+    install()
+    import patterns
+    import transitions
+    count = 151
+    outgoing = array.array("I", [0x10203040] * count)
+    incoming = array.array("I", [0xF0E0D0C0] * count)
+    out = array.array("I", [0] * count)
+    for transition in (transitions.Crossfade(), transitions.Wipe(), transitions.Wipe(reverse=True),
+                       transitions.Dissolve()):
+        transition.blend(out, outgoing, incoming, 0)
+        assert out == outgoing, transition
+        transition.blend(out, outgoing, incoming, 256)
+        assert out == incoming, transition
+    transitions.Crossfade().blend(out, outgoing, incoming, 128)
+    assert out[0] == 0x80808080
+    transitions.Dissolve().blend(out, outgoing, incoming, 128)
+    assert 60 < sum(1 for word in out if word == 0xF0E0D0C0) < 90
+    assert transitions.transition_from_json({"type": "wipe", "ms": 800}).duration_ms == 800
+
+    context = patterns.RenderContext()
+    scheduler = patterns.FrameScheduler(context, frame_ms)
+    first = patterns.NeopixelSingleColorConfiguration((10, 20, 30, 40), context)
+    second = patterns.Rainbow(10, context=context)
+
+    async def drive():
+        scheduler.set_pattern(first)
+        await asyncio.sleep(0.7)
+        assert context.NP.get_pixel(0) == (10, 20, 30, 40)
+        scheduler.set_pattern(second, transitions.Wipe(300))
+        await asyncio.sleep(0.5)
+        assert scheduler.active_transition is None and scheduler.previous is None
+        scheduler.stop()
+
+    async def run():
+        await asyncio.gather(scheduler.run(), drive())
+
+    asyncio.run(run())
+    second.draw((second.elapsed(time.ticks_ms()) // 10) & 255)
+    assert list(context.NP.logical_frame()) == list(context.frame)
+
+
+def benchmark_switch_time(frame_ms=20):
+    """
+    Time from a pattern switch until the strip shows the new pattern, switching between two solid colors:
+    finishing the old pattern first (its 1 s fade out), and crossfading.
+
+    :return: (sequential_ms, crossfade_ms)
+    """
+    install()
+    import patterns
+    from transitions import Crossfade
+    results = []
+    for transition in (None, Crossfade()):
+        context = patterns.RenderContext()
+        scheduler = patterns.FrameScheduler(context, frame_ms)
+        scheduler.transition = transition
+        old = patterns.NeopixelSingleColorConfiguration((255, 0, 0, 0), context)
+        new = patterns.NeopixelSingleColorConfiguration((0, 0, 255, 0), context)
+        switched = []
+
+        async def drive():
+            scheduler.set_pattern(old)
+            await asyncio.sleep(0.6)
+            start = time.perf_counter()
+            scheduler.set_pattern(new)
+            while context.NP.get_pixel(0) != (0, 0, 255, 0):
+                await asyncio.sleep(0.001)
+            switched.append(time.perf_counter() - start)
+            scheduler.stop()
+
+        async def run():
+            await asyncio.gather(scheduler.run(), drive())
+
+        asyncio.run(run())
+        results.append(switched[0] * 1000)
+    return tuple(results)
+
+
+def benchmark_frame_rate(seconds=1.0, frame_ms=20, render_ms=8):
+    """
+    Frames drawn in <seconds> with <render_ms> of drawing per frame: by a loop sleeping frame_ms after every
+    frame, as the patterns did, and by the FrameScheduler.
+
+    :return: (loop_fps, scheduler_fps, scheduler stats)
+    """
+    install()
+    import patterns
+
+    class Busy(patterns.NeopixelConfigurationInterface):
+        def render(self, now_ms, fb):
+            _busy(render_ms)
+            self.fill((now_ms & 255, 0, 0, 0))
+            return True
+
+    context = patterns.RenderContext()
+    pattern = Busy(context)
+    frames = []
+
+    async def sleeping_loop():
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            pattern.render_frame(time.ticks_ms(), context.NP)
+            await context.NP.show_async()
+            frames.append(1)
+            await asyncio.sleep(frame_ms / 1000)
+
+    asyncio.run(sleeping_loop())
+    scheduler = patterns.FrameScheduler(context, frame_ms)
+    scheduler.set_pattern(pattern)
+
+    async def stop_later():
+        await asyncio.sleep(seconds)
+        scheduler.stop()
+
+    async def run():
+        await asyncio.gather(scheduler.run(), stop_later())
+
+    asyncio.run(run())
+    return len(frames) / seconds, scheduler.frames / seconds, scheduler.stats()
+
+
+def _busy(ms):
+    end = time.perf_counter() + ms / 1000
+    while time.perf_counter() < end:
+        pass
+
+
+def benchmark_show(num_leds=151, frames=200, mode="RGBW", bulk=True, dma=True, render_ms=5):
+    """
+    Render <frames> frames and report how long show() keeps the CPU busy per frame, and the
+    resulting wire throughput. <render_ms> of busy work between frames stands in for a pattern
+    drawing the next frame.
+
+    :return: dict with cpu_ms_per_frame, wire_ms_per_frame, words_per_s and the state machine
+    """
+    install(dma)
+    from neopixel import Neopixel
+    np = Neopixel(num_leds, 0, 22, mode, bulk=bulk)
+    sm = np.sm
+    cpu = 0.0
+    start = time.perf_counter()
+    for frame in range(frames):
+        np.fill((frame & 255, 0, 255 - (frame & 255), 0))
+        _busy(render_ms)
+        t = time.perf_counter()
+        np.show()
+        cpu += time.perf_counter() - t
+    elapsed = time.perf_counter() - start
+    return {
+        "cpu_ms_per_frame": cpu * 1000 / frames,
+        "wire_ms_per_frame": sm.wire_time * 1000 / frames,
+        "words_per_s": len(sm.words) / elapsed,
+        "sm": sm,
+    }
+
+
+def check_show_output(num_leds=151, mode="RGBW"):
+    """
+    Check that every output path puts exactly the packed pixels, in order, for every frame.
+
+    :return: None, raises AssertionError on mismatch
+    """
+    for bulk, dma in ((False, False), (True, False), (True, True)):
+        install(dma)
+        from neopixel import Neopixel
+        np = Neopixel(num_leds, 0, 22, mode, bulk=bulk)
+        expected = []
+        for frame in range(3):
+            for i in range(num_leds):
+                np.set_pixel(i, ((i + frame) & 255, i & 255, frame, 255 - (i & 255)))
+            np.show()
+            cut = 0 if np.W_in_mode else 8
+            expected.extend((p << cut) & 0xFFFFFFFF for p in np.pixels)
+        assert np.sm.words == expected, (bulk, dma)
+
+
+def check_segmented_output(segment_leds=(60, 51, 40), mode="RGBW"):
+    """
+    Check that every segment of a SegmentedNeopixel gets exactly its own slice of the logical strip,
+    for full frames and for frames where only a prefix changed.
+
+    :return: None, raises AssertionError on mismatch
+    """
+    for bulk, dma in ((False, False), (True, False), (True, True)):
+        install(dma)
+        from neopixel import SegmentedNeopixel
+        np = SegmentedNeopixel([(sm, 22 + sm, n) for sm, n in enumerate(segment_leds)], mode, bulk=bulk)
+        num_leds = np.num_leds
+        assert num_leds == sum(segment_leds)
+        expected = [[] for _ in segment_leds]
+        cut = 0 if np.W_in_mode else 8
+        # Three full frames, then one that only changes a pixel in the second segment: the third isn't sent
+        for frame in range(4):
+            if frame < 3:
+                for i in range(num_leds):
+                    np.set_pixel(i, ((i + frame) & 255, i & 255, frame, 255 - (i & 255)))
+                changed = num_leds
+            else:
+                np.set_pixel(segment_leds[0] + 5, (1, 2, 3, 4))
+                changed = segment_leds[0] + 6
+            np.show()
+            first = 0
+            for k, n in enumerate(segment_leds):
+                sent = max(0, min(n, changed - first))
+                expected[k].extend((p << cut) & 0xFFFFFFFF for p in np.pixels[first:first + sent])
+                first += n
+        for k, segment in enumerate(np.segments):
+            assert segment.sm.words == expected[k], (bulk, dma, k)
+
+
+def benchmark_segments(num_leds=450, segment_count=3, frames=20, dma=True):
+    """
+    Send <frames> frames of <num_leds> pixels through one strip and through <segment_count> segments of the
+    same total length, and measure the wall time from the start of show() until the last segment has
+    clocked out its data.
+
+    :return: (single_ms, segmented_ms) per frame
+    """
+    install(dma)
+    from neopixel import Neopixel, SegmentedNeopixel
+    per_segment = num_leds // segment_count
+    strips = (Neopixel(num_leds, 0, 22, "RGBW"),
+              SegmentedNeopixel([(sm, 22 + sm, per_segment) for sm in range(segment_count)], "RGBW"))
+    results = []
+    for np in strips:
+        total = 0.0
+        for frame in range(frames):
+            np.fill((frame & 255, 0, 255 - (frame & 255), 0))
+            np.wait_ready()
+            start = time.perf_counter()
+            np.show()
+            total += max(segment.sm.busy_until for segment in np.segments) - start
+        results.append(total * 1000 / frames)
+    return tuple(results)
+
+
+def measure_loop_lag(use_async=True, bulk=True, dma=True, num_leds=151, frames=100, wait_ms=5):
+    """
+    Drive a strip from one task while another task asks to be woken every millisecond, and measure
+    how late it is woken: the event loop lag caused by show().
+
+    :return: dict with max_lag_ms and avg_lag_ms
+    """
+    install(dma)
+    from neopixel import Neopixel
+    np = Neopixel(num_leds, 0, 22, "RGBW", bulk=bulk)
+    lags = []
+    done = []
+
+    async def ticker():
+        while not done:
+            t = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lags.append(time.perf_counter() - t - 0.001)
+
+    async def pattern():
+        for frame in range(frames):
+            np.fill((frame & 255, 0, 0, 0))
+            if use_async:
+                await np.show_async()
+            else:
+                np.show()
+            await asyncio.sleep(wait_ms / 1000)
+        done.append(True)
+
+    async def run():
+        await asyncio.gather(ticker(), pattern())
+
+    asyncio.run(run())
+    return {"max_lag_ms": max(lags) * 1000, "avg_lag_ms": sum(lags) * 1000 / len(lags)}
+
+
+def _report(name, result):
+    print(name, "cpu %.3f ms/frame, wire %.3f ms/frame, %d words/s" % (
+        result["cpu_ms_per_frame"], result["wire_ms_per_frame"], result["words_per_s"]))
+
+
+if __name__ == "__main__":
+    check_show_output()
+    check_show_output(mode="GRB")
+    check_segmented_output()
+    check_segmented_output(mode="GRB")
+    check_dirty_tracking()
+    check_lut_packing()
+    check_brightness_mask()
+    check_framebuffer()
+    check_rotate_no_alloc()
+    check_bulk_writers()
+    check_gradient_engine()
+    check_rgbw_conversion()
+    check_waves()
+    check_palettes()
+    check_zones()
+    check_feather_line()
+    check_keyframes()
+    check_registry()
+    check_binary_protocol()
+    check_write_dispatcher()
+    check_live_stream()
+    check_notification_queue()
+    check_temperature_sampler()
+    check_frame_scheduler()
+    check_scheduler_errors()
+    check_transitions()
+    print("set_pixel: %.2f us/pixel" % benchmark_set_pixel())
+    print("frame render: no mask %.3f ms, mask of 8 levels %.3f ms, mask ramp %.3f ms" % benchmark_brightness_mask())
+    print("rainbow frame: per-pixel %.3f ms, bulk %.3f ms" % benchmark_rainbow())
+    worst, mean, off = rgbw_lut_accuracy()
+    print("RGB2RGBW lookup table: max error %d, mean error %.2f, %.1f%% of colors off by more than 16" % (
+        worst, mean, off * 100))
+    print("RGB2RGBW frame: exact %.3f ms, cached %.3f ms, frame cached %.3f ms, frame lut %.3f ms" %
+          benchmark_rgbw_conversion())
+    print("palette frame: computed per pixel %.3f ms, palette %.3f ms" % benchmark_palette())
+    print("feathered line: read back %.1f us, kernels %.1f us, kernels at sub-pixel positions %.1f us" %
+          benchmark_feather_line())
+    for kb, frame_ms, hit_rate, size in benchmark_keyframes():
+        print("rainbow, %d KB keyframe cache: %.3f ms/frame, hit rate %.0f%%, %d bytes" % (
+            kb, frame_ms, hit_rate * 100, size))
+    print("same JSON sent again: rebuilt %.1f us, from the registry's cache %.1f us" % benchmark_registry())
+    for name, json_bytes, binary_bytes, json_us, binary_us in benchmark_protocol():
+        print("%s config: JSON %d bytes, parsed in %.1f us; binary %d bytes, parsed in %.1f us" % (
+            name, json_bytes, json_us, binary_bytes, binary_us))
+    print("16 stop RGBW palette: JSON %d bytes, binary %d bytes" % palette_sizes())
+    for kind, size, packets, fps, decode_us in benchmark_live_stream():
+        print("live %s frames at MTU 256: %.0f bytes, %.1f packets per frame, %.0f fps sustained, decoded in %.0f us"
+              % (kind, size, packets, fps, decode_us))
+    for case, (delivered, notifications, elapsed_ms) in benchmark_notifications().items():
+        print("40 button presses in 40 ms, %s: %d delivered in %d notifications, done after %.0f ms" % (
+            case, delivered, notifications, elapsed_ms))
+    for case, (conversions, stale, round_ms, notifications) in benchmark_thermometer().items():
+        print("3 thermometers, %s: %.0f conversions, %.0f stale readings, %.0f ms and %.2f notifications per round"
+              % (case, conversions, stale, round_ms, notifications))
+    for case, (avg_ms, max_ms, wakeups) in benchmark_command_latency().items():
+        print("command to pattern switch, %s: avg %.1f ms, max %.1f ms, %.0f wakeups/s when idle" % (
+            case, avg_ms, max_ms, wakeups))
+    print("three zone scene: per-pixel index math %.3f ms, zone map %.3f ms" % benchmark_zones())
+    for case, (switch_ms, peak, created) in benchmark_pattern_switch().items():
+        print("pattern switch, %s context: %.3f ms, peak heap %d bytes, %d state machines created" % (
+            case, switch_ms, peak, created))
+    loop_fps, scheduler_fps, stats = benchmark_frame_rate()
+    print("50 fps target with 8 ms of drawing: sleeping loop %.1f fps, scheduler %.1f fps, "
+          "frame %.2f ms avg, jitter %.2f ms avg / %d ms max, %d dropped" % (
+              loop_fps, scheduler_fps, stats["frame_ms_avg"], stats["jitter_ms_avg"], stats["jitter_ms_max"],
+              stats["dropped"]))
+    print("scheduler frames per second: no pattern %.0f, static color %.0f, rainbow %.0f" % benchmark_idle_frames())
+    print("solid to solid switch: finish first %.0f ms, crossfade %.0f ms" % benchmark_switch_time())
+    print("strip gradient: float %.3f ms, fixed point %.3f ms" % benchmark_gradient())
+    print("450 leds per frame, DMA: one strip %.3f ms, 3 segments %.3f ms" % benchmark_segments())
+    print("450 leds per frame, bulk put: one strip %.3f ms, 3 segments %.3f ms" % benchmark_segments(dma=False))
+    _report("per-pixel put + sleep:", benchmark_show(bulk=False, dma=False))
+    _report("bulk put:", benchmark_show(bulk=True, dma=False))
+    _report("bulk DMA:", benchmark_show(bulk=True, dma=True))
+    for name, use_async, bulk, dma in (("sync show, per-pixel:", False, False, False),
+                                       ("async show, bulk put:", True, True, False),
+                                       ("async show, DMA:", True, True, True)):
+        lag = measure_loop_lag(use_async, bulk, dma)
+        print(name, "event loop lag max %.3f ms, avg %.3f ms" % (lag["max_lag_ms"], lag["avg_lag_ms"]))
@@ -0,0 +1,170 @@
+# Equivalence checks and micro benchmarks for kernels.py.
+# Run it on the Pico (from Thonny) to check that the viper kernels give exactly the same results as the
+# pure Python ones and to see the speedup of each. On a PC only the Python versions exist, so the checks are
+# skipped and only their timings are printed.
+import array
+import random
+import time
+import kernels
+
+try:
+    _ticks_us = time.ticks_us
+    _ticks_diff = time.ticks_diff
+except AttributeError:
+    def _ticks_us():
+        return int(time.perf_counter() * 1000000)
+
+    def _ticks_diff(a, b):
+        return a - b
+
+
+def _random_words(count):
+    return array.array("I", [random.getrandbits(32) for _ in range(count)])
+
+
+def _random_runs(count):
+    # Encoded runs for rle_decode, see protocol.py
+    src = bytearray()
+    for _ in range(count):
+        op = random.getrandbits(8)
+        src.append(op)
+        if op >> 6 == 1:
+            src.extend(bytes(random.getrandbits(8) for _ in range(4)))
+        elif op >> 6 == 2:
+            src.extend(bytes(random.getrandbits(8) for _ in range(4 * ((op & 63) + 1))))
+    return bytes(src)
+
+
+def check_equivalence(samples=50, num_leds=151):
+    """
+    Run the Python and native version of every kernel over the same random inputs and compare the results.
+
+    :param samples: Number of random cases per kernel
+    :param num_leds: Size of the buffers
+    :return: Number of cases checked, 0 if there are no native kernels
+    """
+    if not kernels.NATIVE:
+        print("No native emitter, nothing to compare")
+        return 0
+    checked = 0
+    for _ in range(samples):
+        # fill_words: some words already have the value, so change tracking is tested too
+        value = random.getrandbits(32)
+        buf_py = _random_words(num_leds)
+        for i in range(0, num_leds, 3):
+            buf_py[i] = value
+        buf_native = array.array("I", buf_py)
+        start = random.randint(0, num_leds - 1)
+        end = random.randint(start, num_leds)
+        changed_py = kernels.fill_words_py(memoryview(buf_py)[start:end], value)
+        changed_native = kernels.fill_words_native(memoryview(buf_native)[start:end], value)
+        assert changed_py == changed_native and buf_py == buf_native, "fill_words"
+
+        # render_words
+        frame = _random_words(num_leds)
+        lut = _random_words(1024)
+        out_py = array.array("I", [0] * num_leds)
+        out_native = array.array("I", [0] * num_leds)
+        count = random.randint(0, num_leds)
+        params = array.array("i", [random.randint(0, num_leds - count), random.randint(0, num_leds - count), count])
+        kernels.render_words_py(out_py, frame, lut, params)
+        kernels.render_words_native(out_native, frame, lut, params)
+        assert out_py == out_native, "render_words"
+
+        # gradient_words
+        count = random.randint(1, num_leds)
+        params = kernels.gradient_params(array.array("i", [0] * 8), random.getrandbits(32), random.getrandbits(32), count)
+        out_py = array.array("I", [0] * count)
+        out_native = array.array("I", [0] * count)
+        kernels.gradient_words_py(out_py, params)
+        kernels.gradient_words_native(out_native, params)
+        assert out_py == out_native, "gradient_words"
+
+        # blend_words
+        a = _random_words(num_leds)
+        b = _random_words(num_leds)
+        amount = random.randint(0, 256)
+        out_py = array.array("I", [0] * num_leds)
+        out_native = array.array("I", [0] * num_leds)
+        kernels.blend_words_py(out_py, a, b, amount)
+        kernels.blend_words_native(out_native, a, b, amount)
+        assert out_py == out_native, "blend_words"
+
+        # mask_words: a mask of random levels, many of them 0 or 255
+        mask = bytearray(random.choice((0, 255, random.randint(0, 255))) for _ in range(num_leds))
+        out_py = _random_words(num_leds)
+        out_native = array.array("I", out_py)
+        count = random.randint(0, num_leds)
+        kernels.mask_words_py(out_py, mask, count)
+        kernels.mask_words_native(out_native, mask, count)
+        assert out_py == out_native, "mask_words"
+
+        # rle_decode: random runs, some of them malformed or overrunning the frame
+        src = _random_runs(random.randint(1, 40))
+        params = array.array("i", [random.randint(0, num_leds - 1), 0, num_leds])
+        frame = _random_words(num_leds)
+        dst_py = array.array("I", frame)
+        dst_native = array.array("I", frame)
+        end_py = kernels.rle_decode_py(kernels.byte_view(dst_py), src, params)
+        end_native = kernels.rle_decode_native(kernels.byte_view(dst_native), src, params)
+        assert end_py == end_native and (end_py < 0 or dst_py == dst_native), "rle_decode"
+        checked += 6
+    return checked
+
+
+def _literal_runs(num_leds):
+    # Every pixel sent as a literal, the worst case of a delta frame
+    src = bytearray()
+    for start in range(0, num_leds, 64):
+        n = min(64, num_leds - start)
+        src.append(0x80 | (n - 1))
+        src.extend(bytes(4 * n))
+    return bytes(src)
+
+
+def _time_us(func, args, rounds):
+    start = _ticks_us()
+    for _ in range(rounds):
+        func(*args)
+    return _ticks_diff(_ticks_us(), start) / rounds
+
+
+def benchmark(num_leds=151, rounds=50):
+    """
+    Time every kernel over a strip sized buffer.
+
+    :return: dict of kernel name -> (python_us, native_us or None) per call
+    """
+    frame = _random_words(num_leds)
+    out = array.array("I", [0] * num_leds)
+    lut = _random_words(1024)
+    render_params = array.array("i", [0, 0, num_leds])
+    gradient_params = kernels.gradient_params(array.array("i", [0] * 8), 0xFF102030, 0x1020FF40, num_leds)
+    cases = (
+        ("fill_words", (memoryview(out), 0x12345678)),
+        ("render_words", (out, frame, lut, render_params)),
+        ("gradient_words", (memoryview(out), gradient_params)),
+        ("blend_words", (out, frame, lut[:num_leds], 100)),
+        ("mask_words", (out, bytearray(i & 255 for i in range(num_leds)), num_leds)),
+        ("rle_decode", (kernels.byte_view(out), _literal_runs(num_leds), array.array("i", [0, 0, num_leds]))),
+    )
+    results = {}
+    for name, args in cases:
+        python_us = _time_us(getattr(kernels, name + "_py"), args, rounds)
+        native = getattr(kernels, name + "_native")
+        native_us = _time_us(native, args, rounds) if native is not None else None
+        results[name] = (python_us, native_us)
+    return results
+
+
+def report(num_leds=151, rounds=50):
+    for name, (python_us, native_us) in benchmark(num_leds, rounds).items():
+        if native_us is None:
+            print("%s: python %.1f us" % (name, python_us))
+        else:
+            print("%s: python %.1f us, native %.1f us, %.1fx" % (name, python_us, native_us, python_us / native_us))
+
+
+if __name__ == "__main__":
+    print("Checked", check_equivalence(), "cases")
+    report()
@@ -0,0 +1,198 @@
+# Inner loops of the pixel code. Every kernel has a pure Python version (<name>_py) and, when the firmware
+# has the native emitter, a viper version (<name>_native, in kernels_native.py). The plain name is the fastest
+# one available, so the same code runs on the Pico and in CPython on a PC.
+#
+# Kernels work on contiguous ranges without any ring offset or wrap: callers pass memoryview slices, or for
+# the render kernel that runs on every frame, start indices (so showing a frame doesn't allocate).
+# Viper functions take at most 4 arguments, so more parameters are passed in an array.
+
+
+def fill_words_py(buf, value):
+    """
+    Set every word of <buf> to <value>.
+
+    :param buf: array.array('I') or memoryview slice of one
+    :param value: Word to write
+    :return: Index + 1 of the last word that changed, 0 if nothing changed
+    """
+    changed = 0
+    for i in range(len(buf)):
+        if buf[i] != value:
+            buf[i] = value
+            changed = i + 1
+    return changed
+
+
+def render_words_py(out, frame, lut, params):
+    """
+    Convert logical 0xRRGGBBWW words of <frame> into strip words in <out> through <lut>.
+
+    :param out: array.array('I') output buffer
+    :param frame: array.array('I') framebuffer
+    :param lut: array.array('I') of 1024 words: R, G, B and W tables of 256 words each, one after another
+    :param params: array.array('i') of (out_start, frame_start, count)
+    :return: None
+    """
+    o, f, count = params
+    for i in range(count):
+        c = frame[f + i]
+        out[o + i] = lut[c >> 24] | lut[256 + ((c >> 16) & 255)] | lut[512 + ((c >> 8) & 255)] | lut[768 + (c & 255)]
+
+
+def gradient_words_py(out, params):
+    """
+    Fill <out> with a gradient, stepping 16.16 fixed point channel accumulators.
+
+    :param out: memoryview slice to fill
+    :param params: array.array('i') of (r, g, b, w, dr, dg, db, dw): start accumulators and steps per pixel
+    :return: None
+    """
+    r, g, b, w, dr, dg, db, dw = params
+    for i in range(len(out)):
+        out[i] = (r >> 16) << 24 | (g >> 16) << 16 | (b >> 16) << 8 | (w >> 16)
+        r += dr
+        g += dg
+        b += db
+        w += dw
+
+
+def blend_words_py(out, a, b, amount):
+    """
+    Blend packed 0xRRGGBBWW words: out = a * (1 - amount) + b * amount, per channel and rounded.
+
+    :param out: array.array('I') to write, may be the same as a or b
+    :param a: array.array('I') of the words to blend from
+    :param b: array.array('I') of the words to blend to
+    :param amount: 0..256, where 256 gives exactly b
+    :return: None
+    """
+    inv = 256 - amount
+    for i in range(len(out)):
+        c1 = a[i]
+        c2 = b[i]
+        out[i] = (((c1 >> 24) * inv + (c2 >> 24) * amount + 128) >> 8) << 24 | \
+            ((((c1 >> 16) & 255) * inv + ((c2 >> 16) & 255) * amount + 128) >> 8) << 16 | \
+            ((((c1 >> 8) & 255) * inv + ((c2 >> 8) & 255) * amount + 128) >> 8) << 8 | \
+            (((c1 & 255) * inv + (c2 & 255) * amount + 128) >> 8)
+
+
+def mask_words_py(out, mask, count):
+    """
+    Scale the channels of the first <count> strip words of <out> by a brightness mask: channel * m / 255 for mask
+    value m, rounded exactly, without a division: t = channel * m + 128, then (t + (t >> 8)) >> 8. Channels are
+    the four bytes of the word, in any order; two of them are scaled per multiply.
+
+    :param out: array.array('I') of strip words
+    :param mask: bytearray of per-pixel brightness 0..255
+    :param count: Number of words to scale
+    :return: None
+    """
+    for i in range(count):
+        m = mask[i]
+        if m != 255:
+            c = out[i]
+            t = (c & 0xFF00FF) * m + 0x800080
+            u = ((c >> 8) & 0xFF00FF) * m + 0x800080
+            out[i] = ((t + ((t >> 8) & 0xFF00FF)) >> 8) & 0xFF00FF | (((u + ((u >> 8) & 0xFF00FF)) >> 8) & 0xFF00FF) << 8
+
+
+def rle_decode_py(dst, src, params):
+    """
+    Decode run-length encoded pixels (see protocol.py) from <src> into the bytes of a frame. Runs either keep
+    pixels, fill them with one color or copy literal pixels, 1 to 64 pixels each.
+
+    :param dst: Bytes of the frame, see byte_view
+    :param src: Encoded bytes
+    :param params: array.array('i') of (first pixel, offset of the runs in src, number of pixels in the frame)
+    :return: Index of the pixel after the last one decoded, -1 if the runs are malformed or overrun the frame
+    """
+    pos = params[0] * 4
+    i = params[1]
+    end = params[2] * 4
+    n_src = len(src)
+    while i < n_src:
+        op = src[i]
+        i += 1
+        n = ((op & 63) + 1) * 4
+        kind = op >> 6
+        if pos + n > end:
+            return -1
+        if kind == 0:
+            pos += n
+        elif kind == 1:
+            if i + 4 > n_src:
+                return -1
+            for k in range(pos, pos + n, 4):
+                dst[k] = src[i]
+                dst[k + 1] = src[i + 1]
+                dst[k + 2] = src[i + 2]
+                dst[k + 3] = src[i + 3]
+            pos += n
+            i += 4
+        elif kind == 2:
+            if i + n > n_src:
+                return -1
+            dst[pos:pos + n] = src[i:i + n]
+            pos += n
+            i += n
+        else:
+            return -1
+    return pos >> 2
+
+
+def byte_view(words):
+    """
+    The bytes of an array.array('I') as a writable buffer, to copy raw pixel data into it without a loop per pixel.
+    Words are little endian, so a packed 0xRRGGBBWW pixel is the bytes w, b, g, r.
+
+    :param words: array.array('I')
+    :return: memoryview or bytearray sharing the memory of <words>
+    """
+    try:
+        return memoryview(words).cast("B")
+    except AttributeError:
+        # MicroPython has no memoryview.cast
+        import uctypes
+        return uctypes.bytearray_at(uctypes.addressof(words), 4 * len(words))
+
+
+try:
+    from kernels_native import (fill_words_native, render_words_native, gradient_words_native, blend_words_native,
+                                mask_words_native, rle_decode_native)
+except (ImportError, SyntaxError, AttributeError):
+    # Not MicroPython (ImportError, or AttributeError with host_sim's stand-in module), or firmware without the
+    # native emitter, which fails to compile kernels_native.py (SyntaxError)
+    fill_words_native = None
+    render_words_native = None
+    gradient_words_native = None
+    blend_words_native = None
+    mask_words_native = None
+    rle_decode_native = None
+
+NATIVE = fill_words_native is not None
+
+fill_words = fill_words_native or fill_words_py
+render_words = render_words_native or render_words_py
+gradient_words = gradient_words_native or gradient_words_py
+blend_words = blend_words_native or blend_words_py
+mask_words = mask_words_native or mask_words_py
+rle_decode = rle_decode_native or rle_decode_py
+
+
+def gradient_params(params, c1, c2, count):
+    """
+    Fill <params> for gradient_words: a gradient from packed color c1 towards c2 over <count> pixels.
+    Accumulators start half a step up, so that taking the integer part rounds.
+
+    :param params: array.array('i') of 8 entries to fill
+    :return: params
+    """
+    params[0] = (c1 >> 24) << 16 | 0x8000
+    params[1] = ((c1 >> 16) & 255) << 16 | 0x8000
+    params[2] = ((c1 >> 8) & 255) << 16 | 0x8000
+    params[3] = (c1 & 255) << 16 | 0x8000
+    params[4] = (((c2 >> 24) - (c1 >> 24)) << 16) // count
+    params[5] = ((((c2 >> 16) & 255) - ((c1 >> 16) & 255)) << 16) // count
+    params[6] = ((((c2 >> 8) & 255) - ((c1 >> 8) & 255)) << 16) // count
+    params[7] = (((c2 & 255) - (c1 & 255)) << 16) // count
+    return params
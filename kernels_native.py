@@ -0,0 +1,130 @@
+# Viper versions of the kernels in kernels.py, with the same arguments and results as their <name>_py
+# counterparts. On firmware without the native emitter the viper decorator is a compile error for the whole
+# module, so kernels.py imports this module inside a try and falls back to the Python versions.
+import micropython
+
+
+@micropython.viper
+def fill_words_native(buf, value: int) -> int:
+    p = ptr32(buf)
+    n = int(len(buf))
+    changed = 0
+    i = 0
+    while i < n:
+        if p[i] != value:
+            p[i] = value
+            changed = i + 1
+        i += 1
+    return changed
+
+
+@micropython.viper
+def render_words_native(out, frame, lut, params):
+    o = ptr32(out)
+    f = ptr32(frame)
+    t = ptr32(lut)
+    p = ptr32(params)
+    o_start = p[0]
+    f_start = p[1]
+    n = p[2]
+    i = 0
+    while i < n:
+        c = f[f_start + i]
+        o[o_start + i] = t[(c >> 24) & 255] | t[256 + ((c >> 16) & 255)] | t[512 + ((c >> 8) & 255)] | t[768 + (c & 255)]
+        i += 1
+
+
+@micropython.viper
+def gradient_words_native(out, params):
+    o = ptr32(out)
+    p = ptr32(params)
+    r = p[0]
+    g = p[1]
+    b = p[2]
+    w = p[3]
+    n = int(len(out))
+    i = 0
+    while i < n:
+        o[i] = (r >> 16) << 24 | (g >> 16) << 16 | (b >> 16) << 8 | (w >> 16)
+        r += p[4]
+        g += p[5]
+        b += p[6]
+        w += p[7]
+        i += 1
+
+
+@micropython.viper
+def blend_words_native(out, a, b, amount: int):
+    o = ptr32(out)
+    p = ptr32(a)
+    q = ptr32(b)
+    inv = 256 - amount
+    n = int(len(out))
+    i = 0
+    while i < n:
+        c1 = p[i]
+        c2 = q[i]
+        o[i] = ((((c1 >> 24) & 255) * inv + ((c2 >> 24) & 255) * amount + 128) >> 8) << 24 | \
+            ((((c1 >> 16) & 255) * inv + ((c2 >> 16) & 255) * amount + 128) >> 8) << 16 | \
+            ((((c1 >> 8) & 255) * inv + ((c2 >> 8) & 255) * amount + 128) >> 8) << 8 | \
+            (((c1 & 255) * inv + (c2 & 255) * amount + 128) >> 8)
+        i += 1
+
+
+@micropython.viper
+def mask_words_native(out, mask, count: int):
+    o = ptr32(out)
+    k = ptr8(mask)
+    i = 0
+    while i < count:
+        m = k[i]
+        if m != 255:
+            c = o[i]
+            t = (c & 0xFF00FF) * m + 0x800080
+            u = ((c >> 8) & 0xFF00FF) * m + 0x800080
+            o[i] = ((t + ((t >> 8) & 0xFF00FF)) >> 8) & 0xFF00FF | (((u + ((u >> 8) & 0xFF00FF)) >> 8) & 0xFF00FF) << 8
+        i += 1
+
+
+@micropython.viper
+def rle_decode_native(dst, src, params) -> int:
+    d = ptr8(dst)
+    s = ptr8(src)
+    p = ptr32(params)
+    pos = p[0] * 4
+    i = p[1]
+    end = p[2] * 4
+    n_src = int(len(src))
+    while i < n_src:
+        op = s[i]
+        i += 1
+        n = ((op & 63) + 1) * 4
+        kind = op >> 6
+        if pos + n > end:
+            return -1
+        if kind == 0:
+            pos += n
+        elif kind == 1:
+            if i + 4 > n_src:
+                return -1
+            k = pos
+            while k < pos + n:
+                d[k] = s[i]
+                d[k + 1] = s[i + 1]
+                d[k + 2] = s[i + 2]
+                d[k + 3] = s[i + 3]
+                k += 4
+            pos += n
+            i += 4
+        elif kind == 2:
+            if i + n > n_src:
+                return -1
+            k = 0
+            while k < n:
+                d[pos + k] = s[i + k]
+                k += 1
+            pos += n
+            i += n
+        else:
+            return -1
+    return pos >> 2
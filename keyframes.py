@@ -0,0 +1,100 @@
+# Cache of the frames of periodic patterns. A pattern that shows the same <period> frames over and over (Rainbow,
+# the gradient pulse) draws every frame once and replays it from the cache on later cycles.
+#
+# Frames are kept under a memory budget. Patterns replay their frames in order, so evicting the least recently
+# used frame would always evict the one needed next: instead the first frames of the cycle that fit are kept
+# and the rest are drawn live every cycle.
+#
+# The budget comes from the app (cache_kb), so it is capped, and the buffer only takes what the heap can spare
+# when it is allocated. Without memory for it, every frame is drawn live.
+import array
+import gc
+
+# Largest budget, whatever a pattern asks for
+MAX_BUDGET_BYTES = 96 * 1024
+# Heap left for everything else when the buffer is allocated
+HEAP_RESERVE_BYTES = 24 * 1024
+
+
+class KeyframeCache:
+    def __init__(self, budget_bytes=16384):
+        self.budget_bytes = min(budget_bytes, MAX_BUDGET_BYTES)
+        self.period = 0
+        self.words = 0
+        self.slots = 0
+        self.buffer = None
+        self.valid = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def prepare(self, period, words):
+        # Size the cache for <period> frames of <words> pixels. Keeps the frames if they are the same size.
+        if period == self.period and words == self.words:
+            return
+        self.period = period
+        self.words = words
+        self.slots = min(period, self.budget_bytes // (4 * words))
+        # Allocated once, on the first frame stored
+        self.buffer = None
+        self.valid = bytearray(self.slots)
+
+    def allocate(self):
+        # Allocate the buffer for as many slots as the free heap allows, or none
+        slots = self.slots
+        if hasattr(gc, "mem_free"):
+            gc.collect()
+            # The buffer is built from a bytearray of the same size, so it takes twice its size for a moment
+            slots = min(slots, max(0, gc.mem_free() - HEAP_RESERVE_BYTES) // (8 * self.words))
+        try:
+            buffer = array.array("I", bytearray(4 * self.words * slots))
+        except MemoryError:
+            # Drawn live from here on
+            buffer = array.array("I")
+            slots = 0
+        self.buffer = buffer
+        self.slots = slots
+
+    def release(self):
+        # Free the buffer, the next prepare() starts over
+        self.period = 0
+        self.words = 0
+        self.slots = 0
+        self.buffer = None
+        self.valid = None
+
+    def get(self, phase):
+        # Cached frame for phase 0..period-1 as a memoryview, or None if it must be drawn
+        if phase < self.slots and self.valid[phase]:
+            self.hits += 1
+            start = phase * self.words
+            return memoryview(self.buffer)[start:start + self.words]
+        self.misses += 1
+        return None
+
+    def store(self, phase, frame):
+        # Keep a copy of the packed frame (array.array('I') in pixel order) drawn for <phase>, if it fits
+        if phase >= self.slots:
+            return
+        words = self.words
+        if self.buffer is None:
+            self.allocate()
+            if phase >= self.slots:
+                return
+        start = phase * words
+        memoryview(self.buffer)[start:start + words] = memoryview(frame)[:words]
+        self.valid[phase] = 1
+
+    def stats(self):
+        lookups = max(1, self.hits + self.misses)
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups,
+            "frames": sum(self.valid) if self.valid is not None else 0,
+            "slots": self.slots,
+            "period": self.period,
+            "bytes": len(self.buffer) * 4 if self.buffer is not None else 0,
+        }
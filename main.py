@@ -13,11 +13,16 @@ import ds18x20 as ds # Temperature sensor
 import onewire
 from machine import Pin
 from debounce import DebouncedSwitch
-from patterns import NeopixelConfigurationInterface, NeopixelSingleColorConfiguration, NeopixelGradientPulseConfiguration, Rainbow
+from pattern_base import RenderContext, FrameScheduler
+from registry import PatternRegistry
+from ble_dispatch import WriteDispatcher
+from notify_queue import NotificationQueue, KIND_BUTTON, KIND_TEMPERATURE, BACK_PRESSURE
+from thermometer import TemperatureSampler
 
 
 NEOPIXEL_SERVICE_UUID = bluetooth.UUID("f7d9c9d3-9c3d-4c9e-9c8d-9c8d9c8d9c8d")
 NEOPIXEL_COLOR_CHAR_UUID = bluetooth.UUID("f7d9c9d4-9c3d-4c9e-9c8d-9c8d9c8d9c8d")
+NEOPIXEL_LIVE_FRAME_CHAR_UUID = bluetooth.UUID("f7d9c9e0-9c3d-4c9e-9c8d-9c8d9c8d9c8d")
 BUTTONS_SERVICE_UUID = bluetooth.UUID("f7d9c9d5-9c3d-4c9e-9c8d-9c8d9c8d9c8d")
 BUTTONS_1_CHAR_UUID = bluetooth.UUID("f7d9c9d6-9c3d-4c9e-9c8d-9c8d9c8d9c8d")
 TEMPERATURE_CHAR_UUID = bluetooth.UUID("f7d9c9d7-9c3d-4c9e-9c8d-9c8d9c8d9c8d")
@@ -57,6 +62,8 @@ REED_PIN = Pin(0, mode=Pin.IN, value=1, pull=Pin.PULL_UP)
 THERMOMETER_PIN = Pin(10)
 THERMOMETER_SENSOR = ds.DS18X20(onewire.OneWire(THERMOMETER_PIN))
 THERMOMETER_ROMS = THERMOMETER_SENSOR.scan()
+# 12 bit readings (750 ms conversions) every 1 s, slowing down to every 8 s while nothing changes by more than 0.25 C
+temperature_sampler = TemperatureSampler(THERMOMETER_SENSOR, THERMOMETER_ROMS)
 
 ble = bluetooth.BLE()
 
@@ -72,13 +79,30 @@ current_kuunappi_mode = KUUNAPPI_MODE_CONTROLS_AND_LED
 
 current_neopixel_pattern = None
 current_neopixel_identifier = None
-latest_neopixel_ble_update = None
-static_board_neopixel_pattern = NeopixelSingleColorConfiguration((0, 0, 0, 0))
+# Set when current_neopixel_identifier changes, see set_neopixel_identifier(). The button callbacks set it from
+# micropython.schedule, which must not touch the event loop directly.
+neopixel_changed = asyncio.ThreadSafeFlag() if hasattr(asyncio, "ThreadSafeFlag") else asyncio.Event()
+# The led-strip and its buffers, shared by every pattern
+render_context = RenderContext()
+# Draws the active pattern at a fixed frame rate
+frame_scheduler = FrameScheduler(render_context)
+# Patterns by mode, imported on first use and reused when the same JSON is sent again
+pattern_registry = PatternRegistry(render_context)
+# The static color set with the buttons, see get_static_pattern()
+static_board_neopixel_pattern = None
 led = Pin(1, Pin.OUT)
 is_connected = False
 bt_connection = None
 
 
+def get_static_pattern():
+    # Made on first use, so the pattern modules aren't loaded at boot
+    global static_board_neopixel_pattern
+    if static_board_neopixel_pattern is None:
+        static_board_neopixel_pattern = pattern_registry.get_class("solid")((0, 0, 0, 0), render_context)
+    return static_board_neopixel_pattern
+
+
 # Register service
 controls_service = aioble.Service(CONTROLS_SERVICE_UUID)
 controls_powerbutton_characteristic = aioble.Characteristic(controls_service, CONTROLS_POWERBUTTON_CHAR_UUID, write=True, read=True)
@@ -87,17 +111,23 @@ mode_characteristic = aioble.Characteristic(
     controls_service, CONTROLS_MODE_CHAR_UUID, write=True, read=True, notify=True)
 neopixel_service = aioble.Service(NEOPIXEL_SERVICE_UUID)
 neopixel_setting_characteristic = aioble.Characteristic(neopixel_service, NEOPIXEL_COLOR_CHAR_UUID, write=True, read=True)
+# Frames streamed by the app, see protocol.py. Every packet counts, so writes are captured instead of read.
+live_frame_characteristic = aioble.Characteristic(
+    neopixel_service, NEOPIXEL_LIVE_FRAME_CHAR_UUID, write=True, write_no_response=True, capture=True)
 buttons_service = aioble.Service(BUTTONS_SERVICE_UUID)
 buttons_characteristic = aioble.Characteristic(buttons_service, BUTTONS_1_CHAR_UUID, notify=True)
 temperature_service = aioble.Service(TEMPERATURE_SERVICE_UUID)
 temperature_characteristic = aioble.Characteristic(temperature_service, TEMPERATURE_CHAR_UUID, notify=True)
+# Button presses and temperatures are queued and sent in batches. Button presses come from interrupts and can't
+# wait, so the oldest are dropped when the central falls behind; the thermometer task waits for room instead.
+button_notifications = NotificationQueue(buttons_characteristic)
+temperature_notifications = NotificationQueue(temperature_characteristic, depth=16, policy=BACK_PRESSURE)
 
 # Write a 256 byte buffer to the characteristic.
 sample = bytearray(256)
 for i in range(256):
     sample[i] = i
 neopixel_setting_characteristic.write(sample)
-neopixel_loop_task = None # asyncio task
     
 aioble.register_services(neopixel_service, controls_service, buttons_service, temperature_service)
 
@@ -107,65 +137,54 @@ async def create_short_pin_pulse(pin, duration):
     await asyncio.sleep_ms(duration)
     pin.value(0)
 
-def get_neopixel_config_from_json(json) -> NeopixelConfigurationInterface:
-    light_class = json["mode"]
-    if (light_class == "solid"):
-        return NeopixelSingleColorConfiguration.from_json(json)
-    elif (light_class == 'rainbow'):
-        return Rainbow.from_json(json)
-    else:
-        return NeopixelGradientPulseConfiguration.from_json(json)
-
 # ! Neopixel stuff
+def set_neopixel_identifier(identifier):
+    # 'STATIC' or a pattern's JSON or binary payload. Wakes neopixel_task.
+    global current_neopixel_identifier
+    current_neopixel_identifier = identifier
+    neopixel_changed.set()
+
 async def neopixel_task():
-    global current_neopixel_pattern, current_neopixel_identifier, neopixel_loop_task
-    previous_neopixel_identifier = None
+    global current_neopixel_pattern
     while True:
-        if current_neopixel_identifier != previous_neopixel_identifier:
-            # Update
-            previous_neopixel_identifier = current_neopixel_identifier
-            if current_neopixel_identifier is not None:
-                # Start the loop, terminate the previous one if it exists.
-                if neopixel_loop_task is not None:
-                    neopixel_loop_task.cancel()
-                    if current_neopixel_pattern is not None:
-                        await current_neopixel_pattern.terminate()
-                if current_neopixel_identifier == 'STATIC':
-                    await static_board_neopixel_pattern.setup()
-                    loop = asyncio.get_event_loop()
-                    neopixel_loop_task = loop.create_task(static_board_neopixel_pattern.loop())
-                else:
-                    try:
-                        current_neopixel_pattern = get_neopixel_config_from_json(current_neopixel_identifier)
-                        await current_neopixel_pattern.setup()
-                        loop = asyncio.get_event_loop()
-                        neopixel_loop_task = loop.create_task(current_neopixel_pattern.loop())
-                    except Exception as e:
-                        print("Error:", e)
-                        return
-        await asyncio.sleep_ms(200)
-
-async def neopixel_task_BLE(connection):
-    global current_neopixel_pattern, is_connected, current_neopixel_identifier, latest_neopixel_ble_update
-    if not is_connected:
-        await asyncio.sleep_ms(1000)
-        return
-    # Check if the mode has changed.
-    new_mode = neopixel_setting_characteristic.read()
-    if latest_neopixel_ble_update is None or new_mode != latest_neopixel_ble_update:
-        latest_neopixel_ble_update = new_mode
-        try:
-            # Check if valid JSON
-            new_mode = json.loads(new_mode)
-        except Exception as e:
-            print("BLE Error:", e)
-            await asyncio.sleep_ms(1000)
-            return
-        current_neopixel_identifier = new_mode
+        await neopixel_changed.wait()
+        # A ThreadSafeFlag clears itself in wait(), an Event doesn't
+        if isinstance(neopixel_changed, asyncio.Event):
+            neopixel_changed.clear()
+        # Only the latest identifier matters when several came in at once
+        identifier = current_neopixel_identifier
+        if identifier is None:
+            continue
+        # The scheduler blends the new pattern in over the previous one.
+        if identifier == 'STATIC':
+            frame_scheduler.set_pattern(get_static_pattern())
+        else:
+            try:
+                # The identifier is the JSON or binary payload as received, an invalid one or an unknown mode is rejected
+                current_neopixel_pattern, transition = pattern_registry.from_payload(identifier)
+                await current_neopixel_pattern.setup()
+                frame_scheduler.set_pattern(current_neopixel_pattern, transition)
+            except Exception as e:
+                print("Error:", e)
+
+def handle_neopixel_write(value):
+    if value:
+        set_neopixel_identifier(bytes(value))
+
+def handle_live_frame(value):
+    # Switch to streaming on the first packet, unless a "stream" mode was picked with settings of its own
+    global current_neopixel_pattern
+    stream_class = pattern_registry.get_class("stream")
+    pattern = frame_scheduler.pattern
+    if not isinstance(pattern, stream_class):
+        pattern = stream_class(context=render_context)
+        current_neopixel_pattern = pattern
+        frame_scheduler.set_pattern(pattern)
+    pattern.feed(value)
 
 # ! Buttons stuff
 def button_clicked(index):
-    global led, bt_connection, current_kuunappi_mode, static_board_neopixel_pattern, current_neopixel_identifier
+    global led, bt_connection, current_kuunappi_mode
     print("Button clicked", index)
     if (current_kuunappi_mode == KUUNAPPI_MODE_CONTROLS_AND_LED): # If the mode is controls and led, no need for BT connection.
         # Buttons 1-3 are for screen buttons, 4-7 are for RGBW switching for static colors.
@@ -177,24 +196,22 @@ def button_clicked(index):
             asyncio.create_task(create_short_pin_pulse(BRIGHT_UP_PIN, 100))
         elif (index == 3): # LEDS: RED
             # Increase the brightness of the red LEDs by 25
-            static_board_neopixel_pattern.increase_color_for_channel(0, 25)
-            current_neopixel_identifier = 'STATIC'
+            get_static_pattern().increase_color_for_channel(0, 25)
+            set_neopixel_identifier('STATIC')
         elif (index == 4): # LEDS: GREEN
             # Increase the brightness of the green LEDs by 25
-            static_board_neopixel_pattern.increase_color_for_channel(1, 25)
-            current_neopixel_identifier = 'STATIC'
+            get_static_pattern().increase_color_for_channel(1, 25)
+            set_neopixel_identifier('STATIC')
         elif (index == 5): # LEDS: BLUE
             # Increase the brightness of the blue LEDs by 25
-            static_board_neopixel_pattern.increase_color_for_channel(2, 25)
-            current_neopixel_identifier = 'STATIC'
+            get_static_pattern().increase_color_for_channel(2, 25)
+            set_neopixel_identifier('STATIC')
         elif (index == 6): # LEDS: WHITE
             # Increase the brightness of the white LEDs by 25
-            static_board_neopixel_pattern.increase_color_for_channel(3, 25)
-            current_neopixel_identifier = 'STATIC'
+            get_static_pattern().increase_color_for_channel(3, 25)
+            set_neopixel_identifier('STATIC')
     else: # Send the button click to the device
-        # Get the characteristic
-        characteristic = buttons_characteristic
-        characteristic.notify(bt_connection, str(index))
+        button_notifications.put(KIND_BUTTON, index, 1)
 
 # ! Controls stuff
 # Set the screen brightness. If max/min, increase/decrease for all possible levels. If +1/-1, increase/decrease by one level.
@@ -240,59 +257,45 @@ def handle_reed_trigger(*args, **kwargs):
     led.value(not led.value())
 
 
-async def controls_task():
-    global current_kuunappi_mode, is_connected, current_neopixel_identifier, current_neopixel_pattern
-    if not is_connected:
-        return
-    # Listen to the controls powerbutton and brightness up/down characteristics.
-    powerbutton = controls_powerbutton_characteristic.read()
-    if powerbutton == b'\x01':
+# Handlers of the controls characteristics, called by the write dispatcher when a value is written.
+async def handle_powerbutton_write(value):
+    if value == b'\x01':
         print("Powerbutton pressed")
         # Reset the powerbutton state to 0 again
         controls_powerbutton_characteristic.write(b'\x00')
         await handle_powerbutton_click()
-    brightness_change = controls_brightness_change_characteristic.read()
-    if brightness_change != b'\x00' and brightness_change != b'':
+
+def handle_brightness_write(value):
+    if value != b'\x00' and value != b'':
         # Reset the brightness change state to 0 again
         controls_brightness_change_characteristic.write(b'\x00')
-        #Decode the brightness change value string
-        brightness_change = brightness_change.decode("utf-8")
-        # Create a task to handle the brightness change
-        loop = asyncio.get_event_loop()
-        loop.create_task(handle_brightness_change(bt_connection, brightness_change))
-    new_mode = mode_characteristic.read()
-    new_mode = decode_mode(new_mode)
+        # Decode the brightness change value string and handle it in a task of its own
+        asyncio.create_task(handle_brightness_change(bt_connection, value.decode("utf-8")))
+
+def handle_mode_write(value):
+    global current_kuunappi_mode
+    new_mode = decode_mode(value)
     if new_mode != current_kuunappi_mode:
         current_kuunappi_mode = new_mode
         led.toggle()
         print("Mode changed to", new_mode)
-    
-# Looping task
-async def conn_task(connection):
-    global current_kuunappi_mode, is_connected
-    if is_connected:
-        # Initial write
-        mode_characteristic.write(_encode_mode(current_kuunappi_mode))
-    while True:
-        await neopixel_task_BLE(connection)
-        await controls_task()
-        await asyncio.sleep_ms(20)
+
+# Every written characteristic goes straight to its handler
+ble_dispatcher = WriteDispatcher()
+ble_dispatcher.route(neopixel_setting_characteristic, handle_neopixel_write)
+ble_dispatcher.route(live_frame_characteristic, handle_live_frame, capture=True)
+ble_dispatcher.route(controls_powerbutton_characteristic, handle_powerbutton_write)
+ble_dispatcher.route(controls_brightness_change_characteristic, handle_brightness_write)
+ble_dispatcher.route(mode_characteristic, handle_mode_write)
+
+def report_temperature(index, value):
+    print("Temperature:", index, value / 100)
+    # Send the temperature to the central, in hundredths of a degree
+    return temperature_notifications.put_async(KIND_TEMPERATURE, index, value)
 
 async def thermometer_task():
-    global is_connected, bt_connection
-    while True:
-        await asyncio.sleep_ms(1000)
-        if is_connected:
-            try:
-                for rom in THERMOMETER_ROMS:
-                    THERMOMETER_SENSOR.convert_temp()
-                    await asyncio.sleep_ms(100)
-                    temperature = THERMOMETER_SENSOR.read_temp(rom)
-                    print("Temperature:", temperature)
-                    # Send the temperature to the central
-                    temperature_characteristic.notify(bt_connection, str(temperature))
-            except Exception as e:
-                print("Error handling thermometer data:", e)
+    # Runs while connected: all temperatures are sent on connecting, then only when they change
+    await temperature_sampler.run(report_temperature)
 
 # Serially wait for connections. Don't advertise while a central is
 # connected.
@@ -311,16 +314,23 @@ async def peripheral_task():
             bt_connection = connection
             connection.exchange_mtu(512)
             is_connected = True
+            # Initial write
+            mode_characteristic.write(_encode_mode(current_kuunappi_mode))
             loop = asyncio.get_event_loop()
-            conn_t = loop.create_task(conn_task(connection))
             therm_t = loop.create_task(thermometer_task())
+            # Events from before the connection are stale
+            button_notifications.clear()
+            temperature_notifications.clear()
+            buttons_t = loop.create_task(button_notifications.run(connection))
+            temperature_t = loop.create_task(temperature_notifications.run(connection))
             await connection.disconnected()
             print("Disconnected")
             is_connected = False
             # Remove tasks
             try:
-                conn_t.cancel()
                 therm_t.cancel()
+                buttons_t.cancel()
+                temperature_t.cancel()
             except Exception as e:
                 print("Error cancelling tasks:", e)
 
@@ -335,7 +345,9 @@ async def main():
     button_sw_6 = DebouncedSwitch(MOON_BUTTON_6_PIN, button_clicked, 5, 150)
     button_sw_7 = DebouncedSwitch(MOON_BUTTON_7_PIN, button_clicked, 6, 150)
     reed_sw = DebouncedSwitch(REED_PIN, handle_reed_trigger, delay=200)
+    asyncio.get_event_loop().create_task(frame_scheduler.run())
     asyncio.get_event_loop().create_task(neopixel_task())
+    ble_dispatcher.start()
     asyncio.get_event_loop().create_task(peripheral_task())
     asyncio.get_event_loop().run_forever()
 
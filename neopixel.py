@@ -1,6 +1,8 @@
 import array, time
 from machine import Pin
 import rp2
+import uasyncio as asyncio
+from kernels import fill_words, render_words, mask_words, gradient_words, gradient_params
 
 
 # PIO state machine for RGB. Pulls 24 bits (rgb -> 3 * 8bit) automatically
@@ -45,79 +47,57 @@ class slice_maker_class:
 
 slice_maker = slice_maker_class()
 
+# How many brightness levels keep their lookup tables around (each one takes 4 * 256 words)
+LUT_CACHE_SIZE = 4
 
-# Delay here is the reset time. You need a pause to reset the LED strip back to the initial LED
-# however, if you have quite a bit of processing to do before the next time you update the strip
-# you could put in delay=0 (or a lower delay)
+# Logical framebuffer the patterns draw into. Colors are stored at full precision, unscaled and
+# independent of the strip's color order, packed as 0xRRGGBBWW in one word per pixel. Brightness,
+# color order and packing for the strip are only applied by Neopixel.show(), so reading a pixel back
+# is exact and changing brightness doesn't touch the framebuffer.
 #
-# Class supports different order of individual colors (GRB, RGB, WRGB, GWRB ...). In order to achieve
-# this, we need to flip the indexes: in 'RGBW', 'R' is on index 0, but we need to shift it left by 3 * 8bits,
-# so in it's inverse, 'WBGR', it has exactly right index. Since micropython doesn't have [::-1] and recursive rev()
-# isn't too efficient we simply do that by XORing (operator ^) each index with 3 (0b11) to make this flip.
-# When dealing with just 'RGB' (3 letter string), this means same but reduced by 1 after XOR!.
-# Example: in 'GRBW' we want final form of 0bGGRRBBWW, meaning G with index 0 needs to be shifted 3 * 8bit ->
-# 'G' on index 0: 0b00 ^ 0b11 -> 0b11 (3), just as we wanted.
-# Same hold for every other index (and - 1 at the end for 3 letter strings).
+# Rotating doesn't move any data: 'offset' says where in 'frame' pixel 0 is stored, so pixel i lives at
+# frame[(i + offset) % num_leds]. The brightness mask belongs to the led position and doesn't rotate.
 
-class Neopixel:
-    # Micropython doesn't implement __slots__, but it's good to have a place
-    # to describe the data members...
+class FrameBuffer:
     # __slots__ = [
     #    'num_leds',   # number of LEDs
-    #    'pixels',     # array.array('I') of raw data for LEDs
-    #    'mode',       # mode 'RGB' etc
-    #    'W_in_mode',  # bool: is 'W' in mode
-    #    'sm',         # state machine
-    #    'shift',      # shift amount for each component, in a tuple for (R,B,G,W)
-    #    'delay',      # delay amount
-    #    'brightnessvalue', # brightness scale factor 1..255
+    #    'frame',      # array.array('I') of logical colors, 0xRRGGBBWW
+    #    'offset',     # index in 'frame' where pixel 0 is stored
+    #    'mask',       # bytearray of per-pixel brightness 0..255, applied on top of the global brightness
+    #    'W_in_mode',  # bool: do pixels have a white channel
+    #    'dirty_end',  # pixels from 0 up to (excluding) this index changed since the last show
+    #    'scratch',    # array.array('I') the size of the strip, for building packed pixels before writing them
+    #    'masked',     # number of pixels whose brightness mask isn't 255
     # ]
 
-    def __init__(self, num_leds, state_machine, pin, mode="RGB", delay=0.0001):
+    def __init__(self, num_leds, W_in_mode=True):
         """
-        Constructor for library class
-
-        :param num_leds:  number of leds on your led-strip
-        :param state_machine: id of PIO state machine used
-        :param pin: pin on which data line to led-strip is connected
-        :param mode: [default: "RGB"] mode and order of bits representing the color value.
-        This can be any order of RGB or RGBW (neopixels are usually GRB)
-        :param delay: [default: 0.0001] delay used for latching of leds when sending data
+        :param num_leds: number of pixels
+        :param W_in_mode: [default: True] whether get_pixel returns (r, g, b, w) or (r, g, b) tuples
         """
-        self.pixels = array.array("I", [0] * num_leds)
-        self.mode = mode
-        self.W_in_mode = 'W' in mode
-        if self.W_in_mode:
-            # RGBW uses different PIO state machine configuration
-            self.sm = rp2.StateMachine(state_machine, sk6812, freq=8000000, sideset_base=Pin(pin))
-            # tuple of values required to shift bit into position (check class desc.)
-            self.shift = ((mode.index('R') ^ 3) * 8, (mode.index('G') ^ 3) * 8,
-                          (mode.index('B') ^ 3) * 8, (mode.index('W') ^ 3) * 8)
-        else:
-            self.sm = rp2.StateMachine(state_machine, ws2812, freq=8000000, sideset_base=Pin(pin))
-            self.shift = (((mode.index('R') ^ 3) - 1) * 8, ((mode.index('G') ^ 3) - 1) * 8,
-                          ((mode.index('B') ^ 3) - 1) * 8, 0)
-        self.sm.active(1)
         self.num_leds = num_leds
-        self.delay = delay
-        self.brightnessvalue = 255
-
-    def brightness(self, brightness=None):
+        self.frame = array.array("I", [0] * num_leds)
+        self.offset = 0
+        self.mask = bytearray(b"\xff" * num_leds)
+        self.W_in_mode = W_in_mode
+        self.dirty_end = num_leds
+        self.scratch = array.array("I", [0] * num_leds)
+        self.gradient_params = array.array("i", [0] * 8)
+        # Number of pixels with a brightness mask other than 255
+        self.masked = 0
+
+    def mark_dirty(self, end=None):
         """
-        Set the overall value to adjust brightness when updating leds
-        or return class brightnessvalue if brightness is None
+        Mark pixels as changed, for code that writes into self.frame or self.mask directly.
+        Note that pixel i is stored in frame[(i + self.offset) % self.num_leds].
 
-        :param brightness: [default: None] Value of brightness on interval 1..255
-        :return: class brightnessvalue member or None
+        :param end: [default: None] Pixels before this index changed. If None, the whole strip changed.
+        :return: None
         """
-        if brightness is None:
-            return self.brightnessvalue
-        else:
-            if brightness < 1:
-                brightness = 1
-        if brightness > 255:
-            brightness = 255
-        self.brightnessvalue = brightness
+        if end is None or end > self.num_leds:
+            end = self.num_leds
+        if end > self.dirty_end:
+            self.dirty_end = end
 
     def set_pixel_line_gradient(self, pixel1, pixel2, left_rgb_w, right_rgb_w, how_bright=None):
         """
@@ -127,7 +107,7 @@ class Neopixel:
         :param pixel2: Index of ending pixel (inclusive)
         :param left_rgb_w: Tuple of form (r, g, b) or (r, g, b, w) representing starting color
         :param right_rgb_w: Tuple of form (r, g, b) or (r, g, b, w) representing ending color
-        :param how_bright: [default: None] Brightness of current interval. If None, use global brightness value
+        :param how_bright: [default: None] Brightness of current interval. If None, pixels keep their brightness
         :return: None
         """
         if pixel2 - pixel1 == 0:
@@ -135,24 +115,66 @@ class Neopixel:
         right_pixel = max(pixel1, pixel2)
         left_pixel = min(pixel1, pixel2)
 
-        with_W = len(left_rgb_w) == 4 and self.W_in_mode
-        r_diff = right_rgb_w[0] - left_rgb_w[0]
-        g_diff = right_rgb_w[1] - left_rgb_w[1]
-        b_diff = right_rgb_w[2] - left_rgb_w[2]
-        if with_W:
-            w_diff = (right_rgb_w[3] - left_rgb_w[3])
-
-        for i in range(right_pixel - left_pixel + 1):
-            fraction = i / (right_pixel - left_pixel)
-            red = round(r_diff * fraction + left_rgb_w[0])
-            green = round(g_diff * fraction + left_rgb_w[1])
-            blue = round(b_diff * fraction + left_rgb_w[2])
-            # if it's (r, g, b, w)
-            if with_W:
-                white = round(w_diff * fraction + left_rgb_w[3])
-                self.set_pixel(left_pixel + i, (red, green, blue, white), how_bright)
-            else:
-                self.set_pixel(left_pixel + i, (red, green, blue), how_bright)
+        left = left_rgb_w[0] << 24 | left_rgb_w[1] << 16 | left_rgb_w[2] << 8
+        right = right_rgb_w[0] << 24 | right_rgb_w[1] << 16 | right_rgb_w[2] << 8
+        # if it's (r, g, b, w)
+        if len(left_rgb_w) == 4 and self.W_in_mode:
+            left |= left_rgb_w[3]
+            right |= right_rgb_w[3]
+        self.fill_gradient(left_pixel, right_pixel, (left, right))
+        if how_bright is not None:
+            self.set_brightness(slice_maker[left_pixel:right_pixel + 1], how_bright)
+
+    def fill_gradient(self, pixel1, pixel2, stops):
+        """
+        Fill pixels from "pixel1" to "pixel2" (inclusive) with a gradient through evenly spaced color stops.
+        Works in 16.16 fixed point, stepping every channel by a constant per pixel (DDA), so there is no
+        division or float work per pixel. Results are within 1 of the float interpolation.
+
+        :param pixel1: Index of starting pixel (inclusive)
+        :param pixel2: Index of ending pixel (inclusive)
+        :param stops: Sequence of packed 0xRRGGBBWW colors, the first at pixel1 and the last at pixel2
+        :return: None
+        """
+        num_leds = self.num_leds
+        left_pixel = min(pixel1, pixel2)
+        right_pixel = min(max(pixel1, pixel2), num_leds - 1)
+        span = max(pixel1, pixel2) - left_pixel
+        # Only the part on the strip is drawn: pixels before 0 are skipped, those past the end cut off
+        skip = max(0, -left_pixel)
+        total = right_pixel - (left_pixel + skip) + 1
+        if total <= 0:
+            return
+        if len(stops) == 1:
+            stops = (stops[0], stops[0])
+        segments = len(stops) - 1
+        # The line is built in the scratch buffer and copied in at once, the copy takes care of the ring
+        scratch = memoryview(self.scratch)
+        params = self.gradient_params
+        written = 0
+        for s in range(segments):
+            count = (s + 1) * span // segments - s * span // segments
+            if count == 0:
+                continue
+            if skip >= count:
+                skip -= count
+                continue
+            gradient_params(params, stops[s], stops[s + 1], count)
+            if skip:
+                # Step the accumulators past the skipped pixels
+                for k in range(4):
+                    params[k] += params[k + 4] * skip
+                count -= skip
+                skip = 0
+            count = min(count, total - written)
+            gradient_words(scratch[written:written + count], params)
+            written += count
+            if written == total:
+                break
+        # The last pixel is the last stop, unless the gradient was cut off at the end of the strip
+        if written < total:
+            self.scratch[written] = stops[-1]
+        self.write_frame(scratch[:total], max(0, left_pixel))
 
     def set_pixel_line(self, pixel1, pixel2, rgb_w, how_bright=None):
         """
@@ -161,7 +183,7 @@ class Neopixel:
         :param pixel1: Index of starting pixel (inclusive)
         :param pixel2: Index of ending pixel (inclusive)
         :param rgb_w: Tuple of form (r, g, b) or (r, g, b, w) representing color to be used
-        :param how_bright: [default: None] Brightness of current interval. If None, use global brightness value
+        :param how_bright: [default: None] Brightness of current interval. If None, pixels keep their brightness
         :return: None
         """
         if pixel2 >= pixel1:
@@ -175,29 +197,157 @@ class Neopixel:
 
         :param pixel_num: Index of pixel to be set or slice object representing multiple leds
         :param rgb_w: Tuple of form (r, g, b) or (r, g, b, w) representing color to be used
-        :param how_bright: [default: None] Brightness of current interval. If None, use global brightness value
+        :param how_bright: [default: None] Brightness of the pixels, on top of the global brightness.
+        If None, pixels keep their brightness (see set_brightness)
         :return: None
         """
-        if how_bright is None:
-            how_bright = self.brightness()
-        sh_R, sh_G, sh_B, sh_W = self.shift
-        bratio = how_bright / 255.0
+        try:
+            value = rgb_w[0] << 24 | rgb_w[1] << 16 | rgb_w[2] << 8
+            # if it's (r, g, b, w)
+            if len(rgb_w) == 4:
+                value |= rgb_w[3]
+        except TypeError:
+            # Float channels (e.g. from lerp) are rounded first
+            rgb_w = tuple(round(c) for c in rgb_w)
+            value = rgb_w[0] << 24 | rgb_w[1] << 16 | rgb_w[2] << 8
+            if len(rgb_w) == 4:
+                value |= rgb_w[3]
+        frame = self.frame
+        num_leds = self.num_leds
+        offset = self.offset
+        # Only pixels that really change count as dirty, so re-drawing the same frame sends nothing
+        changed = -1
+        # set some subset, if pixel_num is a slice:
+        if type(pixel_num) is slice:
+            start, stop, step = pixel_num.indices(num_leds)
+            if step == 1 and stop > start:
+                # Contiguous range: fill with the kernel, in two parts where it wraps around the ring
+                j = start + offset
+                if j >= num_leds:
+                    j -= num_leds
+                first = min(stop - start, num_leds - j)
+                frame = memoryview(frame)
+                last = fill_words(frame[j:j + first], value)
+                if last:
+                    changed = start + last - 1
+                if first < stop - start:
+                    last = fill_words(frame[:stop - start - first], value)
+                    if last:
+                        changed = start + first + last - 1
+            else:
+                for i in range(start, stop, step):
+                    j = i + offset
+                    if j >= num_leds:
+                        j -= num_leds
+                    if frame[j] != value:
+                        frame[j] = value
+                        if i > changed:
+                            changed = i
+        else:
+            if pixel_num < 0:
+                pixel_num += num_leds
+            j = pixel_num + offset
+            if j >= num_leds:
+                j -= num_leds
+            if frame[j] != value:
+                frame[j] = value
+                changed = pixel_num
+        if changed >= self.dirty_end:
+            self.dirty_end = changed + 1
+        if how_bright is not None:
+            self.set_brightness(pixel_num, how_bright)
+
+    def set_pixels(self, start, data, with_W=True):
+        """
+        Set consecutive pixels from a buffer of channel bytes, starting at <start>.
+        Pixels before the start or past the end of the strip are ignored.
 
-        red = round(rgb_w[0] * bratio)
-        green = round(rgb_w[1] * bratio)
-        blue = round(rgb_w[2] * bratio)
-        white = 0
-        # if it's (r, g, b, w)
-        if len(rgb_w) == 4 and self.W_in_mode:
-            white = round(rgb_w[3] * bratio)
+        :param start: Index of the first pixel to set
+        :param data: bytes, bytearray, array.array('B') or memoryview of r, g, b(, w) bytes per pixel
+        :param with_W: [default: True] whether data has 4 (r, g, b, w) or 3 (r, g, b) bytes per pixel
+        :return: None
+        """
+        num_leds = self.num_leds
+        stride = 4 if with_W else 3
+        if start < 0:
+            data = memoryview(data)[-start * stride:]
+            start = 0
+        count = min(len(data) // stride, num_leds - start)
+        if count <= 0:
+            return
+        frame = self.frame
+        j = start + self.offset
+        if j >= num_leds:
+            j -= num_leds
+        k = 0
+        for _ in range(count):
+            if with_W:
+                frame[j] = data[k] << 24 | data[k + 1] << 16 | data[k + 2] << 8 | data[k + 3]
+            else:
+                frame[j] = data[k] << 24 | data[k + 1] << 16 | data[k + 2] << 8
+            k += stride
+            j += 1
+            if j == num_leds:
+                j = 0
+        self.mark_dirty(start + count)
+
+    def write_frame(self, packed, start=0):
+        """
+        Copy precomputed packed pixels (0xRRGGBBWW words) into the framebuffer starting at <start>,
+        with memoryview slice copies. Pixels before the start or past the end of the strip are ignored.
 
-        pix_value = white << sh_W | blue << sh_B | red << sh_R | green << sh_G
-        # set some subset, if pixel_num is a slice:
+        :param packed: array.array('I') or memoryview of one, e.g. memoryview(frame)[a:b]
+        :param start: [default: 0] Index of the first pixel to set
+        :return: None
+        """
+        num_leds = self.num_leds
+        src = memoryview(packed)
+        if start < 0:
+            src = src[-start:]
+            start = 0
+        count = min(len(src), num_leds - start)
+        if count <= 0:
+            return
+        dst = memoryview(self.frame)
+        j = start + self.offset
+        if j >= num_leds:
+            j -= num_leds
+        # The copy is split in two where it wraps around the end of the ring
+        first = num_leds - j
+        if count <= first:
+            dst[j:j + count] = src[:count]
+        else:
+            dst[j:] = src[:first]
+            dst[:count - first] = src[first:count]
+        self.mark_dirty(start + count)
+
+    def set_brightness(self, pixel_num, how_bright):
+        """
+        Set the brightness mask of pixel on position <pixel_num>. The mask scales the global brightness
+        when the frame is shown, the stored colors are not changed.
+
+        :param pixel_num: Index of pixel or slice object representing multiple leds
+        :param how_bright: Brightness on interval 0..255
+        :return: None
+        """
+        mask = self.mask
+        changed = -1
         if type(pixel_num) is slice:
-            for i in range(*pixel_num.indices(self.num_leds)):
-                self.pixels[i] = pix_value
+            indices = range(*pixel_num.indices(self.num_leds))
         else:
-            self.pixels[pixel_num] = pix_value
+            if pixel_num < 0:
+                pixel_num += self.num_leds
+            indices = (pixel_num,)
+        for i in indices:
+            if mask[i] != how_bright:
+                if mask[i] == 255:
+                    self.masked += 1
+                elif how_bright == 255:
+                    self.masked -= 1
+                mask[i] = how_bright
+                changed = i
+        if changed >= self.dirty_end:
+            self.dirty_end = changed + 1
 
     def get_pixel(self, pixel_num):
         """
@@ -206,21 +356,53 @@ class Neopixel:
         :param pixel_num: Index of pixel to be set
         :return rgb_w: Tuple of form (r, g, b) or (r, g, b, w) representing color to be used
         """
-        balance = self.pixels[pixel_num]
-        sh_R, sh_G, sh_B, sh_W = self.shift
+        if pixel_num < 0:
+            pixel_num += self.num_leds
+        value = self.frame[(pixel_num + self.offset) % self.num_leds]
         if self.W_in_mode:
-            w = (balance >> sh_W) & 255
-        b = (balance >> sh_B) & 255
-        r = (balance >> sh_R) & 255
-        g = (balance >> sh_G) & 255
-        red = int(r * 255 / self.brightness() )
-        green = int(g * 255 / self.brightness() )
-        blue = int(b * 255 / self.brightness() )
-        if self.W_in_mode:
-            white = int(w * 255 / self.brightness() )
-            return (red,green,blue,white)
+            return (value >> 24, (value >> 16) & 255, (value >> 8) & 255, value & 255)
         else:
-            return (red,green,blue)
+            return (value >> 24, (value >> 16) & 255, (value >> 8) & 255)
+
+    def blend_pixel(self, pixel_num, value, amount):
+        """
+        Blend a packed color into the pixel on position <pixel_num>, in the framebuffer itself (no read back
+        through get_pixel). Positions wrap around the strip, so lines can cross the seam.
+
+        :param pixel_num: Index of the pixel, taken modulo the number of pixels
+        :param value: Packed 0xRRGGBBWW color
+        :param amount: 0..255, where 255 gives exactly <value>
+        :return: None
+        """
+        num_leds = self.num_leds
+        pixel_num %= num_leds
+        i = pixel_num + self.offset
+        if i >= num_leds:
+            i -= num_leds
+        c = self.frame[i]
+        # Stretch 0..255 to 0..256, so that 255 gives exactly value
+        amount += amount >> 7
+        inv = 256 - amount
+        self.frame[i] = (((c >> 24) * inv + (value >> 24) * amount + 128) >> 8) << 24 | \
+            ((((c >> 16) & 255) * inv + ((value >> 16) & 255) * amount + 128) >> 8) << 16 | \
+            ((((c >> 8) & 255) * inv + ((value >> 8) & 255) * amount + 128) >> 8) << 8 | \
+            (((c & 255) * inv + (value & 255) * amount + 128) >> 8)
+        self.mark_dirty(pixel_num + 1)
+
+    def logical_frame(self):
+        """
+        The framebuffer in pixel order: 'frame' itself when it isn't rotated, otherwise a copy in 'scratch'.
+
+        :return: array.array('I') of packed pixels, pixel 0 first
+        """
+        offset = self.offset
+        if offset == 0:
+            return self.frame
+        src = memoryview(self.frame)
+        dst = memoryview(self.scratch)
+        dst[:self.num_leds - offset] = src[offset:]
+        dst[self.num_leds - offset:] = src[:offset]
+        return self.scratch
 
     def __setitem__(self, idx, rgb_w):
         """
@@ -295,48 +477,34 @@ class Neopixel:
 
     def rotate_left(self, num_of_pixels=None):
         """
-        Rotate <num_of_pixels> pixels to the left
+        Rotate <num_of_pixels> pixels to the left. Only moves the ring offset, no pixel data is copied.
 
         :param num_of_pixels: Number of pixels to be shifted to the left. If None, it shifts for 1.
         :return: None
         """
         if num_of_pixels is None:
             num_of_pixels = 1
-        self.pixels = self.pixels[num_of_pixels:] + self.pixels[:num_of_pixels]
+        self.offset = (self.offset + num_of_pixels) % self.num_leds
+        self.dirty_end = self.num_leds
 
     def rotate_right(self, num_of_pixels=None):
         """
-        Rotate <num_of_pixels> pixels to the right
+        Rotate <num_of_pixels> pixels to the right. Only moves the ring offset, no pixel data is copied.
 
         :param num_of_pixels: Number of pixels to be shifted to the right. If  None, it shifts for 1.
         :return: None
         """
         if num_of_pixels is None:
             num_of_pixels = 1
-        num_of_pixels = -1 * num_of_pixels
-        self.pixels = self.pixels[num_of_pixels:] + self.pixels[:num_of_pixels]
-
-    def show(self):
-        """
-        Send data to led-strip, making all changes on leds have an effect.
-        This method should be used after every method that changes the state of leds or after a chain of changes.
-        :return: None
-        """
-        # If mode is RGB, we cut 8 bits of, otherwise we keep all 32
-        cut = 8
-        if self.W_in_mode:
-            cut = 0
-        sm_put = self.sm.put
-        for pixval in self.pixels:
-            sm_put(pixval, cut)
-        time.sleep(self.delay)
+        self.offset = (self.offset - num_of_pixels) % self.num_leds
+        self.dirty_end = self.num_leds
 
     def fill(self, rgb_w, how_bright=None):
         """
         Fill the entire strip with color rgb_w
 
         :param rgb_w: Tuple of form (r, g, b) or (r, g, b, w) representing color to be used
-        :param how_bright: [default: None] Brightness of current interval. If None, use global brightness value
+        :param how_bright: [default: None] Brightness of current interval. If None, pixels keep their brightness
         :return: None
         """
         # set_pixel over all leds.
@@ -348,4 +516,469 @@ class Neopixel:
 
         :return: None
         """
-        self.pixels = array.array("I", [0] * self.num_leds)
\ No newline at end of file
+        self.set_pixel(slice_maker[:], (0, 0, 0, 0))
+
+
+class NeopixelSegment:
+    # __slots__ = [
+    #    'first',      # index of the first logical pixel on this segment
+    #    'num_leds',   # number of LEDs on this segment
+    #    'sm',         # state machine
+    #    'cut',        # bits each word is shifted left by when put (8 for RGB, 0 for RGBW)
+    #    'delay',      # delay amount
+    #    'word_us',    # time it takes to clock out one pixel
+    #    'bulk',       # bool: hand the whole frame to the state machine at once
+    #    'dma',        # rp2.DMA channel used for bulk output, or None
+    #    'out_buffers',# pair of array.array('I') the bulk output alternates between
+    #    'ready_at',   # ticks_us after which the previous frame has clocked out and latched
+    # ]
+
+    def __init__(self, first, num_leds, state_machine, pin, W_in_mode, delay=0.0001, bulk=True):
+        """
+        Constructor of one physical led-strip of a Neopixel
+
+        :param first: index of the first logical pixel on this segment
+        :param num_leds: number of leds on this segment
+        :param state_machine: id of PIO state machine used
+        :param pin: pin on which data line to this segment is connected
+        :param W_in_mode: bool: the leds are RGBW
+        :param delay: [default: 0.0001] delay used for latching of leds when sending data
+        :param bulk: [default: True] send the whole segment in one transfer (DMA when available)
+        """
+        self.first = first
+        self.num_leds = num_leds
+        if W_in_mode:
+            # RGBW uses different PIO state machine configuration
+            self.sm = rp2.StateMachine(state_machine, sk6812, freq=8000000, sideset_base=Pin(pin))
+            self.cut = 0
+        else:
+            self.sm = rp2.StateMachine(state_machine, ws2812, freq=8000000, sideset_base=Pin(pin))
+            # If mode is RGB, we cut 8 bits of, otherwise we keep all 32
+            self.cut = 8
+        self.sm.active(1)
+        self.delay = delay
+        # Time it takes to clock out one pixel: every bit is 10 PIO cycles at 8MHz (1.25us)
+        self.word_us = (32 if W_in_mode else 24) * 10 // 8
+        self.bulk = bulk
+        self.dma = None
+        self.out_buffers = None
+        self.out_index = 0
+        self.ready_at = time.ticks_us()
+        if bulk:
+            # Two output buffers: one may still be clocking out while the other receives the next frame
+            self.out_buffers = (array.array("I", [0] * num_leds), array.array("I", [0] * num_leds))
+            # DMA can't shift words like sm.put does, so only RGBW (no cut) frames can use it
+            if W_in_mode and hasattr(rp2, "DMA"):
+                self.dma = rp2.DMA()
+                # DREQ of the TX FIFO: state machines 0-3 are on PIO0 (DREQ 0-3), 4-7 on PIO1 (DREQ 8-11)
+                dreq = (state_machine // 4) * 8 + state_machine % 4
+                self.dma_ctrl = self.dma.pack_ctrl(size=2, inc_write=False, treq_sel=dreq)
+
+    def load(self, pixels, count):
+        """
+        Copy this segment's part of the first <count> rendered pixels into the idle output buffer,
+        so drawing into pixels can continue while the frame is clocked out.
+
+        :param pixels: array.array('I') of rendered data of the whole logical strip
+        :param count: Number of logical pixels to send
+        :return: Number of words this segment has to send, 0 if the change ends before this segment
+        """
+        first = self.first
+        n = min(count - first, self.num_leds)
+        if n <= 0:
+            return 0
+        self.out_index ^= 1
+        buf = self.out_buffers[self.out_index]
+        if len(buf) == len(pixels):
+            # The only segment: copy the whole array, which doesn't allocate
+            buf[:] = pixels
+        else:
+            memoryview(buf)[:n] = memoryview(pixels)[first:first + n]
+        return n
+
+    def put_words(self, pixels, count):
+        """
+        Put this segment's part of the first <count> rendered pixels into the state machine one by one.
+
+        :param pixels: array.array('I') of rendered data of the whole logical strip
+        :param count: Number of logical pixels to send
+        :return: None
+        """
+        first = self.first
+        n = min(count - first, self.num_leds)
+        if n <= 0:
+            return
+        sm_put = self.sm.put
+        cut = self.cut
+        for pixval in memoryview(pixels)[first:first + n]:
+            sm_put(pixval, cut)
+        self.ready_at = time.ticks_add(time.ticks_us(), 8 * self.word_us + int(self.delay * 1000000))
+
+    def busy_us(self):
+        """
+        Time until the previous frame has been clocked out and latched.
+
+        :return: Remaining microseconds, 0 if the segment is ready for a new frame
+        """
+        remaining = time.ticks_diff(self.ready_at, time.ticks_us())
+        if remaining < 0:
+            return 0
+        return remaining
+
+    def wait_ready(self):
+        """
+        Block until the previous frame has been clocked out and the latch time has passed.
+
+        :return: None
+        """
+        remaining = self.busy_us()
+        if remaining > 0:
+            time.sleep_us(remaining)
+
+    async def wait_ready_async(self):
+        """
+        Yield until the previous frame has been clocked out of the FIFO and the latch time has passed.
+
+        :return: None
+        """
+        remaining = self.busy_us()
+        if remaining >= 1000:
+            await asyncio.sleep_ms(remaining // 1000)
+        # The estimate may be early: keep yielding while the DMA or the FIFO still has data
+        while (self.dma is not None and self.dma.active()) or self.sm.tx_fifo():
+            await asyncio.sleep_ms(0)
+        # Whatever is left is a fraction of a millisecond of latch time
+        remaining = self.busy_us()
+        if remaining > 0:
+            time.sleep_us(remaining)
+
+    def start_transfer(self, count):
+        """
+        Hand the first <count> words of the last loaded output buffer to the state machine in one go.
+        With DMA this returns immediately, otherwise it returns once the last words are in the TX FIFO.
+
+        :param count: Number of words to send
+        :return: None
+        """
+        buf = self.out_buffers[self.out_index]
+        now = time.ticks_us()
+        latch_us = int(self.delay * 1000000)
+        if self.dma is not None:
+            self.dma.config(read=buf, write=self.sm, count=count, ctrl=self.dma_ctrl, trigger=True)
+            self.ready_at = time.ticks_add(now, count * self.word_us + latch_us)
+        else:
+            self.sm.put(buf if count == len(buf) else memoryview(buf)[:count], self.cut)
+            # put returns when the words are in the FIFO; at most the FIFO depth of 8 is left to clock out
+            self.ready_at = time.ticks_add(time.ticks_us(), min(count, 8) * self.word_us + latch_us)
+
+
+# Delay here is the reset time. You need a pause to reset the LED strip back to the initial LED
+# however, if you have quite a bit of processing to do before the next time you update the strip
+# you could put in delay=0 (or a lower delay)
+#
+# Class supports different order of individual colors (GRB, RGB, WRGB, GWRB ...). In order to achieve
+# this, we need to flip the indexes: in 'RGBW', 'R' is on index 0, but we need to shift it left by 3 * 8bits,
+# so in it's inverse, 'WBGR', it has exactly right index. Since micropython doesn't have [::-1] and recursive rev()
+# isn't too efficient we simply do that by XORing (operator ^) each index with 3 (0b11) to make this flip.
+# When dealing with just 'RGB' (3 letter string), this means same but reduced by 1 after XOR!.
+# Example: in 'GRBW' we want final form of 0bGGRRBBWW, meaning G with index 0 needs to be shifted 3 * 8bit ->
+# 'G' on index 0: 0b00 ^ 0b11 -> 0b11 (3), just as we wanted.
+# Same hold for every other index (and - 1 at the end for 3 letter strings).
+#
+# Drawing happens in the FrameBuffer part. show() runs a single pass over the changed pixels that applies
+# the global brightness, the per-pixel brightness mask and gamma (all folded into lookup tables), the color
+# order and packing, writing the result into 'pixels', the output buffer.
+# show() then hands the rendered pixels to the segments: physical strips, each on its own pin and state machine,
+# that together make up the logical strip. Each segment has its own output buffers and DMA channel, so with DMA
+# all segments clock out their part of the frame at the same time.
+
+class Neopixel(FrameBuffer):
+    # Micropython doesn't implement __slots__, but it's good to have a place
+    # to describe the data members...
+    # __slots__ = [
+    #    'num_leds',   # number of LEDs
+    #    'pixels',     # array.array('I') of raw data for LEDs, rendered from 'frame' by show()
+    #    'mode',       # mode 'RGB' etc
+    #    'W_in_mode',  # bool: is 'W' in mode
+    #    'segments',   # list of NeopixelSegment the logical strip is split into
+    #    'sm',         # state machine of the first segment
+    #    'dma',        # rp2.DMA channel of the first segment, or None
+    #    'shift',      # shift amount for each component, in a tuple for (R,B,G,W)
+    #    'delay',      # delay amount
+    #    'brightnessvalue', # brightness scale factor 1..255
+    #    'bulk',       # bool: hand the whole frame to the state machines at once
+    #    'frames_sent',    # number of show() calls that transferred data
+    #    'frames_skipped', # number of show() calls skipped because nothing changed
+    #    'gamma_table',# bytearray mapping channel value to gamma corrected value, or None
+    #    'lut',        # lookup table for the global brightness: R, G, B, W tables of 256 words each in one array
+    #    'luts',       # cache of lookup tables by brightness
+    # ]
+
+    def __init__(self, num_leds, state_machine, pin, mode="RGB", delay=0.0001, bulk=True, gamma=None):
+        """
+        Constructor for library class
+
+        :param num_leds:  number of leds on your led-strip
+        :param state_machine: id of PIO state machine used
+        :param pin: pin on which data line to led-strip is connected
+        :param mode: [default: "RGB"] mode and order of bits representing the color value.
+        This can be any order of RGB or RGBW (neopixels are usually GRB)
+        :param delay: [default: 0.0001] delay used for latching of leds when sending data
+        :param bulk: [default: True] send the whole frame in one transfer (DMA when available)
+        and double-buffer it, instead of putting every pixel separately and sleeping for the latch
+        :param gamma: [default: None] exponent of the perceptual gamma curve applied to every channel (e.g. 2.2).
+        If None, channel values are used linearly
+        """
+        self.init_strip(((state_machine, pin, num_leds),), mode, delay, bulk, gamma)
+
+    def init_strip(self, segments, mode, delay, bulk, gamma):
+        """
+        Set up the framebuffer and the output of a logical strip made of <segments>.
+
+        :param segments: sequence of (state_machine, pin, num_leds), in logical pixel order
+        :return: None
+        """
+        num_leds = 0
+        for state_machine, pin, segment_leds in segments:
+            num_leds += segment_leds
+        super().__init__(num_leds, 'W' in mode)
+        self.pixels = array.array("I", [0] * num_leds)
+        self.mode = mode
+        if self.W_in_mode:
+            # tuple of values required to shift bit into position (check class desc.)
+            self.shift = ((mode.index('R') ^ 3) * 8, (mode.index('G') ^ 3) * 8,
+                          (mode.index('B') ^ 3) * 8, (mode.index('W') ^ 3) * 8)
+        else:
+            self.shift = (((mode.index('R') ^ 3) - 1) * 8, ((mode.index('G') ^ 3) - 1) * 8,
+                          ((mode.index('B') ^ 3) - 1) * 8, 0)
+        self.segments = []
+        first = 0
+        for state_machine, pin, segment_leds in segments:
+            self.segments.append(NeopixelSegment(first, segment_leds, state_machine, pin, self.W_in_mode, delay, bulk))
+            first += segment_leds
+        self.sm = self.segments[0].sm
+        self.dma = self.segments[0].dma
+        self.delay = delay
+        self.brightnessvalue = 255
+        self.bulk = bulk
+        self.frames_sent = 0
+        self.frames_skipped = 0
+        self.words_sent = 0
+        self.luts = {}
+        self.lut_order = []
+        self.set_gamma(gamma)
+        self.render_params = array.array("i", [0] * 3)
+
+    def brightness(self, brightness=None):
+        """
+        Set the overall value to adjust brightness when updating leds
+        or return class brightnessvalue if brightness is None.
+        The lookup table of the new level is built (or taken from the cache) right away, and every pixel
+        is re-sent with it on the next show().
+
+        :param brightness: [default: None] Value of brightness on interval 1..255
+        :return: class brightnessvalue member or None
+        """
+        if brightness is None:
+            return self.brightnessvalue
+        else:
+            if brightness < 1:
+                brightness = 1
+        if brightness > 255:
+            brightness = 255
+        if brightness != self.brightnessvalue:
+            self.brightnessvalue = brightness
+            self.lut = self.get_lut(brightness)
+            self.dirty_end = self.num_leds
+
+    def set_gamma(self, gamma=None):
+        """
+        Set the gamma curve folded into the brightness lookup tables. The cached tables are dropped and the
+        current brightness level's table is rebuilt right away; the pixels are re-sent on the next show().
+
+        :param gamma: [default: None] Exponent of the curve, e.g. 2.2. If None, channel values are used linearly
+        :return: None
+        """
+        if gamma is None:
+            self.gamma_table = None
+        else:
+            self.gamma_table = bytearray(round(255 * (c / 255) ** gamma) for c in range(256))
+        self.luts = {}
+        self.lut_order = []
+        self.lut = self.get_lut(self.brightnessvalue)
+        self.dirty_end = self.num_leds
+
+    def get_lut(self, how_bright):
+        """
+        Lookup table for brightness <how_bright>: four tables (R, G, B, W) of 256 words, one after another in
+        a single array, mapping a channel value 0..255 to its gamma corrected, scaled and shifted part of the
+        pixel word. Tables are built on first use and the last LUT_CACHE_SIZE brightness levels are kept.
+
+        :param how_bright: Brightness on interval 0..255
+        :return: array.array('I') of 1024 words
+        """
+        lut = self.luts.get(how_bright)
+        if lut is not None:
+            return lut
+        if len(self.lut_order) >= LUT_CACHE_SIZE:
+            del self.luts[self.lut_order.pop(0)]
+        gamma_table = self.gamma_table
+        # Channel value scaled by brightness and rounded half up, in integers only
+        scaled = [0] * 256
+        for c in range(256):
+            if gamma_table is not None:
+                c_in = gamma_table[c]
+            else:
+                c_in = c
+            scaled[c] = (2 * c_in * how_bright + 255) // 510
+        sh_R, sh_G, sh_B, sh_W = self.shift
+        lut = array.array("I", [v << sh_R for v in scaled])
+        lut.extend(array.array("I", [v << sh_G for v in scaled]))
+        lut.extend(array.array("I", [v << sh_B for v in scaled]))
+        # In RGB mode the white channel is dropped
+        if self.W_in_mode:
+            lut.extend(array.array("I", [v << sh_W for v in scaled]))
+        else:
+            lut.extend(array.array("I", [0] * 256))
+        self.luts[how_bright] = lut
+        self.lut_order.append(how_bright)
+        return lut
+
+    def render(self, count):
+        """
+        Convert the first <count> pixels of the framebuffer into strip data in 'pixels', applying brightness,
+        brightness mask, gamma and color order.
+
+        :param count: Number of pixels to render
+        :return: None
+        """
+        # Every pixel goes through the global brightness LUT: one kernel call, two where the ring wraps
+        params = self.render_params
+        first = min(count, self.num_leds - self.offset)
+        params[0] = 0
+        params[1] = self.offset
+        params[2] = first
+        render_words(self.pixels, self.frame, self.lut, params)
+        if first < count:
+            params[0] = first
+            params[1] = 0
+            params[2] = count - first
+            render_words(self.pixels, self.frame, self.lut, params)
+        # The brightness mask then scales the strip words of its pixels, whatever the number of mask levels
+        if self.masked:
+            mask_words(self.pixels, self.mask, count)
+
+    def show(self):
+        """
+        Send data to led-strip, making all changes on leds have an effect.
+        This method should be used after every method that changes the state of leds or after a chain of changes.
+        Only the pixels up to the last changed one are sent, and nothing at all if no pixel changed.
+        :return: None
+        """
+        count = self.take_dirty()
+        if count == 0:
+            return
+        self.render(count)
+        pixels = self.pixels
+        if not self.bulk:
+            for segment in self.segments:
+                segment.put_words(pixels, count)
+            time.sleep(self.delay)
+            return
+        # With DMA start_transfer returns at once, so every segment is clocking out before the last one starts.
+        # Without DMA the puts block, and the segments are sent one after another.
+        for segment in self.segments:
+            n = segment.load(pixels, count)
+            if n:
+                segment.wait_ready()
+                segment.start_transfer(n)
+
+    async def show_async(self):
+        """
+        Same as show(), but yields to other tasks instead of blocking while the previous frame is
+        clocked out and latched. Use this from coroutines.
+        :return: None
+        """
+        count = self.take_dirty()
+        if count == 0:
+            return
+        self.render(count)
+        pixels = self.pixels
+        if not self.bulk:
+            await self.wait_ready_async()
+            for segment in self.segments:
+                segment.put_words(pixels, count)
+            return
+        for segment in self.segments:
+            n = segment.load(pixels, count)
+            if n:
+                await segment.wait_ready_async()
+                # Without DMA the frame has to be put in one go: yielding halfway could let the FIFO run dry
+                # for longer than the latch time, which would show a partial frame.
+                segment.start_transfer(n)
+
+    def take_dirty(self):
+        """
+        Return how many pixels have to be sent for the next frame and reset the dirty range.
+        Updates the frames_sent / frames_skipped counters.
+
+        :return: Number of pixels to send, 0 if the frame can be skipped
+        """
+        count = self.dirty_end
+        if count == 0:
+            self.frames_skipped += 1
+            return 0
+        self.dirty_end = 0
+        self.frames_sent += 1
+        self.words_sent += count
+        return count
+
+    async def wait_ready_async(self):
+        """
+        Yield until the previous frame has been clocked out and latched on every segment.
+
+        :return: None
+        """
+        for segment in self.segments:
+            await segment.wait_ready_async()
+
+    def busy_us(self):
+        """
+        Time until the previous frame has been clocked out and latched on every segment.
+
+        :return: Remaining microseconds, 0 if the strip is ready for a new frame
+        """
+        remaining = 0
+        for segment in self.segments:
+            remaining = max(remaining, segment.busy_us())
+        return remaining
+
+    def wait_ready(self):
+        """
+        Block until the previous frame has been clocked out and the latch time has passed on every segment.
+
+        :return: None
+        """
+        remaining = self.busy_us()
+        if remaining > 0:
+            time.sleep_us(remaining)
+
+
+class SegmentedNeopixel(Neopixel):
+    """
+    One logical strip of pixels 0..num_leds-1 driven through several physical strips, each on its own pin and
+    PIO state machine. Pixel indices run through the segments in the order they are given, so drawing works
+    exactly as on a Neopixel, while the segments clock out concurrently and a frame takes as long as the
+    longest segment instead of the whole strip.
+    """
+
+    def __init__(self, segments, mode="RGB", delay=0.0001, bulk=True, gamma=None):
+        """
+        :param segments: sequence of (state_machine, pin, num_leds) tuples, one per physical strip,
+        in logical pixel order. State machines 0-7 can be used
+        :param mode: [default: "RGB"] mode and order of bits representing the color value, the same for every segment
+        :param delay: [default: 0.0001] delay used for latching of leds when sending data
+        :param bulk: [default: True] send every segment in one transfer (DMA when available)
+        :param gamma: [default: None] exponent of the perceptual gamma curve applied to every channel (e.g. 2.2)
+        """
+        self.init_strip(segments, mode, delay, bulk, gamma)
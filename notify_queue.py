@@ -0,0 +1,128 @@
+# Outbound notifications, batched. Events are queued as packed records and sent as one notification per
+# connection interval, holding as many records as fit in the MTU, so bursts don't need one notification each.
+#
+# A notification is a sequence of RECORD: kind, source (button or sensor index), sequence number, ticks_ms and a
+# value. Every event gets the next sequence number when it is queued, also those dropped later on, so the app can
+# tell from a gap in the numbers that events went missing.
+import struct
+import time
+import uasyncio as asyncio
+
+RECORD = "<BBHIh"
+RECORD_SIZE = struct.calcsize(RECORD)
+
+KIND_BUTTON = 1
+KIND_TEMPERATURE = 2
+
+# When the queue is full: drop the oldest event, or (for tasks using put_async) wait for room
+DROP_OLDEST = 0
+BACK_PRESSURE = 1
+
+# ATT payload of the default MTU of 23
+_DEFAULT_PAYLOAD = 20
+
+
+class NotificationQueue:
+    def __init__(self, characteristic, depth=32, interval_ms=30, policy=DROP_OLDEST):
+        self.characteristic = characteristic
+        self.depth = depth
+        self.interval_ms = interval_ms
+        self.policy = policy
+        self.records = bytearray(depth * RECORD_SIZE)
+        self.packet = bytearray(depth * RECORD_SIZE)
+        self.head = 0
+        self.count = 0
+        self.seq = 0
+        # put() is called from micropython.schedule callbacks too, which must not touch the event loop directly
+        self.ready = asyncio.ThreadSafeFlag() if hasattr(asyncio, "ThreadSafeFlag") else asyncio.Event()
+        self.room = asyncio.Event()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.queued = 0
+        self.sent = 0
+        self.notifications = 0
+        self.dropped = 0
+        self.stalls = 0
+        self.max_depth = 0
+
+    def stats(self):
+        return {
+            "depth": self.count,
+            "max_depth": self.max_depth,
+            "queued": self.queued,
+            "sent": self.sent,
+            "notifications": self.notifications,
+            "dropped": self.dropped,
+            "stalls": self.stalls,
+        }
+
+    def clear(self):
+        self.head = 0
+        self.count = 0
+
+    def put(self, kind, source, value):
+        # Queue an event without waiting. Returns False if the queue was full and an event was dropped:
+        # the oldest one, or with BACK_PRESSURE this one.
+        full = self.count == self.depth
+        if full:
+            self.dropped += 1
+            if self.policy == BACK_PRESSURE:
+                self.seq = (self.seq + 1) & 0xFFFF
+                return False
+            self.head = (self.head + 1) % self.depth
+            self.count -= 1
+        slot = (self.head + self.count) % self.depth
+        value = max(-32768, min(32767, value))
+        struct.pack_into(RECORD, self.records, slot * RECORD_SIZE, kind, source, self.seq, time.ticks_ms() & 0xFFFFFFFF,
+                         value)
+        self.seq = (self.seq + 1) & 0xFFFF
+        self.count += 1
+        self.queued += 1
+        self.max_depth = max(self.max_depth, self.count)
+        self.ready.set()
+        return not full
+
+    async def put_async(self, kind, source, value):
+        # Queue an event, with BACK_PRESSURE waiting until there is room for it
+        while self.policy == BACK_PRESSURE and self.count == self.depth:
+            self.room.clear()
+            await self.room.wait()
+        return self.put(kind, source, value)
+
+    def send(self, connection):
+        # Notify the oldest records that fit in one notification. Returns the number sent, 0 if the central
+        # can't take it now.
+        payload = (getattr(connection, "mtu", None) or _DEFAULT_PAYLOAD + 3) - 3
+        n = min(self.count, max(1, payload // RECORD_SIZE))
+        packet = self.packet
+        records = self.records
+        # Copy out of the ring, in two parts where it wraps
+        first = min(n, self.depth - self.head)
+        start = self.head * RECORD_SIZE
+        packet[:first * RECORD_SIZE] = records[start:start + first * RECORD_SIZE]
+        if n > first:
+            packet[first * RECORD_SIZE:n * RECORD_SIZE] = records[:(n - first) * RECORD_SIZE]
+        try:
+            self.characteristic.notify(connection, memoryview(packet)[:n * RECORD_SIZE])
+        except OSError:
+            # Out of buffers: the central is behind
+            self.stalls += 1
+            return 0
+        self.head = (self.head + n) % self.depth
+        self.count -= n
+        self.sent += n
+        self.notifications += 1
+        self.room.set()
+        return n
+
+    async def run(self, connection):
+        # Send queued events to <connection>, at most one notification per interval_ms. Runs until cancelled.
+        while True:
+            await self.ready.wait()
+            # A ThreadSafeFlag clears itself in wait(), an Event doesn't
+            if isinstance(self.ready, asyncio.Event):
+                self.ready.clear()
+            while self.count:
+                self.send(connection)
+                await asyncio.sleep_ms(self.interval_ms)
@@ -0,0 +1,504 @@
+# What every pattern builds on: the render context shared by all patterns, the FrameScheduler that drives them
+# and the interface they implement. main.py needs only this module at boot, the patterns themselves (patterns.py,
+# scene.py) are imported by the registry when their mode is first used.
+from neopixel import SegmentedNeopixel, FrameBuffer, slice_maker
+from transitions import Crossfade
+from zones import ZoneMap
+from keyframes import KeyframeCache
+from kernels import gradient_words, gradient_params
+import array
+import time
+import uasyncio as asyncio
+from color_utils import RGB2RGBW_cached, RGB2RGBW_frame, pack_rgbw, color_from_palette, begin_frame, end_frame, feather_kernel, FEATHER_PHASES
+
+# Physical led-strips as (state machine, pin, number of leds), in the order the board pixel indices run through them.
+# More strips can be added here; patterns keep addressing pixels 0..NUM_PIXELS-1 of the strips chained together.
+LED_SEGMENTS = ((0, 22, 151),)
+
+# Everything that outlives a single pattern: the strip with its state machines, DMA channels, framebuffer,
+# brightness mask and lookup tables, plus a frame sized scratch buffer. main.py creates one at boot and hands it
+# to every pattern, so switching patterns doesn't allocate a strip or claim new state machines and DMA channels.
+class RenderContext:
+    def __init__(self, segments=LED_SEGMENTS, mode="RGBW", zones=None):
+        self.NP = SegmentedNeopixel(segments, mode)
+        self.num_pixels = self.NP.num_leds
+        # Zones of the board, from zones.json unless given
+        if zones is None:
+            zones = ZoneMap.from_file(self.num_pixels)
+        self.zones = zones
+        # For patterns that build a whole frame of packed colors before writing it
+        self.frame = array.array("I", [0] * self.num_pixels)
+        # What the outgoing and the incoming pattern draw into while a transition between them runs
+        self.outgoing = FrameBuffer(self.num_pixels)
+        self.incoming = FrameBuffer(self.num_pixels)
+        # Wakes a FrameScheduler that sleeps because nothing changes on the strip: set by set_pattern() and by
+        # patterns whose frame changed (see invalidate()). invalidate() is called from button callbacks run by
+        # micropython.schedule too, which must not touch the event loop directly.
+        self.redraw = asyncio.ThreadSafeFlag() if hasattr(asyncio, "ThreadSafeFlag") else asyncio.Event()
+
+_default_context = None
+
+# Context used by patterns created without one, made on first use
+def get_default_context():
+    global _default_context
+    if _default_context is None:
+        _default_context = RenderContext()
+    return _default_context
+
+# Runs the active pattern at a fixed frame rate: every frame_ms it calls render(now_ms, fb) on the pattern and
+# shows the result, sleeping only for what is left of the frame. Deadlines advance by whole frames from ticks_ms,
+# so render and show time don't make the rate drift. A frame that starts late is drawn right away to catch up;
+# when one or more whole frames were missed they are dropped, not drawn in a burst.
+#
+# A new pattern starts right away and the transition (a crossfade by default) blends it in over the old one,
+# which keeps running until the transition is over. With transition set to None, the old pattern first gets to
+# finish (e.g. fade out) and then the new one begins.
+#
+# Without a pattern, or with one whose frame doesn't change (see idle()), the scheduler sleeps until the context's
+# redraw event is set. A pattern that raises is dropped, the scheduler keeps running.
+class FrameScheduler:
+    def __init__(self, context, frame_ms=20):
+        self.context = context
+        self.frame_ms = frame_ms
+        self.pattern = None
+        self.next_pattern = None
+        self.transition = Crossfade()
+        # Outgoing pattern and transition while one runs
+        self.previous = None
+        self.active_transition = None
+        self.transition_start = 0
+        self.running = False
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.frames = 0
+        self.dropped = 0
+        self.late = 0
+        self.frame_us_total = 0
+        self.frame_us_max = 0
+        self.jitter_ms_total = 0
+        self.jitter_ms_max = 0
+
+    def stats(self):
+        # Frame time is render + show, jitter is how late a frame started after its deadline
+        frames = max(1, self.frames)
+        return {
+            "frames": self.frames,
+            "dropped": self.dropped,
+            "late": self.late,
+            "frame_ms_avg": self.frame_us_total / frames / 1000,
+            "frame_ms_max": self.frame_us_max / 1000,
+            "jitter_ms_avg": self.jitter_ms_total / frames,
+            "jitter_ms_max": self.jitter_ms_max,
+        }
+
+    def set_pattern(self, pattern, transition=None):
+        # transition: Crossfade, Wipe or Dissolve from transitions.py. If None, the scheduler's transition is used.
+        if pattern is self.pattern:
+            return
+        if transition is None:
+            transition = self.transition
+        now = time.ticks_ms()
+        self.context.redraw.set()
+        if transition is None:
+            if self.pattern is None:
+                pattern.begin(now)
+                self.pattern = pattern
+                return
+            if self.next_pattern is None:
+                self.pattern.finish(now)
+            self.next_pattern = pattern
+            return
+        context = self.context
+        # Both sides start from what is on the strip now, for patterns that draw over their previous frame.
+        # Without an active pattern, what is on the strip is faded out.
+        shown = context.NP.logical_frame()
+        context.outgoing.write_frame(shown)
+        context.incoming.write_frame(shown)
+        if self.previous is not None and self.previous is not pattern:
+            # A transition was still running: its outgoing pattern is gone now
+            self.previous.release()
+        self.previous = self.pattern
+        self.next_pattern = None
+        self.pattern = pattern
+        self.active_transition = transition
+        self.transition_start = now
+        pattern.begin(now)
+
+    def render_transition(self, now_ms):
+        context = self.context
+        transition = self.active_transition
+        amount = transition.amount(max(0, time.ticks_diff(now_ms, self.transition_start)))
+        if self.previous is not None:
+            # A finished outgoing pattern keeps its last frame
+            self.previous.render_frame(now_ms, context.outgoing)
+        running = self.pattern.render_frame(now_ms, context.incoming)
+        out = context.NP.scratch
+        transition.blend(out, context.outgoing.logical_frame(), context.incoming.logical_frame(), amount)
+        context.NP.write_frame(out)
+        if amount >= 256:
+            # The strip now shows the incoming frame, the pattern draws straight into it from here on
+            self.active_transition = None
+            if self.previous is not None and self.previous is not self.pattern:
+                self.previous.release()
+            self.previous = None
+            if not running:
+                self.pattern.release()
+                self.pattern = None
+
+    def drop(self):
+        # Forget the active pattern and transition, e.g. after the pattern raised
+        for pattern in (self.pattern, self.previous):
+            if pattern is not None:
+                pattern.release()
+        self.pattern = None
+        self.next_pattern = None
+        self.previous = None
+        self.active_transition = None
+
+    def idle(self):
+        # Nothing will change on the strip until the redraw event
+        pattern = self.pattern
+        return pattern is None or (self.active_transition is None and self.next_pattern is None and pattern.idle())
+
+    def stop(self):
+        self.running = False
+        self.context.redraw.set()
+
+    async def run(self, until_idle=False):
+        # until_idle: return once no pattern is active, instead of waiting for the next one
+        frame_ms = self.frame_ms
+        fb = self.context.NP
+        redraw = self.context.redraw
+        deadline = time.ticks_ms()
+        self.running = True
+        while self.running:
+            # Cleared before drawing, so an invalidate() while drawing isn't missed. A ThreadSafeFlag clears itself
+            # in wait(), a set() since then just costs one more frame.
+            if isinstance(redraw, asyncio.Event):
+                redraw.clear()
+            late = time.ticks_diff(time.ticks_ms(), deadline)
+            if late >= frame_ms:
+                missed = late // frame_ms
+                self.dropped += missed
+                deadline = time.ticks_add(deadline, missed * frame_ms)
+                late -= missed * frame_ms
+            pattern = self.pattern
+            if pattern is not None:
+                start = time.ticks_us()
+                begin_frame(deadline)
+                try:
+                    if self.active_transition is not None:
+                        self.render_transition(deadline)
+                    elif not pattern.render_frame(deadline, fb):
+                        # Done: the last frame stays on the strip until the next pattern draws over it
+                        pattern.release()
+                        self.pattern = self.next_pattern
+                        self.next_pattern = None
+                        if self.pattern is not None:
+                            self.pattern.begin(deadline)
+                except Exception as e:
+                    # One broken pattern mustn't stop the strip: what it drew stays until the next one
+                    print("Error rendering pattern:", e)
+                    self.drop()
+                end_frame()
+                await fb.show_async()
+                frame_us = time.ticks_diff(time.ticks_us(), start)
+                self.frames += 1
+                self.frame_us_total += frame_us
+                self.frame_us_max = max(self.frame_us_max, frame_us)
+                if late > 0:
+                    self.late += 1
+                    self.jitter_ms_total += late
+                    self.jitter_ms_max = max(self.jitter_ms_max, late)
+            elif until_idle:
+                break
+            # Sleep once the active pattern has drawn its unchanging frame (a pattern that just began hasn't yet)
+            if not until_idle and (self.pattern is None or (self.pattern is pattern and self.idle())):
+                await redraw.wait()
+                deadline = time.ticks_ms()
+                continue
+            deadline = time.ticks_add(deadline, frame_ms)
+            remaining = time.ticks_diff(deadline, time.ticks_ms())
+            # Always yield, so other tasks run even when the frames don't keep up
+            await asyncio.sleep_ms(max(0, remaining))
+        self.running = False
+
+class NeopixelConfigurationInterface:
+    def __init__(self, context=None):
+        if context is None:
+            context = get_default_context()
+        self.context = context
+        self.NP = context.NP
+        self.NUM_PIXELS = context.num_pixels
+        self.zones = context.zones
+        # Mask for brightness. 0-255 value for each pixel, applied when the frame is shown.
+        # Change it with self.NP.set_brightness() so the pixels get re-sent.
+        self.brightness_mask = self.NP.mask
+        # Framebuffer the drawing functions below draw into: the strip, or the one given to render()
+        self.fb = self.NP
+        self.start_ms = time.ticks_ms()
+        self.end_ms = None
+        # KeyframeCache of a periodic pattern, see render_periodic()
+        self.keyframes = None
+
+    @staticmethod
+    def from_json(json, context=None):
+        pass
+
+    @staticmethod
+    def from_binary(payload, header, context=None):
+        # Pattern from a binary config (see protocol.py), header being its unpacked header
+        pass
+
+    # Patterns are driven by a FrameScheduler: begin() when the pattern becomes active, then render() once per
+    # frame. finish() asks the pattern to end (e.g. fade out), after which render() returns False once it's done.
+    def begin(self, now_ms):
+        self.start_ms = now_ms
+        self.end_ms = None
+
+    def finish(self, now_ms):
+        self.end_ms = now_ms
+
+    def release(self):
+        # Free the memory the pattern only needs while it is shown, e.g. its keyframes. Called by the scheduler
+        # when the pattern is done and by the registry when it forgets the pattern; begin() starts it again.
+        if self.keyframes is not None:
+            self.keyframes.release()
+
+    def render(self, now_ms, fb):
+        # Draw the frame at time now_ms (ticks_ms) into the framebuffer fb. Return False when the pattern is done.
+        return self.end_ms is None
+
+    def render_frame(self, now_ms, fb):
+        self.fb = fb
+        return self.render(now_ms, fb)
+
+    def idle(self):
+        # True when the frame just drawn stays the same until invalidate() is called: the scheduler then stops
+        # drawing it again every frame
+        return False
+
+    def invalidate(self):
+        # Something the frame depends on changed, e.g. the color of a static pattern: draw it again
+        self.context.redraw.set()
+
+    # Periodic patterns show one of period() frames, picked by phase(now_ms) and drawn by draw_phase(phase).
+    # With use_keyframes() every frame is drawn once and replayed from the cache after that.
+    def period(self):
+        return 1
+
+    def phase(self, now_ms):
+        return 0
+
+    def draw_phase(self, phase):
+        pass
+
+    def use_keyframes(self, budget_bytes):
+        # Opt in to caching up to budget_bytes of frames (0 to turn it off). Returns the pattern, for from_json.
+        self.keyframes = KeyframeCache(budget_bytes) if budget_bytes > 0 else None
+        return self
+
+    def render_periodic(self, now_ms):
+        phase = self.phase(now_ms)
+        cache = self.keyframes
+        if cache is None:
+            self.draw_phase(phase)
+            return
+        cache.prepare(self.period(), self.NUM_PIXELS)
+        frame = cache.get(phase)
+        if frame is not None:
+            self.fb.write_frame(frame)
+            return
+        self.draw_phase(phase)
+        cache.store(phase, self.fb.logical_frame())
+
+    def elapsed(self, now_ms):
+        # Milliseconds since begin()
+        return max(0, time.ticks_diff(now_ms, self.start_ms))
+
+    def ending(self, now_ms):
+        # Milliseconds since finish()
+        return max(0, time.ticks_diff(now_ms, self.end_ms))
+
+    async def setup(self):
+        pass
+
+    async def terminate(self):
+        # Run the ending of the pattern on a scheduler of its own
+        scheduler = FrameScheduler(self.context)
+        scheduler.pattern = self
+        self.finish(time.ticks_ms())
+        await scheduler.run(until_idle=True)
+
+    async def loop(self):
+        # Run the pattern on a scheduler of its own. main.py shares one FrameScheduler between patterns instead.
+        scheduler = FrameScheduler(self.context)
+        scheduler.set_pattern(self)
+        await scheduler.run()
+
+    def fill(self, color):
+        # If tuple has 4 elements, it's RGBW, so no need to convert. If 3, convert to RGBW.
+        if len(color) == 3:
+            color = RGB2RGBW_cached(color[0], color[1], color[2])
+        self.fb.fill(color)
+
+    def set_pixel(self, index, color):
+        index = self.get_board_pixel(index)
+        # If tuple has 4 elements, it's RGBW, so no need to convert. If 3, convert to RGBW.
+        if len(color) == 3:
+            color = RGB2RGBW_cached(color[0], color[1], color[2])
+        self.fb.set_pixel(index, color)
+
+    def set_pixel_line(self, start, end, color):
+        # If tuple has 4 elements, it's RGBW, so no need to convert. If 3, convert to RGBW.
+        if len(color) == 3:
+            color = RGB2RGBW_cached(color[0], color[1], color[2])
+        self.fb.set_pixel_line(start, end, color)
+
+    def set_pixels(self, start, data, with_W=True):
+        # Bulk write consecutive pixels from a buffer of r, g, b(, w) bytes. RGB data is converted to RGBW first.
+        start = self.get_board_pixel(start)
+        if with_W:
+            self.fb.set_pixels(start, data)
+            return
+        scratch = self.fb.scratch
+        count = RGB2RGBW_frame(scratch, data)
+        self.fb.write_frame(memoryview(scratch)[:count], start)
+
+    def write_frame(self, packed, start=0):
+        # Copy precomputed packed RGBW pixels (array.array('I') or a memoryview slice of one) into the strip.
+        self.fb.write_frame(packed, self.get_board_pixel(start))
+
+    def fill_palette(self, palette, start_index=0, brightness=255):
+        # Spread an expanded palette (see color_utils.get_palette) over the whole strip, starting at start_index.
+        scratch = self.fb.scratch
+        num_pixels = self.NUM_PIXELS
+        if brightness == 255:
+            for i in range(num_pixels):
+                scratch[i] = palette[(start_index + (i << 8) // num_pixels) & 255]
+        else:
+            for i in range(num_pixels):
+                scratch[i] = color_from_palette(palette, start_index + (i << 8) // num_pixels, brightness)
+        self.fb.write_frame(memoryview(scratch)[:num_pixels])
+
+    # Zone drawing: zone is a name from zones.json. Each call handles the zone's pixels in one or two runs.
+    def fill_zone(self, zone, color):
+        if len(color) == 3:
+            color = RGB2RGBW_cached(color[0], color[1], color[2])
+        for start, stop in self.zones.spans[zone]:
+            self.fb.set_pixel_line(start, stop - 1, color)
+
+    def write_zone(self, zone, packed):
+        # Copy packed RGBW pixels (one per pixel of the zone, in zone order) into the zone
+        offset = 0
+        packed = memoryview(packed)
+        for start, stop in self.zones.spans[zone]:
+            self.fb.write_frame(packed[offset:offset + stop - start], start)
+            offset += stop - start
+
+    def gradient_zone(self, zone, color1, color2):
+        # Gradient from color1 at the start of the zone to color2 at its end
+        if len(color1) == 3:
+            color1 = RGB2RGBW_cached(color1[0], color1[1], color1[2])
+        if len(color2) == 3:
+            color2 = RGB2RGBW_cached(color2[0], color2[1], color2[2])
+        size = self.zones.size(zone)
+        scratch = self.fb.scratch
+        params = gradient_params(self.fb.gradient_params, pack_rgbw(color1), pack_rgbw(color2), max(1, size - 1))
+        gradient_words(memoryview(scratch)[:size], params)
+        self.write_zone(zone, scratch)
+
+    def palette_zone(self, zone, palette, start_index=0, brightness=255):
+        # Spread an expanded palette over the zone, starting at start_index
+        size = self.zones.size(zone)
+        scratch = self.fb.scratch
+        if brightness == 255:
+            for i in range(size):
+                scratch[i] = palette[(start_index + (i << 8) // size) & 255]
+        else:
+            for i in range(size):
+                scratch[i] = color_from_palette(palette, start_index + (i << 8) // size, brightness)
+        self.write_zone(zone, scratch)
+
+    def set_zone_brightness(self, zone, how_bright):
+        # Brightness mask of the zone on the strip itself: it stays until changed, also across patterns
+        for start, stop in self.zones.spans[zone]:
+            self.NP.set_brightness(slice_maker[start:stop], how_bright)
+
+    def get_board_pixel(self, index):
+        # If index exceeds the number of pixels, return the remainder pixel from the start. If negative, return the remainder pixel from the end.
+        if index >= self.NUM_PIXELS:
+            index = index % self.NUM_PIXELS
+        elif index < 0:
+            index = self.NUM_PIXELS - (abs(index) % self.NUM_PIXELS)
+        return index
+
+    def get_board_pixel_range(self, i1, i2, clockwise=True):
+        # Get corrected range
+        if clockwise:
+            # If the second value is less than the first, add the number of pixels to the second value.
+            if i2 < i1:
+                return range(i1, i2 + self.NUM_PIXELS)
+            else:
+                return range(i1, i2)
+        else:
+            # If the first value is less than the second, add the number of pixels to the first value.
+            if i1 < i2:
+                return range(i1 + self.NUM_PIXELS, i2, -1)
+            else:
+                return range(i1, i2, -1)
+
+    def get_pixel_color(self, index):
+        color = self.fb.get_pixel(self.get_board_pixel(index))
+        # Convert to RGB
+        return (color[0], color[1], color[2])
+
+    # Draw a line of pixels from start to end (inclusive) with feathered edges of <feather> pixels.
+    def set_feather_pixel_line(self, start, end, color, feather):
+        self.draw_line(start << 8, (end - start + 1) << 8, color, feather)
+
+    # Antialiased line of <length> pixels starting at <position>, both in 1/256ths of a pixel so lines can move
+    # smoothly. The ends are blended into the frame with the feather kernels, and the line wraps around the board.
+    def draw_line(self, position, length, color, feather=0):
+        if length <= 0:
+            return
+        if len(color) == 3:
+            color = RGB2RGBW_cached(color[0], color[1], color[2])
+        packed = pack_rgbw(color)
+        fb = self.fb
+        kernel = feather_kernel(feather)
+        width = feather + 2
+        end = position + length
+        first = position >> 8
+        count = ((end - 1) >> 8) - first + 1
+        # Kernel rows for the sub-pixel phase of both ends
+        lead = ((position & 255) * FEATHER_PHASES >> 8) * width
+        trail = ((-end & 255) * FEATHER_PHASES >> 8) * width
+        # Edge pixels: the first and last <width> pixels, blended with the smaller alpha of both ends
+        solid = count - 2 * width
+        for k in range(2 * width if solid > 0 else count):
+            if solid > 0 and k >= width:
+                k += solid
+            alpha = 255
+            if k < width:
+                alpha = kernel[lead + k]
+            m = count - 1 - k
+            if m < width:
+                alpha = min(alpha, kernel[trail + m])
+            fb.blend_pixel(first + k, packed, alpha)
+        # Solid middle, split where it wraps
+        num_pixels = self.NUM_PIXELS
+        if solid > 0:
+            start = (first + width) % num_pixels
+            if start + solid <= num_pixels:
+                fb.set_pixel_line(start, start + solid - 1, color)
+            else:
+                fb.set_pixel_line(start, num_pixels - 1, color)
+                fb.set_pixel_line(0, start + solid - num_pixels - 1, color)
+
+    def show(self):
+        self.NP.show()
+
+    async def show_async(self):
+        await self.NP.show_async()
@@ -1,11 +1,17 @@
-from neopixel import Neopixel
+# The built-in patterns. The scheduler, render context and pattern interface are in pattern_base.py, and imported
+# from here too for code that expects them in this module.
+from pattern_base import LED_SEGMENTS, RenderContext, get_default_context, FrameScheduler, NeopixelConfigurationInterface
+import protocol
+from kernels import rle_decode, byte_view
 from machine import Pin
+import array
+import struct
 import time
 import uasyncio as asyncio
 from micropython import const
-from color_utils import hsi2rgbw, RGBToRGBW, RGB2RGBW, lerp, random_rgb, wheel, beatsin88, beatsin16, beatsin8, beat16, sin16, scale16, getAverageLightness
+from color_utils import hsi2rgbw, RGBToRGBW, RGB2RGBW, RGB2RGBW_cached, RGB2RGBW_frame, pack_rgbw, unpack_rgbw, get_palette, color_from_palette, lerp, lerp8, random_rgb, wheel, beatsin88, beatsin16, beatsin8, beat16, beat8, sin16, scale16, expand_palette, begin_frame, end_frame, feather_kernel, FEATHER_PHASES, getAverageLightness
 
-# Rough dimensions of the elements on the board
+# Rough dimensions of the elements on the board. zones.json has the same zones for the zone drawing functions.
 _MOUNTAIN_START = const(135)
 _MOUNTAIN_END = const(30)
 _DESERT_START = const(30)
@@ -18,134 +24,46 @@ _JUNGLE_END = const(135)
 _TAVERNA = const(0)
 _DRAGON = const(140)
 _REED = const(70)
-class NeopixelConfigurationInterface:
-    def __init__(self):
-        self.NUM_PIXELS = 151
-        self.NP = Neopixel(self.NUM_PIXELS, 0, 22, "RGBW")
-        # Set up mask for brightness. 0-255 value for each pixel
-        self.brightness_mask = [255] * self.NUM_PIXELS
-
-    @staticmethod
-    def from_json(json):
-        pass
-
-    async def setup(self):
-        pass
-
-    async def terminate(self):
-        pass
-
-    async def loop(self):
-        pass
-
-    def fill(self, color):
-        # If tuple has 4 elements, it's RGBW, so no need to convert. If 3, convert to RGBW.
-        if len(color) == 3:
-            color = RGB2RGBW(color[0], color[1], color[2])
-        self.NP.fill(color)
-
-    def set_pixel(self, index, color):
-        index = self.get_board_pixel(index)
-        # If tuple has 4 elements, it's RGBW, so no need to convert. If 3, convert to RGBW.
-        if len(color) == 3:
-            color = RGB2RGBW(color[0], color[1], color[2])
-        self.NP.set_pixel(index, color, how_bright=self.brightness_mask[index])
-
-    def set_pixel_line(self, start, end, color):
-        # If tuple has 4 elements, it's RGBW, so no need to convert. If 3, convert to RGBW.
-        if len(color) == 3:
-            color = RGB2RGBW(color[0], color[1], color[2])
-        self.NP.set_pixel_line(start, end, color)
-
-    def get_board_pixel(self, index):
-        # If index exceeds the number of pixels, return the remainder pixel from the start. If negative, return the remainder pixel from the end.
-        if index >= self.NUM_PIXELS:
-            index = index % self.NUM_PIXELS
-        elif index < 0:
-            index = self.NUM_PIXELS - (abs(index) % self.NUM_PIXELS)
-        return index
-
-    def get_board_pixel_range(self, i1, i2, clockwise=True):
-        # Get corrected range
-        if clockwise:
-            # If the second value is less than the first, add the number of pixels to the second value.
-            if i2 < i1:
-                return range(i1, i2 + self.NUM_PIXELS)
-            else:
-                return range(i1, i2)
-        else:
-            # If the first value is less than the second, add the number of pixels to the first value.
-            if i1 < i2:
-                return range(i1 + self.NUM_PIXELS, i2, -1)
-            else:
-                return range(i1, i2, -1)
-
-    def get_pixel_color(self, index):
-        color = self.NP.get_pixel(self.get_board_pixel(index))
-        # Convert to RGB
-        return (color[0], color[1], color[2])
-
-    # Draw a line of pixels with a feathered edge.
-    def set_feather_pixel_line(self, start, end, color, feather):
-        # If tuple has 4 elements, it's RGBW, so no need to convert. If 3, convert to RGBW.
-        if len(color) == 3:
-            color = RGB2RGBW(color[0], color[1], color[2])
-        # Draw the solid line first, then the feathered edges.
-        solid_line_start = self.get_board_pixel(start + feather)
-        solid_line_end = self.get_board_pixel(end - feather)
-        self.set_pixel_line(solid_line_start, solid_line_end, color)
-        # Now draw the feathered edges.
-        for i in range(feather):
-            # Draw the left edge.
-            left_edge_pixel_color = self.get_pixel_color(start + i)
-            self.set_pixel(self.get_board_pixel(start + i), lerp(color, left_edge_pixel_color, i / feather))
-            # Draw the right edge.
-            right_edge_pixel_color = self.get_pixel_color(end - i)
-            self.set_pixel(self.get_board_pixel(end - i), lerp(color, right_edge_pixel_color, i / feather))
-
-    def show(self):
-        self.NP.show()
 
 class NeopixelSingleColorConfiguration(NeopixelConfigurationInterface):
-    def __init__(self, color):
+    def __init__(self, color, context=None):
         # If given color is RGB, convert to RGBW.
         if len(color) == 3:
             color = RGB2RGBW(color[0], color[1], color[2])
         self.color = color
-        super().__init__()
+        super().__init__(context)
 
     @staticmethod
-    def from_json(json):
+    def from_json(json, context=None):
         # Check whether the colors are RGB or RGBW.
         if len(json["color"]) == 3:
             return NeopixelSingleColorConfiguration(
-                RGB2RGBW(json["color"][0], json["color"][1], json["color"][2])
+                RGB2RGBW(json["color"][0], json["color"][1], json["color"][2]), context
             )
         else:
             return NeopixelSingleColorConfiguration(
-                (json["color"][0], json["color"][1], json["color"][2], json["color"][3])
+                (json["color"][0], json["color"][1], json["color"][2], json["color"][3]), context
             )
 
-    async def setup(self):
-        # Lerp to the color over 1 second.
-        for i in range(100):
-            self.fill(lerp((0, 0, 0, 0), self.color, i / 100))
-            self.NP.show()
-            await asyncio.sleep_ms(10)
-
-    async def loop(self):
-        # Just keep the color on.
-        while True:
+    @staticmethod
+    def from_binary(payload, header, context=None):
+        if header[protocol.F_STOPS] < 1:
+            raise ValueError("A solid color needs a color stop")
+        return NeopixelSingleColorConfiguration(protocol.color(payload, header, 0), context)
+
+    def render(self, now_ms, fb):
+        # Fading in is done by the scheduler's transition. Once finished, lerp to black over 1 second.
+        if self.end_ms is None:
+            # The color is drawn every frame, so live changes to it show right away
             self.fill(self.color)
-            self.NP.show()
-            await asyncio.sleep_ms(1000)
-    
-    async def terminate(self):
-        # Lerp to black over 1 second.
-        for i in range(100):
-            self.fill(lerp(self.color, (0, 0, 0, 0), i / 100))
-            self.NP.show()
-            await asyncio.sleep_ms(10)
+            return True
+        level = 255 - min(255, self.ending(now_ms) * 255 // 1000)
+        self.fill(lerp8((0, 0, 0, 0), self.color, level))
+        return level > 0
+
+    def idle(self):
+        # Until it fades out, the color only changes through increase_color_for_channel()
+        return self.end_ms is None
 
     # ? Live modification functions (Mainly for static color modification with physical buttons)
     def increase_color_for_channel(self, channel, amount):
@@ -153,101 +71,345 @@ class NeopixelSingleColorConfiguration(NeopixelConfigurationInterface):
         self.color = list(self.color)
         self.color[channel] = (self.color[channel] + amount) % 256
         self.color = tuple(self.color)
+        self.invalidate()
 
 class NeopixelGradientPulseConfiguration(NeopixelConfigurationInterface):
-    def __init__(self, color1, color2, steps=50, wait_ms=50):
+    # With a palette (a name, or an expanded palette), the pulse walks through the palette instead of between
+    # color1 and color2.
+    def __init__(self, color1, color2, steps=50, wait_ms=50, palette=None, context=None):
+        if steps < 1 or wait_ms < 1:
+            raise ValueError("A pulse needs steps and wait_ms of at least 1")
         self.color1 = color1
         self.color2 = color2
         self.steps = steps
         self.wait_ms = wait_ms
-        super().__init__()
+        self.palette = None
+        if palette is not None:
+            self.palette = get_palette(palette) if type(palette) is str else palette
+            self.color1 = unpack_rgbw(self.palette[0])
+        super().__init__(context)
 
     @staticmethod
-    def from_json(json):
+    def from_json(json, context=None):
+        # The colors may be left out when a palette is given
+        c1 = json.get("c1", (0, 0, 0))
+        c2 = json.get("c2", (0, 0, 0))
         return NeopixelGradientPulseConfiguration(
-            (json["c1"][0], json["c1"][1], json["c1"][2]),
-            (json["c2"][0], json["c2"][1], json["c2"][2]),
+            (c1[0], c1[1], c1[2]),
+            (c2[0], c2[1], c2[2]),
             json["steps"],
             json["wait_ms"],
-        )
-
-    async def setup(self):
-        self.fill(self.color1)
-        self.NP.show()
-        await asyncio.sleep_ms(1)
-
-    async def terminate(self):
-        self.fill((0, 0, 0, 0))
-        self.NP.show()
-        await asyncio.sleep_ms(1)
-
-    async def loop(self):
-        # Color shift the fill to the other color, one step at a time. After the last step, start over.
-        while True:
-            for i in range(self.steps):
-                self.fill(lerp(self.color1, self.color2, i / self.steps))
-                self.NP.show()
-                await asyncio.sleep_ms(self.wait_ms)
-            for i in range(self.steps):
-                self.fill(lerp(self.color2, self.color1, i / self.steps))
-                self.NP.show()
-                await asyncio.sleep_ms(self.wait_ms)
+            json.get("palette"),
+            context,
+        ).use_keyframes(json.get("cache_kb", 0) * 1024)
+
+    @staticmethod
+    def from_binary(payload, header, context=None):
+        # Two stops are the colors, more make a palette
+        if header[protocol.F_STOPS] < 2:
+            raise ValueError("A pulse needs two color stops")
+        palette = None
+        if header[protocol.F_STOPS] > 2:
+            palette = expand_palette(protocol.palette_stops(payload, header))
+        return NeopixelGradientPulseConfiguration(
+            protocol.color(payload, header, 0),
+            protocol.color(payload, header, 1),
+            header[protocol.F_STEPS],
+            header[protocol.F_WAIT_MS],
+            palette,
+            context,
+        ).use_keyframes(header[protocol.F_CACHE_KB] * 1024)
+
+    def render(self, now_ms, fb):
+        if self.end_ms is not None:
+            self.fill((0, 0, 0, 0))
+            return False
+        self.render_periodic(now_ms)
+        return True
+
+    # Color shift the fill to the other color in <steps> steps of wait_ms, then back. After that, start over.
+    def period(self):
+        return 2 * self.steps
+
+    def phase(self, now_ms):
+        return (self.elapsed(now_ms) // self.wait_ms) % (2 * self.steps)
+
+    def draw_phase(self, phase):
+        steps = self.steps
+        if phase < steps:
+            self.fill(self.pulse_color(phase * 255 // steps))
+        else:
+            self.fill(self.pulse_color(255 - (phase - steps) * 255 // steps))
+
+    def pulse_color(self, amount):
+        # Color at amount 0..255 of the way from color1 to color2, or along the palette
+        if self.palette is not None:
+            return unpack_rgbw(self.palette[amount])
+        return lerp8(self.color1, self.color2, amount)
 
 class Rainbow(NeopixelConfigurationInterface):
-    def __init__(self, wait_ms=50):
+    # Packed RGBW color of every wheel position, shared by all instances and built on first use.
+    wheel_table = None
+
+    def __init__(self, wait_ms=50, palette=None, context=None):
+        if wait_ms < 1:
+            raise ValueError("A rainbow needs wait_ms of at least 1")
         self.wait_ms = wait_ms
-        super().__init__()
+        super().__init__(context)
+        if palette is not None:
+            # Any palette (a name, or an expanded palette) can be cycled around the board instead of the color wheel
+            self.wheel_table = get_palette(palette) if type(palette) is str else palette
+        elif Rainbow.wheel_table is None:
+            Rainbow.wheel_table = array.array("I", [pack_rgbw(RGB2RGBW(*wheel(k))) for k in range(256)])
+        # Position of every pixel on the wheel. The frame is built in the context's frame buffer.
+        self.hues = bytearray((i * 255) // self.NUM_PIXELS for i in range(self.NUM_PIXELS))
+        self.frame = self.context.frame
 
     @staticmethod
-    def from_json(json):
-        return Rainbow(json["wait_ms"])
-
-    async def setup(self):
-        # Fill with black
-        self.fill((0, 0, 0, 0))
-
-    async def terminate(self):
-        # Lerp to black over 1 second.
-        self.fill((0, 0, 0, 0))
-        return
-        for i in range(100):
-            for i in range(self.NUM_PIXELS):
-                self.set_pixel(i, lerp(self.get_pixel_color(i), (0, 0, 0, 0), i / 100))
-            self.show()
-            await asyncio.sleep_ms(10)
-
-    async def loop(self):
-        # Color shift the fill to the other color, one step at a time. After the last step, start over.
-        j = 0
-        while True:
-            for i in range(self.NUM_PIXELS):
-                self.set_pixel(i, wheel((((i * 255) // self.NUM_PIXELS) + j) & 255))
-            self.show()
-            j = (j + 1) % 256
-            await asyncio.sleep_ms(self.wait_ms)
+    def from_json(json, context=None):
+        return Rainbow(json["wait_ms"], json.get("palette"), context).use_keyframes(json.get("cache_kb", 0) * 1024)
+
+    @staticmethod
+    def from_binary(payload, header, context=None):
+        # Two or more stops make a palette
+        palette = None
+        if header[protocol.F_STOPS] >= 2:
+            palette = expand_palette(protocol.palette_stops(payload, header))
+        return Rainbow(header[protocol.F_WAIT_MS], palette, context).use_keyframes(header[protocol.F_CACHE_KB] * 1024)
+
+    def render(self, now_ms, fb):
+        if self.end_ms is not None:
+            self.fill((0, 0, 0, 0))
+            return False
+        self.render_periodic(now_ms)
+        return True
+
+    # The rainbow moves one wheel position every wait_ms
+    def period(self):
+        return 256
+
+    def phase(self, now_ms):
+        return (self.elapsed(now_ms) // self.wait_ms) & 255
+
+    def draw_phase(self, phase):
+        self.draw(phase)
+
+    def draw(self, j):
+        # Rainbow rotated by j wheel positions, looked up from the wheel table and written in one go.
+        frame = self.frame
+        hues = self.hues
+        wheel_table = self.wheel_table
+        for i in range(self.NUM_PIXELS):
+            frame[i] = wheel_table[(hues[i] + j) & 255]
+        self.write_frame(frame)
 
 class PowerOn(NeopixelConfigurationInterface):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, context=None):
+        super().__init__(context)
+
+    @staticmethod
+    def from_json(json, context=None):
+        return PowerOn(context)
 
     @staticmethod
-    def from_json(json):
-        return PowerOn()
-
-    async def setup(self):
-        # Fill with black
-        self.fill((0, 0, 0, 0))
-        self.show()
-        # Then, start a flash of light moving from the REED to the TAVERNA in clockwise direction
-        for i in self.get_board_pixel_range(_REED, _TAVERNA):
+    def from_binary(payload, header, context=None):
+        return PowerOn(context)
+
+    def begin(self, now_ms):
+        super().begin(now_ms)
+        self.flash = self.get_board_pixel_range(_REED, _TAVERNA)
+        self.line = self.get_board_pixel_range(_TAVERNA, _DESERT_END)
+        self.lines_drawn = 0
+
+    def render(self, now_ms, fb):
+        if self.end_ms is not None:
+            return False
+        # One step every 50ms. First a flash of light moving from the REED to the TAVERNA in clockwise direction
+        step = self.elapsed(now_ms) // 50
+        if step < len(self.flash):
             self.fill((0, 0, 0, 0))
-            self.set_pixel(i, (255, 255, 255, 255))
-            self.show()
-            await asyncio.sleep_ms(50)
-        # Now, start drawing a feathered line from the TAVERNA through the DESERT
-        line_length = 10
-        line_feather = 4
-        for i in self.get_board_pixel_range(_TAVERNA, _DESERT_END):
-            self.set_feather_pixel_line(i, i + line_length, (255, 255, 255, 255), line_feather)
-            self.show()
-            await asyncio.sleep_ms(50)
\ No newline at end of file
+            self.set_pixel(self.flash[step], (255, 255, 255, 255))
+            return True
+        # Then a feathered line drawn from the TAVERNA through the DESERT. Every line is drawn over the previous
+        # ones, so the steps of dropped frames are drawn too.
+        step = min(step - len(self.flash), len(self.line) - 1)
+        while self.lines_drawn <= step:
+            i = self.line[self.lines_drawn]
+            self.set_feather_pixel_line(i, i + 10, (255, 255, 255, 255), 4)
+            self.lines_drawn += 1
+        return step < len(self.line) - 1
+
+class LiveStream(NeopixelConfigurationInterface):
+    # Frames streamed by the app over the live frame characteristic, as keyframes or deltas (see protocol.py).
+    # Packets are decoded into a ring of frames as they arrive. Playback starts once <depth> frames are buffered
+    # and shows one every frame_ms, so that the jitter of the BLE link doesn't show. If the buffer runs dry, the
+    # last frame stays until it is filled up again.
+    def __init__(self, frame_ms=40, depth=2, context=None):
+        super().__init__(context)
+        self.frame_ms = frame_ms
+        self.depth = depth
+        self.slots = None
+        self.params = array.array("i", [0, protocol.STREAM_HEADER_SIZE, self.NUM_PIXELS])
+        self.ready = bytearray(depth + 1)
+        self._allocate()
+        self.reset_stream()
+
+    @staticmethod
+    def from_json(json, context=None):
+        return LiveStream(json.get("frame_ms", 40), json.get("depth", 2), context)
+
+    @staticmethod
+    def from_binary(payload, header, context=None):
+        return LiveStream(header[protocol.F_WAIT_MS] or 40, header[protocol.F_STEPS] or 2, context)
+
+    def _allocate(self):
+        if self.slots is None:
+            # Up to depth + 1 buffered frames, plus the frame shown and the frame being decoded
+            self.slots = [array.array("I", [0] * self.NUM_PIXELS) for _ in range(self.depth + 3)]
+            self.slot_bytes = [byte_view(slot) for slot in self.slots]
+
+    def release(self):
+        super().release()
+        self.slots = None
+        self.slot_bytes = None
+        self.restart()
+
+    def begin(self, now_ms):
+        # A stream shown again starts empty, not from the frames of its last run
+        super().begin(now_ms)
+        self._allocate()
+        self.restart()
+
+    def reset_stream(self):
+        self.restart()
+        self.received = 0
+        self.frames_shown = 0
+        self.lost = 0
+        self.dropped = 0
+        self.underruns = 0
+
+    def restart(self):
+        # Forget the buffered frames and the frame being decoded, the stats stay
+        self.ready_head = 0
+        self.ready_count = 0
+        self.shown = -1
+        self.decoding = -1
+        self.decode_seq = 0
+        self.decode_next = 0
+        # Sequence number and slot of the last complete frame, the base of the next delta
+        self.last_seq = -1
+        self.last_slot = -1
+        self.play_ms = None
+        # Slot and framebuffer last written to the strip: a frame is only written again when either changes
+        self.written = -1
+        self.written_fb = None
+
+    def stats(self):
+        return {
+            "received": self.received,
+            "shown": self.frames_shown,
+            "lost": self.lost,
+            "dropped": self.dropped,
+            "underruns": self.underruns,
+            "buffered": self.ready_count,
+        }
+
+    def _free_slot(self):
+        # A slot that isn't shown, buffered or the base of the next delta. Drops the oldest buffered frame if needed.
+        if self.ready_count == len(self.ready):
+            self.ready_head = (self.ready_head + 1) % len(self.ready)
+            self.ready_count -= 1
+            self.dropped += 1
+        for slot in range(len(self.slots)):
+            if slot == self.shown or slot == self.last_slot:
+                continue
+            for k in range(self.ready_count):
+                if self.ready[(self.ready_head + k) % len(self.ready)] == slot:
+                    break
+            else:
+                return slot
+        return -1
+
+    def feed(self, packet):
+        # Decode one packet of the live frame characteristic. Returns False if it was dropped.
+        if len(packet) < protocol.STREAM_HEADER_SIZE:
+            return False
+        kind, flags, seq, start = struct.unpack_from(protocol.STREAM_HEADER, packet, 0)
+        if kind != protocol.STREAM_KEYFRAME and kind != protocol.STREAM_DELTA:
+            self.lost += 1
+            return False
+        self._allocate()
+        if start == 0:
+            # A new frame. A delta needs the frame right before it.
+            if self.decoding >= 0:
+                self.lost += 1
+            self.decoding = -1
+            if kind == protocol.STREAM_DELTA and (self.last_slot < 0 or seq != (self.last_seq + 1) & 0xFFFF):
+                self.lost += 1
+                return False
+            slot = self._free_slot()
+            if kind == protocol.STREAM_DELTA:
+                self.slot_bytes[slot][:] = self.slot_bytes[self.last_slot]
+            self.decoding = slot
+            self.decode_seq = seq
+            self.decode_next = 0
+        elif self.decoding < 0 or seq != self.decode_seq or start != self.decode_next:
+            # A packet of this frame went missing
+            if self.decoding >= 0:
+                self.lost += 1
+            self.decoding = -1
+            return False
+        slot = self.decoding
+        if kind == protocol.STREAM_KEYFRAME:
+            size = len(packet) - protocol.STREAM_HEADER_SIZE
+            end = start + (size >> 2)
+            if size & 3 or end > self.NUM_PIXELS:
+                end = -1
+            else:
+                self.slot_bytes[slot][start * 4:end * 4] = memoryview(packet)[protocol.STREAM_HEADER_SIZE:]
+        else:
+            self.params[0] = start
+            end = rle_decode(self.slot_bytes[slot], packet, self.params)
+        if end < 0:
+            self.lost += 1
+            self.decoding = -1
+            return False
+        self.decode_next = end
+        if flags & protocol.STREAM_END:
+            self.ready[(self.ready_head + self.ready_count) % len(self.ready)] = slot
+            self.ready_count += 1
+            self.last_seq = seq
+            self.last_slot = slot
+            self.decoding = -1
+            self.received += 1
+        return True
+
+    def render(self, now_ms, fb):
+        if self.end_ms is not None:
+            self.fill((0, 0, 0, 0))
+            return False
+        self._allocate()
+        if self.play_ms is None and self.ready_count >= self.depth:
+            self.play_ms = now_ms
+        if self.play_ms is not None and time.ticks_diff(now_ms, self.play_ms) >= 0:
+            if self.ready_count:
+                self.shown = self.ready[self.ready_head]
+                self.ready_head = (self.ready_head + 1) % len(self.ready)
+                self.ready_count -= 1
+                self.frames_shown += 1
+                self.play_ms = time.ticks_add(self.play_ms, self.frame_ms)
+                # Far behind (e.g. after a stall): start the clock again
+                if time.ticks_diff(now_ms, self.play_ms) >= self.frame_ms:
+                    self.play_ms = now_ms
+            else:
+                # Ran dry, buffer up again
+                self.play_ms = None
+                self.underruns += 1
+        if self.shown != self.written or fb is not self.written_fb:
+            if self.shown >= 0:
+                self.write_frame(self.slots[self.shown])
+            else:
+                self.fill((0, 0, 0, 0))
+            self.written = self.shown
+            self.written_fb = fb
+        return True
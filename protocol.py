@@ -0,0 +1,197 @@
+# Binary pattern configs, the compact alternative to JSON on the neopixel characteristic. A binary payload starts
+# with MAGIC, which JSON never does, so both can be written to the same characteristic.
+#
+# Version 1 layout, little endian:
+#   header  HEADER: magic, version, mode id, flags, stop count, transition id, transition ms, wait_ms, steps,
+#           cache_kb
+#   stops   <stop count> color stops of raw bytes: index, r, g, b and, unless FLAG_RGB is set, w.
+#           Solid uses the first color, the pulse the first two, and more than two stops make a palette.
+#           At most MAX_STOPS, as many as a palette can have.
+# Patterns read the fields with the functions below straight from the payload, without building a dict.
+import struct
+import transitions
+
+MAGIC = 0xA7
+VERSION = 1
+HEADER = "<BBBBBBHHHH"
+HEADER_SIZE = struct.calcsize(HEADER)
+
+# Stops of a config, as many as color_utils.expand_palette() takes
+MAX_STOPS = 16
+
+# Stops are index, r, g, b without w
+FLAG_RGB = 1
+# Wipe from the end of the strip
+FLAG_REVERSE = 2
+
+# Fields of the unpacked header
+F_MODE = 2
+F_FLAGS = 3
+F_STOPS = 4
+F_TRANSITION = 5
+F_TRANSITION_MS = 6
+F_WAIT_MS = 7
+F_STEPS = 8
+F_CACHE_KB = 9
+
+MODE_IDS = {"solid": 1, "pulse": 2, "rainbow": 3, "poweron": 4, "stream": 5}
+MODE_NAMES = {1: "solid", 2: "pulse", 3: "rainbow", 4: "poweron", 5: "stream"}
+TRANSITION_IDS = {None: 0, "crossfade": 1, "wipe": 2, "dissolve": 3}
+
+
+def is_binary(payload):
+    return len(payload) > 0 and payload[0] == MAGIC
+
+
+def stop_size(header):
+    return 4 if header[F_FLAGS] & FLAG_RGB else 5
+
+
+def decode_header(payload):
+    # Unpacked header of a binary payload. Raises ValueError if it is not version 1 or is cut short.
+    view = memoryview(payload)
+    if len(view) < HEADER_SIZE:
+        raise ValueError("Binary config too short")
+    header = struct.unpack_from(HEADER, view, 0)
+    if header[1] != VERSION:
+        raise ValueError("Unknown binary config version: %d" % header[1])
+    if header[F_STOPS] > MAX_STOPS:
+        raise ValueError("Binary config has %d stops, at most %d fit a palette" % (header[F_STOPS], MAX_STOPS))
+    if len(view) < HEADER_SIZE + header[F_STOPS] * stop_size(header):
+        raise ValueError("Binary config too short")
+    return header
+
+
+def color(payload, header, index):
+    # Color of stop <index>: (r, g, b) or (r, g, b, w)
+    offset = HEADER_SIZE + index * stop_size(header) + 1
+    if header[F_FLAGS] & FLAG_RGB:
+        return (payload[offset], payload[offset + 1], payload[offset + 2])
+    return (payload[offset], payload[offset + 1], payload[offset + 2], payload[offset + 3])
+
+
+def palette_stops(payload, header):
+    # All stops as [index, r, g, b(, w)] lists, as palettes are defined
+    size = stop_size(header)
+    return [list(payload[HEADER_SIZE + k * size:HEADER_SIZE + (k + 1) * size]) for k in range(header[F_STOPS])]
+
+
+def transition(header):
+    # Transition of the config, None for the scheduler's default
+    kind = header[F_TRANSITION]
+    if kind == 0:
+        return None
+    duration_ms = header[F_TRANSITION_MS]
+    if kind == 1:
+        return transitions.Crossfade(duration_ms)
+    elif kind == 2:
+        return transitions.Wipe(duration_ms, bool(header[F_FLAGS] & FLAG_REVERSE))
+    elif kind == 3:
+        return transitions.Dissolve(duration_ms)
+    raise ValueError("Unknown transition id: %d" % kind)
+
+
+def encode(mode, stops=(), wait_ms=0, steps=0, cache_kb=0, transition=None, transition_ms=500, reverse=False):
+    """
+    Binary config, for clients and tests.
+
+    :param mode: Mode name, one of MODE_IDS
+    :param stops: Sequence of up to MAX_STOPS [index, r, g, b] or [index, r, g, b, w] stops, all of the same length
+    :param transition: [default: None] "crossfade", "wipe", "dissolve" or None for the default
+    :return: bytes
+    """
+    rgb = len(stops) > 0 and len(stops[0]) == 4
+    flags = (FLAG_RGB if rgb else 0) | (FLAG_REVERSE if reverse else 0)
+    header = struct.pack(HEADER, MAGIC, VERSION, MODE_IDS[mode], flags, len(stops), TRANSITION_IDS[transition],
+                         transition_ms, wait_ms, steps, cache_kb)
+    return header + bytes(value for stop in stops for value in stop)
+
+
+# Live frames, written to the live frame characteristic. A frame is sent as one or more packets of the same
+# sequence number, each starting at a pixel index:
+#   header  STREAM_HEADER: kind, flags, sequence number of the frame (wraps at 65536), first pixel
+#   body    STREAM_KEYFRAME: raw pixels, 4 bytes each: the packed 0xRRGGBBWW word little endian (w, b, g, r)
+#           STREAM_DELTA: runs against the previous frame. Every run is an op byte, the run type in its top two
+#           bits and the run length - 1 (1 to 64 pixels) in the others:
+#             RLE_SKIP     pixels stay as in the previous frame
+#             RLE_FILL     pixels are set to the color in the next 4 bytes
+#             RLE_LITERAL  pixels are set to the <length> colors in the next 4 * length bytes
+# The last packet of a frame has STREAM_END set. A delta frame only applies on top of the frame before it,
+# after a lost packet the stream continues from the next keyframe.
+STREAM_HEADER = "<BBHH"
+STREAM_HEADER_SIZE = struct.calcsize(STREAM_HEADER)
+STREAM_KEYFRAME = 0
+STREAM_DELTA = 1
+STREAM_END = 1
+RLE_SKIP = 0x00
+RLE_FILL = 0x40
+RLE_LITERAL = 0x80
+RLE_MAX_RUN = 64
+
+
+def _delta_runs(words, previous):
+    # (op byte, body bytes, pixels) of the runs turning <previous> into <words>
+    runs = []
+    count = len(words)
+    i = 0
+    while i < count:
+        n = 1
+        if words[i] == previous[i]:
+            while i + n < count and n < RLE_MAX_RUN and words[i + n] == previous[i + n]:
+                n += 1
+            runs.append((RLE_SKIP | (n - 1), b"", n))
+        else:
+            while i + n < count and n < RLE_MAX_RUN and words[i + n] == words[i]:
+                n += 1
+            if n > 1:
+                runs.append((RLE_FILL | (n - 1), struct.pack("<I", words[i]), n))
+            else:
+                # Changed pixels up to the next unchanged one or the next run of one color
+                while i + n < count and n < RLE_MAX_RUN and words[i + n] != previous[i + n] and \
+                        (i + n + 1 >= count or words[i + n + 1] != words[i + n]):
+                    n += 1
+                runs.append((RLE_LITERAL | (n - 1), struct.pack("<%dI" % n, *words[i:i + n]), n))
+        i += n
+    return runs
+
+
+def encode_stream_frame(words, previous, seq, payload_size):
+    """
+    Packets of a live frame, for clients and tests: a delta against <previous> when that is smaller than a
+    keyframe.
+
+    :param words: Packed 0xRRGGBBWW pixels of the frame
+    :param previous: Pixels of the frame before it, or None to send a keyframe
+    :param seq: Sequence number of the frame
+    :param payload_size: Largest packet, the negotiated MTU - 3 for a write without response
+    :return: list of bytes
+    """
+    seq &= 0xFFFF
+    count = len(words)
+    packets = []
+    if previous is not None:
+        runs = _delta_runs(words, previous)
+        start = 0
+        pixel = 0
+        body = []
+        size = STREAM_HEADER_SIZE
+        for op, data, n in runs:
+            if size + 1 + len(data) > payload_size:
+                packets.append(struct.pack(STREAM_HEADER, STREAM_DELTA, 0, seq, start) + b"".join(body))
+                start = pixel
+                body = []
+                size = STREAM_HEADER_SIZE
+            body.append(bytes((op,)) + data)
+            size += 1 + len(data)
+            pixel += n
+        packets.append(struct.pack(STREAM_HEADER, STREAM_DELTA, STREAM_END, seq, start) + b"".join(body))
+        if sum(len(packet) for packet in packets) < STREAM_HEADER_SIZE + 4 * count:
+            return packets
+        packets = []
+    per_packet = (payload_size - STREAM_HEADER_SIZE) // 4
+    for start in range(0, count, per_packet):
+        end = min(count, start + per_packet)
+        flags = STREAM_END if end == count else 0
+        packets.append(struct.pack(STREAM_HEADER, STREAM_KEYFRAME, flags, seq, start) +
+                       struct.pack("<%dI" % (end - start), *words[start:end]))
+    return packets
@@ -0,0 +1,85 @@
+# Patterns by the "mode" in their JSON (or the mode id of a binary config, see protocol.py). Pattern modules are
+# only imported when their mode is first used, so boot time and RAM don't grow with the pattern library. Patterns
+# built from a payload are kept by that payload, so sending the same config again reuses the pattern instead of
+# building it again. Kept patterns hold no frame buffers once the scheduler has released them at the end of their
+# run. Dropping a pattern from the cache only forgets it, as it may still be on the strip.
+import json
+import protocol
+from transitions import transition_from_json
+
+# mode -> (module, class). Add a pattern by listing it here, or with PatternRegistry.register().
+PATTERNS = {
+    "solid": ("patterns", "NeopixelSingleColorConfiguration"),
+    "pulse": ("patterns", "NeopixelGradientPulseConfiguration"),
+    "gradient": ("patterns", "NeopixelGradientPulseConfiguration"),
+    "rainbow": ("patterns", "Rainbow"),
+    "poweron": ("patterns", "PowerOn"),
+    "stream": ("patterns", "LiveStream"),
+    "scene": ("scene", "ZoneScene"),
+}
+
+# Number of patterns kept by payload
+PATTERN_CACHE_SIZE = 4
+
+
+class PatternRegistry:
+    def __init__(self, context, cache_size=PATTERN_CACHE_SIZE):
+        self.context = context
+        self.modes = dict(PATTERNS)
+        self.classes = {}
+        # Built patterns by payload, the oldest is dropped first
+        self.cache = {}
+        self.cache_keys = [None] * cache_size
+        self.cache_next = 0
+        self.hits = 0
+        self.misses = 0
+
+    def register(self, mode, module, class_name):
+        self.modes[mode] = (module, class_name)
+        self.classes.pop(mode, None)
+
+    def get_class(self, mode):
+        # Pattern class of <mode>, imported on first use. Raises ValueError for an unknown mode.
+        cls = self.classes.get(mode)
+        if cls is None:
+            entry = self.modes.get(mode)
+            if entry is None:
+                raise ValueError("Unknown mode: %s" % mode)
+            cls = getattr(__import__(entry[0]), entry[1])
+            self.classes[mode] = cls
+        return cls
+
+    def create(self, config):
+        # New pattern from a parsed JSON config
+        return self.get_class(config.get("mode")).from_json(config, self.context)
+
+    def parse(self, payload):
+        # New pattern from a JSON or binary payload. Returns (pattern, transition), transition None for the default.
+        if protocol.is_binary(payload):
+            header = protocol.decode_header(payload)
+            mode = protocol.MODE_NAMES.get(header[protocol.F_MODE])
+            if mode is None:
+                raise ValueError("Unknown mode id: %d" % header[protocol.F_MODE])
+            pattern = self.get_class(mode).from_binary(payload, header, self.context)
+            return pattern, protocol.transition(header)
+        config = json.loads(payload)
+        if not isinstance(config, dict):
+            raise ValueError("Pattern config must be a JSON object")
+        return self.create(config), transition_from_json(config.get("transition"))
+
+    def from_payload(self, payload):
+        # Pattern for a JSON or binary payload (bytes, as received). Returns (pattern, transition), the same pattern
+        # for the same payload while it is cached. Raises ValueError for an invalid payload or an unknown mode.
+        entry = self.cache.get(payload)
+        if entry is not None:
+            self.hits += 1
+            return entry
+        self.misses += 1
+        entry = self.parse(payload)
+        old = self.cache_keys[self.cache_next]
+        if old is not None:
+            del self.cache[old]
+        self.cache_keys[self.cache_next] = payload
+        self.cache[payload] = entry
+        self.cache_next = (self.cache_next + 1) % len(self.cache_keys)
+        return entry
@@ -0,0 +1,42 @@
+# Scene pattern: every zone of the board (see zones.py) drawn on its own.
+from pattern_base import NeopixelConfigurationInterface
+from color_utils import RGB2RGBW, get_palette, lerp8, beat8, beatsin8
+
+
+class ZoneScene(NeopixelConfigurationInterface):
+    # Every zone of the board drawn on its own, e.g. the sea shimmering while the mountains glow. zones maps a zone
+    # name to {"palette": name, "bpm": scroll speed} or {"color": [r, g, b(, w)]}, either with "glow_bpm" to
+    # pulse its brightness.
+    def __init__(self, zones, context=None):
+        super().__init__(context)
+        self.layers = []
+        for name, spec in zones.items():
+            if name not in self.zones.spans:
+                raise ValueError("Unknown zone: %s" % name)
+            palette = spec.get("palette")
+            if palette is not None:
+                palette = get_palette(palette)
+            color = spec.get("color", (0, 0, 0, 0))
+            if len(color) == 3:
+                color = RGB2RGBW(color[0], color[1], color[2])
+            self.layers.append((name, palette, tuple(color), spec.get("bpm", 0), spec.get("glow_bpm", 0)))
+
+    @staticmethod
+    def from_json(json, context=None):
+        return ZoneScene(json["zones"], context)
+
+    def render(self, now_ms, fb):
+        if self.end_ms is not None:
+            self.fill((0, 0, 0, 0))
+            return False
+        for name, palette, color, bpm, glow_bpm in self.layers:
+            level = 255
+            if glow_bpm:
+                level = beatsin8(glow_bpm, 96, 255)
+            if palette is not None:
+                self.palette_zone(name, palette, beat8(bpm) if bpm else 0, level)
+            elif level == 255:
+                self.fill_zone(name, color)
+            else:
+                self.fill_zone(name, lerp8((0, 0, 0, 0), color, level))
+        return True
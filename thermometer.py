@@ -0,0 +1,130 @@
+# Temperatures of all DS18X20 sensors on the one-wire bus. A conversion is a broadcast, so it is started once for
+# all sensors, and they are read when it is done. Conversion takes longer the higher the resolution, and nothing
+# blocks meanwhile.
+#
+# Readings are kept in hundredths of a degree, the last <history> of every sensor in a ring. A reading is only
+# reported when it has moved more than <deadband> degrees from the last one reported. While the temperatures are
+# steady the sensors are sampled less and less often, down to once per max_interval_ms, and a change brings the
+# rate back to once per interval_ms.
+import array
+import time
+import uasyncio as asyncio
+
+# Conversion time in ms by resolution in bits
+CONVERSION_MS = {9: 94, 10: 188, 11: 375, 12: 750}
+
+
+class TemperatureSampler:
+    def __init__(self, sensor, roms, resolution=12, interval_ms=1000, max_interval_ms=8000, deadband=0.25,
+                 history=16):
+        if resolution not in CONVERSION_MS:
+            raise ValueError("Resolution must be 9 to 12 bits")
+        self.sensor = sensor
+        self.roms = list(roms)
+        self.resolution = resolution
+        self.interval_ms = interval_ms
+        self.max_interval_ms = max(interval_ms, max_interval_ms)
+        self.period_ms = interval_ms
+        self.deadband = int(round(deadband * 100))
+        self.depth = history
+        count = len(self.roms)
+        self.rings = [array.array("h", bytearray(2 * history)) for _ in range(count)]
+        self.heads = [0] * count
+        self.counts = [0] * count
+        self.reported = [None] * count
+        self.configured = False
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.rounds = 0
+        self.reads = 0
+        self.errors = 0
+        self.reports = 0
+
+    def stats(self):
+        return {
+            "sensors": len(self.roms),
+            "rounds": self.rounds,
+            "reads": self.reads,
+            "errors": self.errors,
+            "reports": self.reports,
+            "period_ms": self.period_ms,
+        }
+
+    def configure(self):
+        # Write the resolution to the configuration register of every sensor, keeping the alarm bytes
+        config = ((self.resolution - 9) << 5) | 0x1F
+        for rom in self.roms:
+            scratch = self.sensor.read_scratch(rom)
+            self.sensor.write_scratch(rom, bytes((scratch[2], scratch[3], config)))
+        self.configured = True
+
+    def add(self, index, value):
+        ring = self.rings[index]
+        ring[(self.heads[index] + self.counts[index]) % self.depth] = value
+        if self.counts[index] < self.depth:
+            self.counts[index] += 1
+        else:
+            self.heads[index] = (self.heads[index] + 1) % self.depth
+
+    def history(self, index):
+        # Readings of sensor <index> in hundredths of a degree, oldest first
+        ring = self.rings[index]
+        head = self.heads[index]
+        return [ring[(head + k) % self.depth] for k in range(self.counts[index])]
+
+    def latest(self, index):
+        # Last reading of sensor <index> in hundredths of a degree, None before the first
+        if self.counts[index] == 0:
+            return None
+        return self.rings[index][(self.heads[index] + self.counts[index] - 1) % self.depth]
+
+    async def sample(self):
+        # One round: convert on all sensors, wait until it is done and read them all. Returns the indices of the
+        # sensors whose reading moved past the deadband.
+        self.sensor.convert_temp()
+        await asyncio.sleep_ms(CONVERSION_MS[self.resolution])
+        changed = []
+        for index, rom in enumerate(self.roms):
+            try:
+                temperature = self.sensor.read_temp(rom)
+            except Exception:
+                # CRC error, e.g. a loose wire: keep the last reading
+                temperature = None
+            if temperature is None:
+                self.errors += 1
+                continue
+            self.reads += 1
+            value = int(round(temperature * 100))
+            self.add(index, value)
+            reported = self.reported[index]
+            if reported is None or abs(value - reported) > self.deadband:
+                self.reported[index] = value
+                changed.append(index)
+        self.rounds += 1
+        if changed:
+            self.period_ms = self.interval_ms
+        else:
+            self.period_ms = min(self.max_interval_ms, 2 * self.period_ms)
+        return changed
+
+    async def run(self, report):
+        # Sample until cancelled, calling report(index, value) with the reading in hundredths of a degree whenever
+        # it moves past the deadband. report may be a plain function or an async one. All sensors are reported on
+        # the first round.
+        self.reported = [None] * len(self.roms)
+        self.period_ms = self.interval_ms
+        while True:
+            start = time.ticks_ms()
+            try:
+                if not self.configured:
+                    self.configure()
+                for index in await self.sample():
+                    self.reports += 1
+                    result = report(index, self.reported[index])
+                    if result is not None:
+                        await result
+            except Exception as e:
+                print("Error handling thermometer data:", e)
+            elapsed = time.ticks_diff(time.ticks_ms(), start)
+            await asyncio.sleep_ms(max(0, self.period_ms - elapsed))
@@ -0,0 +1,84 @@
+# Transitions between two patterns. While a transition runs, the FrameScheduler renders the outgoing and the
+# incoming pattern into framebuffers of their own and a transition combines the two frames into the one shown.
+import random
+from kernels import blend_words
+from color_utils import blend8
+
+
+class Crossfade:
+    # Blend the outgoing frame into the incoming one over duration_ms, with integer alpha.
+    def __init__(self, duration_ms=500):
+        self.duration_ms = duration_ms
+
+    def amount(self, elapsed_ms):
+        # Progress 0..256, 256 when done
+        if elapsed_ms >= self.duration_ms:
+            return 256
+        return elapsed_ms * 256 // self.duration_ms
+
+    def blend(self, out, outgoing, incoming, amount):
+        # out, outgoing and incoming are array.array('I') of packed pixels in pixel order
+        blend_words(out, outgoing, incoming, amount)
+
+
+class Wipe(Crossfade):
+    # The incoming frame sweeps over the strip from pixel 0 (or from the end, if reverse), with a soft edge
+    # of <edge> pixels.
+    def __init__(self, duration_ms=500, reverse=False, edge=8):
+        super().__init__(duration_ms)
+        self.reverse = reverse
+        self.edge = edge
+
+    def blend(self, out, outgoing, incoming, amount):
+        count = len(out)
+        edge = self.edge
+        # Position of the front of the edge, from -edge (nothing wiped) to count (all of it)
+        front = (count + edge) * amount // 256 - edge
+        for i in range(count):
+            k = count - 1 - i if self.reverse else i
+            if k < front:
+                out[i] = incoming[i]
+            elif k >= front + edge:
+                out[i] = outgoing[i]
+            else:
+                # Inside the edge the blend goes from incoming to outgoing
+                out[i] = blend8(incoming[i], outgoing[i], (k - front + 1) * 255 // (edge + 1))
+
+
+class Dissolve(Crossfade):
+    # Pixels switch to the incoming frame one by one, in a random order.
+    def __init__(self, duration_ms=500):
+        super().__init__(duration_ms)
+        self.order = None
+
+    def blend(self, out, outgoing, incoming, amount):
+        count = len(out)
+        order = self.order
+        if order is None or len(order) != count:
+            # Moment every pixel switches, 0..255 spread evenly over the pixels and shuffled
+            order = bytearray(i * 256 // count for i in range(count))
+            for i in range(count - 1, 0, -1):
+                j = random.randint(0, i)
+                order[i], order[j] = order[j], order[i]
+            self.order = order
+        for i in range(count):
+            if order[i] < amount:
+                out[i] = incoming[i]
+            else:
+                out[i] = outgoing[i]
+
+
+# Transition described in a pattern's JSON, e.g. {"type": "wipe", "ms": 800, "reverse": true}.
+# Returns None when json is None, so the scheduler's default is used.
+def transition_from_json(json):
+    if json is None:
+        return None
+    kind = json.get("type", "crossfade")
+    duration_ms = json.get("ms", 500)
+    if kind == "crossfade":
+        return Crossfade(duration_ms)
+    elif kind == "wipe":
+        return Wipe(duration_ms, json.get("reverse", False), json.get("edge", 8))
+    elif kind == "dissolve":
+        return Dissolve(duration_ms)
+    raise ValueError("Unknown transition: %s" % kind)
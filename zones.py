@@ -0,0 +1,48 @@
+# Named zones of the board (the sea, the mountains, the taverna...), loaded from zones.json and compiled at
+# startup into the spans of board pixels they cover, so drawing a zone needs no per-pixel index math.
+import array
+import json
+
+ZONE_FILE = "zones.json"
+
+
+class ZoneMap:
+    # A zone is a list of [start, end] ranges of board pixels, end exclusive, going clockwise. A range may wrap
+    # around the end of the strip (e.g. [135, 30]). Every zone is compiled into
+    #   spans: tuple of (start, stop) runs of consecutive pixels, split where they wrap
+    #   indices: array.array('H') of its pixels in order
+    def __init__(self, num_pixels, zones):
+        self.num_pixels = num_pixels
+        self.spans = {}
+        self.indices = {}
+        for name, ranges in zones.items():
+            # A single range may be given without the outer list
+            if type(ranges[0]) is int:
+                ranges = (ranges,)
+            spans = []
+            for start, end in ranges:
+                start %= num_pixels
+                end %= num_pixels
+                if end > start:
+                    spans.append((start, end))
+                else:
+                    # Wraps around, or the whole strip when start == end
+                    spans.append((start, num_pixels))
+                    if end > 0:
+                        spans.append((0, end))
+            self.spans[name] = tuple(spans)
+            indices = array.array("H")
+            for start, stop in spans:
+                indices.extend(array.array("H", range(start, stop)))
+            self.indices[name] = indices
+
+    @staticmethod
+    def from_file(num_pixels, path=ZONE_FILE):
+        with open(path) as f:
+            return ZoneMap(num_pixels, json.load(f))
+
+    def names(self):
+        return list(self.spans)
+
+    def size(self, name):
+        return len(self.indices[name])